@@ -0,0 +1,151 @@
+"""
+RUN THIS FILE TO BENCHMARK THE NON-LLM PARTS OF THE GENERATION AND EVAL PIPELINES.
+
+Times every stage in stages.py (tree templates, deduction prompts, the v2 tree completion with its parsing and
+validation, LogicTree from_json / get_facts / print_for_gpt over viewer/small_datasets, madlib sampling,
+create_sequence_v2, build_assignment and the eval loop) at a few input sizes, with DryRunModel in place of an LLM.
+
+For every stage and size the median / min time of --repeat runs and the time per unit (node, sample, example, ...) are
+written to --out as json.  For every stage, the growth exponent (slope of log time vs log units over its sizes) shows
+how the stage scales: ~1 is linear, ~2 quadratic.
+
+With --baseline, results are compared to a previous run: a stage size that got more than --tolerance times slower (and
+by more than --min-delta seconds), or a stage whose growth exponent went up by more than 0.3, is a regression and the
+script exits with 1.  Refresh the baseline on the machine the comparison runs on with --save-baseline.
+
+Usage:
+
+    python benchmarks/run_benchmarks.py [--scale quick|full] [--only build_structure eval_loop ...] [--repeat 5]
+        [--out benchmark_results.json] [--baseline benchmarks/baseline.json] [--save-baseline] [--tolerance 1.5]
+
+(run from the repo root with PYTHONPATH=.)
+"""
+
+import argparse
+import json
+import math
+import platform
+import random
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from statistics import median
+from typing import Any, Dict
+
+sys.path.append(str(Path(__file__).parent))
+from stages import BENCHMARKS
+
+BASELINE_FILE = Path(__file__).parent / 'baseline.json'
+
+
+def growth_exponent(points) -> float:
+    """Least squares slope of log(seconds) vs log(units) over [(units, seconds), ...] (nan with < 2 points)."""
+    points = [(math.log(u), math.log(s)) for u, s in points if u > 0 and s > 0]
+    if len(set([x for x, _ in points])) < 2:
+        return float('nan')
+    mx = sum([x for x, _ in points]) / len(points)
+    my = sum([y for _, y in points]) / len(points)
+    return sum([(x - mx) * (y - my) for x, y in points]) / sum([(x - mx) ** 2 for x, _ in points])
+
+
+def run_benchmark(name: str, size: int, repeat: int) -> Dict[str, Any]:
+    setup, size_name, _, _ = BENCHMARKS[name]
+
+    random.seed(0)
+    run = setup(size)
+
+    times = []
+    units = 0
+    for ridx in range(repeat):
+        random.seed(ridx)
+        start = time.perf_counter()
+        units = run()
+        times.append(time.perf_counter() - start)
+
+    return {
+        'benchmark': name,
+        size_name: size,
+        'units': units,
+        'median_s': median(times),
+        'min_s': min(times),
+        'repeat': repeat,
+        'per_unit_us': median(times) / max(1, units) * 1e6,
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float, min_delta: float):
+    regressions = []
+    for key, r in results['runs'].items():
+        b = baseline['runs'].get(key)
+        if b is None:
+            continue
+        ratio = r['median_s'] / max(b['median_s'], 1e-9)
+        r['baseline_median_s'] = b['median_s']
+        r['ratio'] = ratio
+        if ratio > tolerance and r['median_s'] - b['median_s'] > min_delta:
+            regressions.append(f'{key}: {b["median_s"]:.4f}s -> {r["median_s"]:.4f}s ({ratio:.2f}x)')
+
+    for name, exponent in results['growth_exponents'].items():
+        b = baseline['growth_exponents'].get(name)
+        if b is None or math.isnan(b) or math.isnan(exponent):
+            continue
+        if exponent - b > 0.3:
+            regressions.append(f'{name}: growth exponent {b:.2f} -> {exponent:.2f}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the non-LLM stages of the MuSR pipelines.')
+    parser.add_argument('--scale', choices=['quick', 'full'], default='quick')
+    parser.add_argument('--only', nargs='+', default=None, choices=list(BENCHMARKS.keys()))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--out', type=Path, default=Path('benchmark_results.json'))
+    parser.add_argument('--baseline', type=Path, default=None, help='Compare to this results file.')
+    parser.add_argument('--save-baseline', action='store_true', help=f'Also write the results to {BASELINE_FILE}.')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='Slowdown (x) that counts as a regression.')
+    parser.add_argument('--min-delta', type=float, default=0.005, help='Ignore slowdowns smaller than this (seconds).')
+    args = parser.parse_args()
+
+    results = {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+            'scale': args.scale,
+        },
+        'runs': {},
+        'growth_exponents': {},
+    }
+
+    for name in (args.only or BENCHMARKS.keys()):
+        _, size_name, quick_sizes, full_sizes = BENCHMARKS[name]
+        points = []
+        for size in (quick_sizes if args.scale == 'quick' else full_sizes):
+            r = run_benchmark(name, size, args.repeat)
+            results['runs'][f'{name}[{size_name}={size}]'] = r
+            points.append((r['units'], r['median_s']))
+            print(f'{name:<24} {size_name}={size:<6} {r["units"]:>8} units | median {r["median_s"]:.4f}s | min {r["min_s"]:.4f}s | {r["per_unit_us"]:.1f} us/unit', flush=True)
+        results['growth_exponents'][name] = growth_exponent(points)
+        print(f'{name:<24} growth exponent {results["growth_exponents"][name]:.2f}', flush=True)
+
+    regressions = []
+    if args.baseline is not None:
+        regressions = compare(results, json.load(args.baseline.open('r')), args.tolerance, args.min_delta)
+        results['regressions'] = regressions
+
+    json.dump(results, args.out.open('w'), indent=2)
+    if args.save_baseline:
+        json.dump(results, BASELINE_FILE.open('w'), indent=2)
+    print(f'Results written to {args.out}')
+
+    if regressions:
+        print('REGRESSIONS:')
+        for r in regressions:
+            print(f'  {r}')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""
+The pipeline stages run_benchmarks.py times.
+
+Every stage is a setup function that takes a size (tree depth, number of samples, dataset copies, ...), does the work
+that should not be timed (loading files, building inputs) and returns a run function.  run() does the timed work once
+and returns how many units it processed (nodes, samples, examples, ...), so run_benchmarks.py can report the time per
+unit and how the time grows with the size.
+
+No stage calls an LLM, the ones that need a model use DryRunModel (src/model/dry_run.py).
+"""
+
+import json
+import random
+import sys
+import tempfile
+from functools import partial
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from src.dataset_builder import DatasetBuilder
+from src.dataset_types.murder_mystery_dataset import _mm_completion_prompt_intro_
+from src.dataset_types.object_placements_dataset import ObjectPlacementsDataset
+from src.dataset_types.team_allocation import TeamAllocationDataset
+from src.evaluation.answer_extraction import extract_answer
+from src.evaluation.dataset_stream import DatasetStream
+from src.evaluation.prompts import build_prompt
+from src.evaluation.runner import InferenceRunner, run_inference
+from src.logic_tree.tree import LogicTree, LogicNode
+from src.model import DryRunModel
+from src.utils.paths import ROOT_FOLDER
+from src.validators import StructureValidator
+
+sys.path.append(str(ROOT_FOLDER / 'musr_dataset_scripts_ibm'))
+import create_murder_mysteries
+
+SMALL_DATASETS_FOLDER = ROOT_FOLDER / 'viewer' / 'small_datasets'
+SMALL_DATASETS = ['small_murder_mystery.json', 'small_object_placements.json', 'small_team_allocation.json']
+
+
+def murder_mystery_template(depth: int, suspect: str = 'Mackenzie') -> LogicTree:
+    """The template tree create_suspect_trees() fills in for a suspect (always two children per deduction)."""
+    root_nodes = [
+        LogicNode(f'{suspect} is the murderer.', [
+            LogicNode(f'{suspect} has a means.'),
+            LogicNode(f'{suspect} has an opportunity.'),
+            LogicNode(f'{suspect} has a motive.')
+        ], frozen=True, prunable=False)
+    ]
+    return DatasetBuilder().build_structure(depth=depth, bf_factor={2: 1.0}, chance_to_prune=0.0, chance_to_prune_all=0.0, root_nodes=root_nodes)
+
+
+def murder_mystery_prompt_fn():
+    return DatasetBuilder().create_completion_prompt(
+        create_murder_mysteries.example_trees, create_murder_mysteries.example_node_completions,
+        create_murder_mysteries.example_descriptions, intro=_mm_completion_prompt_intro_, because_clause_after=0
+    )
+
+
+def all_nodes(tree: LogicTree) -> List[LogicNode]:
+    nodes, stack = [], list(tree.nodes)
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(node.children)
+    return nodes
+
+
+def small_dataset_trees(copies: int) -> List[dict]:
+    """The json of every reasoning tree in the shipped small datasets, copies times over."""
+    trees = []
+    for name in SMALL_DATASETS:
+        for example in json.load((SMALL_DATASETS_FOLDER / name).open('r')):
+            for question in example['questions']:
+                trees.extend(question['intermediate_trees'] or [])
+    return [y for y in trees for _ in range(copies)]
+
+
+def setup_build_structure(depth: int) -> Callable[[], int]:
+    def run():
+        return sum([len(all_nodes(murder_mystery_template(depth, suspect))) for suspect in ['Mackenzie', 'Ana', 'Rory']])
+    return run
+
+
+def setup_completion_prompt(depth: int) -> Callable[[], int]:
+    tree = murder_mystery_template(depth)
+    nodes = [x for x in all_nodes(tree) if any([c.value == '' for c in x.children])]
+    description = create_murder_mysteries.example1_description
+
+    def run():
+        fn = murder_mystery_prompt_fn()
+        for node in nodes:
+            fn(tree, node, description)
+        return len(nodes)
+    return run
+
+
+def setup_complete_structure(depth: int) -> Callable[[], int]:
+    tree = murder_mystery_template(depth)
+    prompt_fn = murder_mystery_prompt_fn()
+    model = DryRunModel()
+
+    def run():
+        done = DatasetBuilder().complete_structure(
+            tree, model, description=create_murder_mysteries.example1_description, completion_prompt_fn=prompt_fn,
+            use_iterative_complete_v2=True, validators=[StructureValidator()]
+        )
+        return len(all_nodes(done))
+    return run
+
+
+def setup_tree_from_json(copies: int) -> Callable[[], int]:
+    trees = small_dataset_trees(copies)
+
+    def run():
+        for t in trees:
+            LogicTree.from_json(t)
+        return len(trees)
+    return run
+
+
+def setup_tree_get_facts(copies: int) -> Callable[[], int]:
+    trees = [LogicTree.from_json(x) for x in small_dataset_trees(copies)]
+
+    def run():
+        for t in trees:
+            t.get_facts()
+        return len(trees)
+    return run
+
+
+def setup_tree_print_for_gpt(copies: int) -> Callable[[], int]:
+    trees = [LogicTree.from_json(x) for x in small_dataset_trees(copies)]
+
+    def run():
+        for t in trees:
+            t.print_for_gpt(pad_space=1, pad_char='> ')
+        return len(trees)
+    return run
+
+
+def setup_madlib_sampling(n_samples: int) -> Callable[[], int]:
+    madlib = create_murder_mysteries.load_madlib()
+
+    def run():
+        DatasetBuilder().sample_madlib(
+            madlib, [['male_names', 'female_names'], 'crime_scenes', 'murder_weapons'],
+            description_string_format="Victim: {victim}\nCrime Scene: {crime_scene}\nMurder Weapon: {murder_weapon}",
+            sampled_item_names=['victim', 'crime_scene', 'murder_weapon'], n_samples=n_samples
+        )
+        return n_samples
+    return run
+
+
+def setup_create_sequence(max_sequence_length: int, n_sequences: int = 200) -> Callable[[], int]:
+    items = ['apple', 'notebook', 'keys', 'wallet']
+    locs = ['kitchen table', 'desk drawer', 'bookshelf', 'fridge', 'coat rack', 'sofa']
+    people = ['Ann', 'Bob', 'Cy']
+
+    def run():
+        creator = ObjectPlacementsDataset()
+        for _ in range(n_sequences):
+            creator.create_sequence_v2(items, locs, people, max_sequence_length=max_sequence_length, chance_subject_sees=0.25)
+        return n_sequences * max_sequence_length
+    return run
+
+
+def setup_build_assignment(n_assignments: int) -> Callable[[], int]:
+    people = ['Ann', 'Bob', 'Cy']
+
+    def run():
+        creator = TeamAllocationDataset()
+        for _ in range(n_assignments):
+            creator.build_assignment(people)
+        return n_assignments
+    return run
+
+
+EVAL_DATASETS = {
+    'small_murder_mystery.json': {'hint': 'The murderer needs to have a means, motive, and opportunity.'},
+    'small_object_placements.json': {'hint': 'Track where each person last saw the object.', 'skip_ablated': True, 'ablation_depth_modifier': 2},
+    'small_team_allocation.json': {'hint': 'Use everyones skills as well as possible.'},
+}
+EVAL_ABLATIONS = [{'prompt': 'cot+', 'name': 'cot+'}, {'prompt': 'facts', 'name': 'facts', 'no_facts_after_depth': 3}]
+
+
+def setup_eval_loop(copies: int) -> Callable[[], int]:
+    """The eval of eval_ibm.py (stream the dataset, build prompts, run them on a runner, parse the answers)."""
+    folder = Path(tempfile.mkdtemp(prefix='musr_bench_'))
+    files = {}
+    for name in EVAL_DATASETS:
+        examples = json.load((SMALL_DATASETS_FOLDER / name).open('r'))
+        files[name] = folder / name
+        json.dump([x for x in examples for _ in range(copies)], files[name].open('w'))
+    model = DryRunModel()
+
+    def run():
+        runner = InferenceRunner(default_max_concurrency=8)
+        n_questions = 0
+        for name, d in EVAL_DATASETS.items():
+            for a in EVAL_ABLATIONS:
+                with DatasetStream(files[name]) as stream:
+                    for example in stream.sample(randomize=True, load_trees=a['prompt'] not in ('regular', 'cot', 'cot+')):
+                        futures = []
+                        for question in example['questions']:
+                            prompt = build_prompt(example['context'], question, d, a)
+                            if prompt is not None:
+                                futures.append((question, runner.submit(model, partial(run_inference, model, prompt))))
+                        for question, future in futures:
+                            output = future.result()
+                            extracted = extract_answer(output, question['choices'])
+                            if extracted.choice is None:
+                                random.choice([str(x + 1) for x in range(len(question['choices']))])
+                            n_questions += 1
+        return n_questions
+    return run
+
+
+# name: (setup, name of the size, sizes for --scale quick, sizes for --scale full)
+BENCHMARKS: Dict[str, tuple] = {
+    'build_structure': (setup_build_structure, 'depth', [2, 3, 4], [2, 3, 4, 5, 6]),
+    'completion_prompt': (setup_completion_prompt, 'depth', [2, 3, 4], [2, 3, 4, 5, 6]),
+    'complete_structure_v2': (setup_complete_structure, 'depth', [2, 3, 4], [2, 3, 4, 5]),
+    'tree_from_json': (setup_tree_from_json, 'copies', [1, 4], [1, 4, 16]),
+    'tree_get_facts': (setup_tree_get_facts, 'copies', [1, 4], [1, 4, 16]),
+    'tree_print_for_gpt': (setup_tree_print_for_gpt, 'copies', [1, 4], [1, 4, 16]),
+    'madlib_sampling': (setup_madlib_sampling, 'samples', [100, 1000], [100, 1000, 10000]),
+    'create_sequence_v2': (setup_create_sequence, 'moves', [5, 10], [5, 10, 20]),
+    'build_assignment': (setup_build_assignment, 'assignments', [100, 400], [100, 400, 1600]),
+    'eval_loop': (setup_eval_loop, 'copies', [1, 4], [1, 4, 16]),
+}
@@ -0,0 +1,39 @@
+"""
+Rebuild the legacy run_data json of an eval (what eval_ibm.py writes into DISTILL_FOLDER) from its answer log.
+
+Usage:
+
+    python compact_answers.py {answer_log.jsonl} [{out_file.json}]
+
+By default the json is written next to the log, as {name}.json for {name}.answers.jsonl.
+"""
+
+import json
+import sys
+from pathlib import Path
+
+from src.evaluation.answer_log import compact_answer_log
+
+
+def main():
+    answer_log_file = Path(sys.argv[1])
+    if len(sys.argv) > 2:
+        out_file = Path(sys.argv[2])
+    else:
+        out_file = answer_log_file.parent / f'{answer_log_file.name.replace(".answers.jsonl", "")}.json'
+
+    run_data = compact_answer_log(answer_log_file)
+
+    with out_file.open('w') as f:
+        json.dump(run_data, f)
+
+    for model_name, model_data in run_data.items():
+        for dataset_name, dataset_data in model_data.items():
+            for ablation_name, ablation_data in dataset_data.items():
+                correct, total = ablation_data['correct'], ablation_data['total']
+                print(f'{model_name} | {dataset_name} | {ablation_name} | {correct} / {total} | {(correct / max(1, total)) * 100:.1f}')
+    print(f'Wrote {out_file}')
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,8 @@ from src import cache
 from src.model import OpenAIModel, HFModel
 from src.logic_tree.tree import LogicTree, LogicNode, LogicNodeFactType
 from src.madlib.madlib import Madlib
+from src.evaluation.answer_extraction import extract_answer
+from src.evaluation.dataset_stream import DatasetStream
 from src.utils.paths import OUTPUT_FOLDER
 
 from eval.icl.murder_mystery_solved_ex import murder_mystery_solved_ex
@@ -80,6 +82,7 @@ def main():
     human_verbose = False  # Useful for annotation stuff (just removes COT lingo)
     log_gold_answer = False  # Print the gold answer
     log_tree = False # Print the tree for the answer
+    save_trees = False # Keep the trees in the saved answers (they are most of the output file).  Off by default, so 'trees' is null in run_data and the trees are never parsed unless a prompt style needs them
     skip_inference = False # Don't actually call the model
     progress_bar = True # Show a progress bar
     randomize = True # Shuffle stuff.
@@ -113,28 +116,17 @@ def main():
                 if datasets.get(d["name"]):
                     dataset = datasets.get(d['name'])
                 else:
-                    _dataset = json.load((DATASETS_FOLDER / d.get("file_name", d.get('name', None))).open('r'))
-                    if randomize:
-                        random.shuffle(_dataset)
-
-                    dataset = []
-                    hashes_done = []
-                    for _d in _dataset:
-                        if exclude_contrastive_examples and _d['questions'][0].get('intermediate_data') and len(
-                                _d['questions'][0].get('intermediate_data')) > 0 and \
-                                _d['questions'][0]['intermediate_data'][0].get('story_hash_id'):
-                            if _d['questions'][0]['intermediate_data'][0]['story_hash_id'] in hashes_done:
-                                if reverse_contrastive_sample:
-                                    dataset.append(_d)
-                                else:
-                                    continue
-                            elif not reverse_contrastive_sample:
-                                dataset.append(_d)
-                            hashes_done.append(_d['questions'][0]['intermediate_data'][0]['story_hash_id'])
-                        else:
-                            dataset.append(_d)
-
-                    dataset = dataset[offset:offset+min(len(dataset), sample_size) if sample_size else sample_size]
+                    # Examples are parsed lazily from the file (see src/evaluation/dataset_stream.py), the reasoning
+                    # trees only when something below uses them.
+                    load_trees = save_trees or log_tree or any([x.get('prompt') not in ('regular', 'cot', 'cot+') for x in ablations])
+                    dataset = DatasetStream(DATASETS_FOLDER / d.get("file_name", d.get('name', None))).sample(
+                        randomize=randomize,
+                        offset=offset,
+                        sample_size=sample_size,
+                        exclude_contrastive_examples=exclude_contrastive_examples,
+                        reverse_contrastive_sample=reverse_contrastive_sample,
+                        load_trees=load_trees
+                    )
 
                     datasets[d['name']] = dataset
 
@@ -176,7 +168,7 @@ def main():
 
                                 prompt = f'{ex_str}Answer the following questions given the list of facts per answer choice.\n\n'
                                 for c, t in zip(choices.split('\n'), question['intermediate_trees']):
-                                    facts = list(set([x.value for x in LogicTree.from_json(t).get_facts(include_cs=a.get('include_cs', False), include_deductions_past_level=-1, no_facts_after_depth=a.get('no_facts_after_depth', 3) + d.get('ablation_depth_modifier', 0))]))
+                                    facts = list(set([x.value for x in LogicTree.from_json(t).get_facts(include_cs=a.get('include_cs', False), include_deductions_from_level=-1, no_facts_after_depth=a.get('no_facts_after_depth', 3) + d.get('ablation_depth_modifier', 0))]))
                                     facts = list(sorted(facts)) if d.get('allow_sorted_facts', True) else facts
                                     facts_str = "\n".join([f'- {x}' for x in facts])
                                     prompt += f'Facts for Choice {c}:\n{facts_str}\n\n'
@@ -210,40 +202,39 @@ def main():
                                 print("MODEL OUTPUT")
                                 print(output)
 
-                            try:
-                                lines = [x.split('answer:')[-1].strip() for x in output.lower().split('\n') if 'answer:' in x and len(x.split('answer:')[-1].strip())>0]
-                                answer = lines[-1]
-                            except Exception as e:
-                                answer = ''
+                            extracted = extract_answer(output, question["choices"])
+                            answer = str(extracted.choice) if extracted.choice is not None else ''
 
                             randomly_selected = False
-                            if not any([str(x+1) in answer for x in range(len(question["choices"]))]):
+                            if extracted.choice is None:
                                 answer = random.sample([str(x+1) for x in range(len(question["choices"]))], 1)[0]
                                 randomly_selected = True
 
-                            if str(gold_answer) in answer:
+                            if answer == str(gold_answer):
                                 answer_outs.append(str(gold_answer))
                                 raw_answers.append({
                                     'qidx': qidx,
                                     'prompt': prompt,
                                     'output': output,
                                     'model_parsed_answer': answer,
-                                    'trees': question['intermediate_trees'],
+                                    'trees': question['intermediate_trees'] if save_trees else None,
                                     'data': question['intermediate_data'],
                                     'randomly_selected': randomly_selected,
+                                    'answer_status': extracted.status.value,
                                     'gold_answer': gold_answer,
                                     'correct': True
                                 })
-                            elif any([str(x+1) in answer for x in range(len(question["choices"]))]):
-                                answer_outs.append([str(x+1) for x in range(len(question["choices"])) if str(x+1) in answer][0])
+                            elif answer in [str(x+1) for x in range(len(question["choices"]))]:
+                                answer_outs.append(answer)
                                 raw_answers.append({
                                     'qidx': qidx,
                                     'prompt': prompt,
                                     'output': output,
                                     'model_parsed_answer': answer,
-                                    'trees': question['intermediate_trees'],
+                                    'trees': question['intermediate_trees'] if save_trees else None,
                                     'data': question['intermediate_data'],
                                     'randomly_selected': randomly_selected,
+                                    'answer_status': extracted.status.value,
                                     'gold_answer': gold_answer,
                                     'correct': False
                                 })
@@ -291,7 +282,11 @@ def main():
                     json.dump(run_data, out_file.open('w'))
 
         if isinstance(m, HFModel):
-            del m
+            # Free the weights for the next model (del m only dropped a reference, the memory was never released).
+            m.unload_model()
+
+    for dataset in datasets.values():
+        dataset.close()
 
 if __name__ == "__main__":
     main()
@@ -8,6 +8,7 @@ from transformers import AutoTokenizer
 import transformers
 from transformers import AutoModelForCausalLM, AutoTokenizer
 import collections
+from functools import partial
 
 from icl.team_allocation_solved_ex import team_allocation_solved_ex
 from icl.murder_mystery_solved_ex import murder_mystery_solved_ex
@@ -17,9 +18,16 @@ from src.model.rits import RitsModel
 random.seed(0)
 
 from src import cache
-from src.model import OpenAIModel, HFModel
+from src.model import OpenAIModel, HFModel, hf_registry
 from src.logic_tree.tree import LogicTree, LogicNode, LogicNodeFactType
 from src.madlib.madlib import Madlib
+from src.evaluation.dataset_stream import DatasetStream
+from src.evaluation.prompts import build_prompt, format_choices
+from src.evaluation.prompt_store import PromptStore, needs_trees
+from src.evaluation.runner import InferenceRunner, submit_inference
+from src.evaluation.answer_extraction import extract_answer
+from src.evaluation.answer_log import AnswerLog, prompt_hash, record_key
+from src.evaluation.self_consistency import SampleWaves
 from src.utils.paths import OUTPUT_FOLDER, DISTILL_FOLDER
 
 # from eval.icl.murder_mystery_solved_ex import murder_mystery_solved_ex
@@ -65,6 +73,9 @@ def main():
         # {'prompt': 'cot+', 'name': 'cot+ 1-shot', 'self_consistency_n': 1, 'use_example': True},
         # {'prompt': 'cot+', 'name': 'cot+ s.c.', 'self_consistency_n': 3},
         # {'prompt': 'cot+', 'name': 'cot+ s.c. 1-shot', 'self_consistency_n': 3, 'use_example': True},
+        # Adaptive self-consistency: ask for 'self_consistency_wave' samples at a time and stop once the vote is decided
+        # (or the leader is ahead with 'self_consistency_confidence'), see src/evaluation/self_consistency.py.
+        # {'prompt': 'cot+', 'name': 'cot+ adaptive s.c.', 'self_consistency_n': 9, 'self_consistency_wave': 3, 'self_consistency_confidence': 0.95},
         # {'prompt': 'phi-4', 'name': 'Phi-4-reasoning-plus'}
     ]
 
@@ -95,231 +106,324 @@ def main():
     verbose = False  # Print stuff out
     human_verbose = False  # Useful for annotation stuff (just removes COT lingo)
     log_gold_answer = True  # Print the gold answer
-    log_tree = True # Print the tree for the answer
+    log_tree = True # Print the tree for the answer (the trees of that one question are parsed just for this)
+    save_trees = False # Keep the trees in the saved answers (they are most of the output file).  Off by default, so 'trees' is null in run_data and the answer log, and the trees are never parsed unless a prompt style needs them
     skip_inference = False # Don't actually call the model
     progress_bar = True # Show a progress bar
     randomize = True # Shuffle stuff.
 
+    max_concurrency = 8 # Model calls in flight per api model (set 'max_concurrency' in a models_to_test entry to override, huggingface models default to 1)
+    max_pending = 64 # How far (in model calls) the prompt planning may run ahead of the scoring
+    fan_out = True # Build every prompt once and send it to all models_to_test at once (api models run while the local model is busy); False evaluates the models one after the other
+    hf_memory_budget_gb = None # Most GB the loaded huggingface checkpoints may take, the least recently used ones are unloaded to make room (None for no limit)
+    preload_hf_models = True # Load (and warm up) the huggingface models before the eval starts instead of on their first call
+    save_run_data = True # Rewrite the full run_data json after every ablation (compact_answers.py can rebuild it from the answer log)
+
+    # Every scored answer is appended here as it happens.  Rerunning with the same log reuses the answers in it instead
+    # of calling the model again (see src/evaluation/answer_log.py).
+    answer_log = AnswerLog(DISTILL_FOLDER / f'{Path(input_file_name).stem}.answers.jsonl')
+
+    # The prompts of every dataset x ablation are compiled once into this store and looked up by the eval, so reasoning
+    # trees are only parsed to compile new prompts (see src/evaluation/prompt_store.py).  None builds them on the fly.
+    prompt_store = PromptStore(DISTILL_FOLDER / f'{Path(input_file_name).stem}.prompts')
+    compile_only = False # Only compile the prompts into the prompt store, don't run the eval
+
     datasets = {}
     run_data = {}
     out_file = None # Can save results to a json file, should be a path object.
 
     run_cost = 0.0
 
-    for model_info in models_to_test:
+    if prompt_store is not None:
+        for d in datasets_to_test:
+            with DatasetStream(DATASETS_FOLDER / d.get("file_name", d.get('name', None))) as stream:
+                for a in ablations:
+                    stats = prompt_store.compile(stream, d, a)
+                    print(f'PROMPT STORE | {d["name"]} | {a["name"]} | compiled {stats["examples"]} examples, {stats["new_prompts"]} new prompts ({stats["tokens"]} tokens) | {len(prompt_store)} prompts in the store')
+        if compile_only:
+            prompt_store.close()
+            answer_log.close()
+            return
+
+    # Examples are parsed lazily from the file (see src/evaluation/dataset_stream.py), the reasoning trees only when
+    # something below uses them.
+    load_trees = save_trees or (prompt_store is None and any([needs_trees(x) for x in ablations]))
+    for d in datasets_to_test:
+        if not datasets.get(d['name']):
+            datasets[d['name']] = DatasetStream(DATASETS_FOLDER / d.get("file_name", d.get('name', None))).sample(
+                randomize=randomize,
+                offset=offset,
+                sample_size=sample_size,
+                exclude_contrastive_examples=exclude_contrastive_examples,
+                reverse_contrastive_sample=reverse_contrastive_sample,
+                load_trees=load_trees
+            )
+
+    # Huggingface checkpoints are loaded once per process and shared by the HFModels using them (see
+    # src/model/hf_registry.py).
+    hf_registry.memory_budget = int(hf_memory_budget_gb * 1024 ** 3) if hf_memory_budget_gb is not None else None
+    if preload_hf_models and not skip_inference:
+        hf_registry.preload([x['model'].checkpoint for x in models_to_test if isinstance(x['model'], HFModel)], warmup=True)
+
+    # Every model call is a job on the model's own thread pool, local models share one GPU queue (see
+    # src/evaluation/runner.py).  The planning below submits the calls in the order the scoring loop further down walks
+    # over them, so the results do not depend on how many calls run at once.
+    runner = InferenceRunner(default_max_concurrency=max_concurrency)
+
+    def submit_sample(m, model_name, model_info, model_concurrency, d, a, eidx, qidx, question, prompt, gold_answer, qhash, scidx):
+        if verbose:
+            print(f'EX: {eidx +1}.{qidx +1}')
+
+            if human_verbose:
+                print(prompt.replace(' Explain your reasoning step by step before you answer.', ''))
+            else:
+                print(prompt)
+        if log_gold_answer:
+            print(gold_answer)
+        if log_tree:
+            trees = question['intermediate_trees'] if 'intermediate_trees' in question else datasets[d['name']].question_trees(eidx, qidx)
+            for i in trees:
+                print(LogicTree.from_json(i).print_for_gpt(pad_space=1, pad_char='> '))
+        if skip_inference:
+            return None
+
+        model_prompt = prompt
+        if isinstance(m, HFModel):
+            # Boaz - I am using the original system prompt. My model_info.get("system_prompt_template") is empty
+            if d.get("system_prompt") and model_info.get("system_prompt_template"):
+                model_prompt = model_info.get("system_prompt_template").replace("{system_prompt}", d.get('system_prompt')).replace("{prompt}", prompt)
+
+        key = record_key(model_name, d['name'], a['name'], qhash, qidx, scidx, prompt_hash(model_prompt))
+        logged = answer_log.get(key)
+
+        # The cache key (and its ".N" sample number) is taken now, in plan order and for logged answers too, so the
+        # samples of a wave can run at the same time and a resumed run calls the cache like an uninterrupted one.
+        # Uncached models are chained instead (one sample after the other).
+        future = submit_inference(
+            runner, m, model_prompt, system_prompt=d.get("system_prompt"),
+            logged_output=logged['output'] if logged is not None else None,
+            chain_key=(model_name, model_prompt, d.get("system_prompt")),
+            max_concurrency=model_concurrency
+        )
+        return scidx, model_prompt, future
+
+    def model_entry(model_info):
         m = model_info['model']
         model_name = m.model_name if isinstance(m, HFModel) else m.engine
-
+        model_concurrency = model_info.get('max_concurrency', 1 if isinstance(m, HFModel) else max_concurrency)
+        return m, model_name, model_info, model_concurrency
+
+    model_entries = [model_entry(x) for x in models_to_test]
+
+    def example_prompts(d, a, eidx, example):
+        """The prompt of every question of an example (built once, whatever the number of models)."""
+        if prompt_store is not None:
+            example_id = datasets[d['name']].example_id(eidx)
+            return [prompt_store.get(d, a, example_id, qidx) for qidx in range(len(example['questions']))]
+        return [build_prompt(example['context'], question, d, a) for question in example['questions']]
+
+    def plan_example(entry, d, a, eidx, example, prompts):
+        m, model_name, model_info, model_concurrency = entry
+        planned_questions = []
+        for qidx, (question, prompt) in enumerate(zip(example['questions'], prompts)):
+            gold_answer = question["answer"] + d.get('answer_index_modifier', 1)
+            qhash = question['intermediate_data'][0]['story_hash_id']
+
+            # The first wave is submitted here, later ones (adaptive self-consistency) while scoring.
+            samples = SampleWaves(
+                partial(submit_sample, m, model_name, model_info, model_concurrency, d, a, eidx, qidx, question, prompt, gold_answer, qhash),
+                n=a.get('self_consistency_n', 1) if prompt is not None else 0,
+                wave_size=a.get('self_consistency_wave'),
+                confidence=a.get('self_consistency_confidence')
+            )
+
+            planned_questions.append((qidx, question, samples))
+        return planned_questions
+
+    def plan():
+        """Yields, per example, the planned questions of every model it is dispatched to (in model_entries order)."""
+        if fan_out:
+            for d in datasets_to_test:
+                for a in ablations:
+                    for eidx, example in enumerate(datasets[d['name']]):
+                        prompts = example_prompts(d, a, eidx, example)
+                        yield [plan_example(entry, d, a, eidx, example, prompts) for entry in model_entries]
+        else:
+            for entry in model_entries:
+                for d in datasets_to_test:
+                    for a in ablations:
+                        for eidx, example in enumerate(datasets[d['name']]):
+                            yield [plan_example(entry, d, a, eidx, example, example_prompts(d, a, eidx, example))]
+
+    planned_examples = runner.prefetch(plan(), max_pending=max_pending)
+
+    def score_example(entry, d, a, eidx, planned_questions, scores):
+        """Score the answers of one example for one model into scores (see new_scores())."""
+        m, model_name, _, _ = entry
+
+        answered_questions = []
+
+        for qidx, question, samples in planned_questions:
+
+            answer_outs = []
+            raw_answers = []
+            choices = format_choices(question)
+            gold_answer = question["answer"] + d.get('answer_index_modifier', 1)
+            qhash = question['intermediate_data'][0]['story_hash_id']
+
+            for scidx, prompt, future in samples:
+                output = future.result()
+
+                if verbose:
+                    print("MODEL OUTPUT")
+                    print(output)
+
+                extracted = extract_answer(output, question["choices"])
+                answer = str(extracted.choice) if extracted.choice is not None else ''
+
+                randomly_selected = False
+                if extracted.choice is None:
+                    answer = random.sample([str(x+1) for x in range(len(question["choices"]))], 1)[0]
+                    randomly_selected = True
+
+                if answer == str(gold_answer):
+                    answer_outs.append(str(gold_answer))
+                    raw_answers.append({
+                        'qidx': qidx,
+                        'qhash': qhash,
+                        'prompt': prompt,
+                        'output': output,
+                        'model_parsed_answer': answer,
+                        'trees': question['intermediate_trees'] if save_trees else None,
+                        'data': question['intermediate_data'],
+                        'randomly_selected': randomly_selected,
+                        'answer_status': extracted.status.value,
+                        'gold_answer': gold_answer,
+                        'correct': True
+                    })
+                elif answer in [str(x+1) for x in range(len(question["choices"]))]:
+                    answer_outs.append(answer)
+                    raw_answers.append({
+                        'qidx': qidx,
+                        'qhash': qhash,
+                        'prompt': prompt,
+                        'output': output,
+                        'model_parsed_answer': answer,
+                        'trees': question['intermediate_trees'] if save_trees else None,
+                        'data': question['intermediate_data'],
+                        'randomly_selected': randomly_selected,
+                        'answer_status': extracted.status.value,
+                        'gold_answer': gold_answer,
+                        'correct': False
+                    })
+                else:
+                    raise Exception("ERROR: SHOULDN'T HIT")
+
+                answer_log.write({
+                    'model': model_name,
+                    'dataset': d['name'],
+                    'ablation': a['name'],
+                    'eidx': eidx,
+                    'sample_idx': scidx,
+                    'prompt_hash': prompt_hash(prompt),
+                    'vote': answer_outs[-1],
+                    **raw_answers[-1]
+                })
+                samples.vote(answer_outs[-1])
+
+            if len(answer_outs) == 0:
+                continue
+            scores['samples_used'].append(samples.used)
+
+            most_common = collections.Counter(answer_outs).most_common()[0][0]
+            if most_common == str(gold_answer):
+                scores['correct'] += 1
+                answered_questions.append([x for x in raw_answers if x['correct']][0])
+            elif most_common is None:
+                scores['correct'] += 1 / len(choices)
+                answered_questions.append([x for x in raw_answers if x['model_parsed_answer'] is None])
+            else:
+                answered_questions.append([x for x in raw_answers if not x['correct'] and x['model_parsed_answer'] is not None])
+
+            scores['total'] += 1
+
+        scores['examples'].append(answered_questions)
+
+    def new_scores():
+        return {'correct': 0, 'total': 0, 'examples': [], 'samples_used': [], 'cost': 0.0}
+
+    def describe(entries, d, a, scores):
+        return f'RUNNING | {d["name"]} | {a["name"]} | ' + ' | '.join([f'{name}: {scores[name]["correct"]} / {scores[name]["total"]}' for _, name, _, _ in entries]) + f' | (run cost = {run_cost:.2f})'
+
+    def finish_ablation(entry, d, a, scores):
+        nonlocal run_cost
+        m, model_name, _, _ = entry
+
+        # Calls of other ablations may be running at the same time, so this is what the model spent while this
+        # ablation was being scored (the run cost is exact).
+        if isinstance(m, OpenAIModel):
+            scores['cost'] += m.total_cost
+            run_cost += m.total_cost
+
+            m.total_cost = 0.0
+
+        correct, total, samples_used = scores['correct'], scores['total'], scores['samples_used']
+
+        model_data = run_data.get(f'{model_name}', {})
+        dataset_data = model_data.get(d["name"], {})
+        ablation_data = dataset_data.get(a["name"], {})
+        ablation_data["examples"] = scores['examples']
+        ablation_data["correct"] = correct
+        ablation_data["total"] = total
+        ablation_data["samples_used"] = samples_used
+        dataset_data[a["name"]] = ablation_data
+        model_data[d.get('name')] = dataset_data
+        run_data[model_name] = model_data
+
+        print(f'RUNNING | {model_name} | {d["name"]} | {a["name"]} | {correct} / {total} | {(correct / max(1,total))*100:.1f}', flush=True)
+        if a.get('self_consistency_n', 1) > 1:
+            print(f'SAMPLES USED | {sum(samples_used)} of {a["self_consistency_n"] * len(samples_used)} | {sum(samples_used) / max(1, len(samples_used)):.2f} per question', flush=True)
+
+        out_file = f'{DISTILL_FOLDER}/{d.get("file_name", d.get("name", None))}'
+        if out_file and save_run_data:
+            with open(out_file, "w") as f:
+                json.dump(run_data, f)
+                # json.dump(run_data, out_file.open('w'))
+
+    # Fan out scores every model on an example before moving to the next example, otherwise a model goes through every
+    # dataset and ablation before the next model starts.  (The random fallback for unparsable answers draws in scoring
+    # order, so the two modes can pick different fallbacks.)
+    model_groups = [model_entries] if fan_out else [[x] for x in model_entries]
+    for entries in model_groups:
         for d in datasets_to_test:
+            dataset = datasets[d['name']]
 
             for a in ablations:
-                total_cost = 0.0
-                if isinstance(m, OpenAIModel):
-                    m.total_cost = 0.0
+                scores = {name: new_scores() for _, name, _, _ in entries}
 
-                ablation_name = a['name']
+                pbar = tqdm(range(len(dataset)), total=len(dataset), desc=describe(entries, d, a, scores), disable=not progress_bar)
 
-                total = 0
-                correct = 0
+                for eidx in pbar:
+                    for entry, planned_questions in zip(entries, next(planned_examples)):
+                        score_example(entry, d, a, eidx, planned_questions, scores[entry[1]])
 
-                answered_examples = []
+                    pbar.set_description(describe(entries, d, a, scores))
+                    pbar.set_postfix_str(f'{runner.throughput():.1f} calls/min, {runner.pending} pending')
 
-                self_consistency_n = a.get('self_consistency_n', 1)
+                for entry in entries:
+                    finish_ablation(entry, d, a, scores[entry[1]])
 
-                if datasets.get(d["name"]):
-                    dataset = datasets.get(d['name'])
-                else:
-                    _dataset = json.load((DATASETS_FOLDER / d.get("file_name", d.get('name', None))).open('r'))
-                    if randomize:
-                        random.shuffle(_dataset)
-
-                    dataset = []
-                    hashes_done = []
-                    for _d in _dataset:
-                        if exclude_contrastive_examples and _d['questions'][0].get('intermediate_data') and len(
-                                _d['questions'][0].get('intermediate_data')) > 0 and \
-                                _d['questions'][0]['intermediate_data'][0].get('story_hash_id'):
-                            if _d['questions'][0]['intermediate_data'][0]['story_hash_id'] in hashes_done:
-                                if reverse_contrastive_sample:
-                                    dataset.append(_d)
-                                else:
-                                    continue
-                            elif not reverse_contrastive_sample:
-                                dataset.append(_d)
-                            hashes_done.append(_d['questions'][0]['intermediate_data'][0]['story_hash_id'])
-                        else:
-                            dataset.append(_d)
-
-                    dataset = dataset[offset:offset+min(len(dataset), sample_size) if sample_size else sample_size]
-
-                    datasets[d['name']] = dataset
-
-                pbar = tqdm(enumerate(dataset), total=len(dataset), desc=f'RUNNING | {model_name} | {d["name"]} | {ablation_name} | {correct} / {total} | (run cost = {run_cost:.2f}, iteration cost = {total_cost:.2f})', disable=not progress_bar)
-
-                for eidx, example in pbar:
-
-                    answered_questions = []
-
-                    context = example['context']
-                    questions = example['questions']
-
-                    for qidx, question in enumerate(questions):
-
-                        answer_outs = []
-                        raw_answers = []
-                        choices = "\n".join([f'{idx + 1} - {x}' for idx, x in enumerate(question["choices"])])
-                        gold_answer = question["answer"] + d.get('answer_index_modifier', 1)
-                        qhash = question['intermediate_data'][0]['story_hash_id']
-
-                        for scidx in range(self_consistency_n):
-
-                            ex_str = ''
-                            if a.get('use_example') and d.get('ex'):
-                                ex_str = 'Here is an example of solving the task:\n\n' + d.get('ex') + '\n\nThis is the end of the example. The real task is below.\n\n---\n\n'
-
-                            prompt_style = a.get('prompt')
-                            if prompt_style == 'regular':
-                                prompt = f'{ex_str}{context}\n\n{question["question"]}\n\nPick one of the following choices:\n{choices}\n\nYou must pick one option. Finally, the last thing you generate should be "ANSWER: (your answer here, include the choice number)"'
-                            elif prompt_style == 'cot':
-                                prompt = f'{ex_str}{context}\n\n{question["question"]}\n\nPick one of the following choices:\n{choices}\n\nYou must pick one option. Explain your reasoning step by step before you answer. Finally, the last thing you generate should be "ANSWER: (your answer here, include the choice number)"'
-                            elif prompt_style == 'cot+':
-                                if a.get("hint_before_question"):
-                                    prompt = f'{ex_str}{context}\n\n{d["hint"]}\n\n{question["question"]}\n\nPick one of the following choices:\n{choices}\n\nYou must pick one option. Explain your reasoning step by step before you answer. Finally, the last thing you generate should be "ANSWER: (your answer here, including the choice number)"'
-                                else:
-                                    prompt = f'{ex_str}{context}\n\n{question["question"]}\n\nPick one of the following choices:\n{choices}\n\nYou must pick one option. {d["hint"]} Explain your reasoning step by step before you answer. Finally, the last thing you generate should be "ANSWER: (your answer here, including the choice number)"'
-                            # elif prompt_style == 'phi-4':
-                            #     phi_prompt = "You are Phi, a language model trained by Microsoft to help users. Your role as an assistant involves thoroughly exploring questions through a systematic thinking process before providing the final precise and accurate solutions. This requires engaging in a comprehensive cycle of analysis, summarizing, exploration, reassessment, reflection, backtracing, and iteration to develop well-considered thinking process. Please structure your response into two main sections: Thought and Solution using the specified format: <think> {Thought section} </think> {Solution section}. In the Thought section, detail your reasoning process in steps. Each step should include detailed considerations such as analysing questions, summarizing relevant findings, brainstorming new ideas, verifying the accuracy of the current steps, refining any errors, and revisiting previous steps. In the Solution section, based on various attempts, explorations, and reflections from the Thought section, systematically present the final solution that you deem correct. The Solution section should be logical, accurate, and concise and detail necessary steps needed to reach the conclusion. Now, try to solve the following question through the above guidelines:"
-                            #     prompt = f'{phi_prompt }\n{ex_str}{context}\n\n{question["question"]}\n\nPick one of the following choices:\n{choices}\n\nYou must pick one option.'
-                            else:
-                                if len(question["intermediate_trees"]) == 0 or d.get('skip_ablated'):
-                                    continue
-
-                                prompt = f'{ex_str}Answer the following questions given the list of facts per answer choice.\n\n'
-                                for c, t in zip(choices.split('\n'), question['intermediate_trees']):
-                                    facts = list(set([x.value for x in LogicTree.from_json(t).get_facts(include_cs=a.get('include_cs', False), include_deductions_past_level=-1, no_facts_after_depth=a.get('no_facts_after_depth', 3) + d.get('ablation_depth_modifier', 0))]))
-                                    facts = list(sorted(facts)) if d.get('allow_sorted_facts', True) else facts
-                                    facts_str = "\n".join([f'- {x}' for x in facts])
-                                    prompt += f'Facts for Choice {c}:\n{facts_str}\n\n'
-                                prompt += f'Given the list of facts per answer choice answer the following question\n\n{question["question"]}\n\nPick one of the following choices:\n{choices}\n\nYou must pick on option.  After you have found the answer, say it in this format "ANSWER: (your answer here, include the choice number)"'
-
-                            if verbose:
-                                print(f'EX: {eidx +1}.{qidx +1}')
-
-                                if human_verbose:
-                                    print(prompt.replace(' Explain your reasoning step by step before you answer.', ''))
-                                else:
-                                    print(prompt)
-                            if log_gold_answer:
-                                print(gold_answer)
-                            if log_tree:
-                                for i in question['intermediate_trees']:
-                                    print(LogicTree.from_json(i).print_for_gpt(pad_space=1, pad_char='> '))
-                            if skip_inference:
-                                continue
-
-                            if isinstance(m, OpenAIModel):
-                                raw = m.inference(prompt, system_prompt=d.get("system_prompt"))
-                                output = raw.choices[0]['message']['content']
-                            elif isinstance(m, RitsModel):
-                                raw = m.inference(prompt, system_prompt=d.get("system_prompt"))
-                                output = raw.choices[0].message.content
-                            else:
-                                # Boaz - I am using the original system prompt. My model_info.get("system_prompt_template") is empty
-                                if d.get("system_prompt") and model_info.get("system_prompt_template"):
-                                    prompt = model_info.get("system_prompt_template").replace("{system_prompt}", d.get('system_prompt')).replace("{prompt}", prompt)
-                                output = m.inference(prompt)
-
-                            if verbose:
-                                print("MODEL OUTPUT")
-                                print(output)
-
-                            try:
-                                lines = [x.split('answer:')[-1].strip() for x in output.lower().split('\n') if 'answer:' in x and len(x.split('answer:')[-1].strip())>0]
-                                answer = lines[-1]
-                            except Exception as e:
-                                answer = ''
-
-                            randomly_selected = False
-                            if not any([str(x+1) in answer for x in range(len(question["choices"]))]):
-                                answer = random.sample([str(x+1) for x in range(len(question["choices"]))], 1)[0]
-                                randomly_selected = True
-
-                            if str(gold_answer) in answer:
-                                answer_outs.append(str(gold_answer))
-                                raw_answers.append({
-                                    'qidx': qidx,
-                                    'qhash': qhash,
-                                    'prompt': prompt,
-                                    'output': output,
-                                    'model_parsed_answer': answer,
-                                    'trees': question['intermediate_trees'],
-                                    'data': question['intermediate_data'],
-                                    'randomly_selected': randomly_selected,
-                                    'gold_answer': gold_answer,
-                                    'correct': True
-                                })
-                            elif any([str(x+1) in answer for x in range(len(question["choices"]))]):
-                                answer_outs.append([str(x+1) for x in range(len(question["choices"])) if str(x+1) in answer][0])
-                                raw_answers.append({
-                                    'qidx': qidx,
-                                    'qhash': qhash,
-                                    'prompt': prompt,
-                                    'output': output,
-                                    'model_parsed_answer': answer,
-                                    'trees': question['intermediate_trees'],
-                                    'data': question['intermediate_data'],
-                                    'randomly_selected': randomly_selected,
-                                    'gold_answer': gold_answer,
-                                    'correct': False
-                                })
-                            else:
-                                raise Exception("ERROR: SHOULDN'T HIT")
-
-                            if isinstance(m, OpenAIModel):
-                                total_cost += m.total_cost
-                                run_cost += m.total_cost
-
-                                m.total_cost = 0.0
-
-                        if len(answer_outs) == 0:
-                            continue
-
-                        most_common = collections.Counter(answer_outs).most_common()[0][0]
-                        if most_common == str(gold_answer):
-                            correct += 1
-                            answered_questions.append([x for x in raw_answers if x['correct']][0])
-                        elif most_common is None:
-                            correct += 1 / len(choices)
-                            answered_questions.append([x for x in raw_answers if x['model_parsed_answer'] is None])
-                        else:
-                            answered_questions.append([x for x in raw_answers if not x['correct'] and x['model_parsed_answer'] is not None])
-
-                        total += 1
-
-                        pbar.set_description(f'RUNNING | {model_name} | {d["name"]} | {ablation_name} | {correct} / {total} | (run cost = {run_cost:.2f}, iteration cost = {total_cost:.2f})')
-
-                    answered_examples.append(answered_questions)
-
-                model_data = run_data.get(f'{model_name}', {})
-                dataset_data = model_data.get(d["name"], {})
-                ablation_data = dataset_data.get(a["name"], {})
-                ablation_data["examples"] = answered_examples
-                ablation_data["correct"] = correct
-                ablation_data["total"] = total
-                dataset_data[a["name"]] = ablation_data
-                model_data[d.get('name')] = dataset_data
-                run_data[model_name] = model_data
-
-                print(f'RUNNING | {model_name} | {d["name"]} | {ablation_name} | {correct} / {total} | {(correct / max(1,total))*100:.1f}', flush=True)
-
-                out_file = f'{DISTILL_FOLDER}/{d.get("file_name", d.get("name", None))}'
-                if out_file:
-                    with open(out_file, "w") as f:
-                        json.dump(run_data, f, indent=2)
-                        # json.dump(run_data, out_file.open('w'))
+        for m, _, _, _ in entries:
+            if isinstance(m, HFModel):
+                runner.close(m)
+                m.unload_model()
 
-        if isinstance(m, HFModel):
-            del m
+    runner.close()
+    answer_log.close()
+    if prompt_store is not None:
+        prompt_store.close()
+    for dataset in datasets.values():
+        dataset.close()
 
 if __name__ == "__main__":
     main()
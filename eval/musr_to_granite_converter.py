@@ -1,96 +1,267 @@
+"""
+RUN THIS FILE TO CONVERT EVAL OUTPUTS (distill json or answer logs) INTO GRANITE LONG COT TRAINING DATA.
+
+The input is never loaded as a whole: the distill json is scanned for the examples of the selected
+model / dataset / prompt_type entries (see src/utils/json_stream.py), an answer log (.answers.jsonl) is read line by
+line.  Records are built in batches by a pool of worker processes and written as they come, in input order, into
+size-bounded jsonl shards next to a manifest.  Answers whose qhash was already written for the same selection are
+dropped, the set of written qhashes lives in a small sqlite file instead of memory.
+
+Usage:
+
+    python musr_to_granite_converter.py {input_file} [--select "model|dataset|prompt_type" ...] [--correct-only]
+        [--parsed-only] [--keep-duplicates] [--no-chat-format] [--max-shard-mb 256] [--workers 4]
+
+{input_file} is a path or a file name in DISTILL_FOLDER.  Without --select, the default selection below is used.
+With --parsed-only, the answer of every output is extracted again (see src/evaluation/answer_extraction.py) and
+outputs that do not clearly pick one choice (no answer, ambiguous, truncated) are dropped; "correct" (and
+--correct-only) then use the extracted choice, so answers the eval only got right through its random fallback are not
+kept as correct.
+
+Output goes to "{GRANITE_LCOT_FOLDER}/{input_name}-00000.jsonl", ... and "{GRANITE_LCOT_FOLDER}/{input_name}.manifest.json".
+"""
+
 # Standard
-import csv
+import argparse
+import itertools
 import json
-import sys
+import sqlite3
 import uuid
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
-# Third Party
-import jsonlines
-
+from src.evaluation.answer_extraction import AnswerStatus, choices_from_prompt, extract_answer
+from src.utils.json_stream import open_json_buffer, iter_value_spans
 from src.utils.paths import DISTILL_FOLDER, GRANITE_LCOT_FOLDER
 
+DEFAULT_SELECTION = ("microsoft/phi-4", "murder mysteries", "Phi-4-reasoning-plus")
+# DEFAULT_SELECTION = ("microsoft/phi-4", "murder mysteries", "cot+")
+# DEFAULT_SELECTION = ("microsoft/phi-4", "murder mysteries", "cot+ s.c. 1-shot")
 
-def read_input_to_dict(input_file, skip_header=False, fieldnames=()):
-    if input_file.endswith('jsonl'):
-        with jsonlines.open(input_file, 'r') as f:
-            input_data = [line for line in f]
-    elif input_file.endswith('json'):
-        with open(input_file, 'r') as f:
-            input_data = json.load(f)
-    elif input_file.endswith('csv'):
-        csvfile = open(input_file, 'r')
-        reader = csv.DictReader(csvfile, fieldnames)
-        if skip_header:
-            next(reader)
-        input_data = [line for line in reader]
-    elif input_file.endswith('txt'):
-        with open(input_file, 'r') as f:
-            input_data = f.readlines()
-    else:
-        assert False, f'Unknown input file format {input_file}. File needs to end with either csv, json or jsonl.'
-    print(f'Read {len(input_data)} samples from {input_file}')
-    return input_data
+Selection = Tuple[str, str, str]
 
-def main():
 
-    input_file_name = sys.argv[1]
-    assert input_file_name.endswith("json"), f"Please provide a json input file. Got {input_file_name}"
-    correct_only = False
-    chat_format = True
+def iter_examples(input_file: Path, selections: List[Selection]) -> Iterator[Tuple[Selection, bytes]]:
+    """
+    Yield the raw (unparsed) answered examples of the selections, in file order.
 
-    model = "microsoft/phi-4"
-    dataset = "murder mysteries"
-    # prompt_type = "cot+"
-    # prompt_type = "cot+ s.c. 1-shot"
-    prompt_type = "Phi-4-reasoning-plus"
+    For a distill json (run_data) an example is one entry of run_data[model][dataset][prompt_type]["examples"].  For an
+    answer log every logged sample is its own example.
+    """
+    if input_file.name.endswith('.jsonl'):
+        wanted = set(selections)
+        with input_file.open('rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A log of a run that crashed can end in a partial line.
+                    continue
+                selection = (record['model'], record['dataset'], record['ablation'])
+                if selection in wanted:
+                    yield selection, line
+        return
 
-    input_file = f'{DISTILL_FOLDER}/{input_file_name}'
-    # Output file is jsonl format
-    output_file = f'{GRANITE_LCOT_FOLDER}/{input_file_name}l'
+    key_paths = [(*selection, 'examples', '*') for selection in selections]
+    with open_json_buffer(input_file) as buffer:
+        for path, start, end in iter_value_spans(buffer, key_paths):
+            yield path[:3], buffer[start:end]
 
-    input_data = read_input_to_dict(input_file)
-    output_data = []
 
+def build_record(job: Tuple[Selection, bytes, bool, bool, bool]) -> Optional[Tuple[str, str]]:
+    """
+    Turn one answered example into a granite record (runs in the worker processes).
 
-    examples = input_data[model][dataset][prompt_type]["examples"]
-    for d_ins in examples:
+    :return: (qhash, jsonl line) or None if the example is filtered out.
+    """
+    (model, dataset, prompt_type), raw, chat_format, correct_only, parsed_only = job
+
+    d_ins = json.loads(raw)
+    if isinstance(d_ins, dict):
+        d_in = d_ins
+    else:
         assert len(d_ins) == 1, f'Several answers is not yet supported'
         d_in = d_ins[0]
         if isinstance(list(), type(d_in)): d_in = d_in[0]
-        if chat_format:
-            content = {"messages":
-                [
-                    {"role": "user", "content": d_in["prompt"]},
-                    {
-                        "role": "assistant",
-                        "content": d_in["output"],
-                    },
-                ]
-            }
-        else:
-            content = {
-                "problem": d_in["prompt"],
-                "response": d_in["output"]
-            }
-
-        d_out = {
-            "id": str(uuid.uuid4()),
-            "qidx": d_in["qidx"],
-            "qhash": d_in["qhash"],
-            "source": f'{model}_{dataset}_{prompt_type}',
-            "solution": "",
-            **content,
-            "ground_truth": d_in["gold_answer"],
-            "correct": d_in["correct"],
+
+    correct = bool(d_in["correct"])
+    if parsed_only:
+        extracted = extract_answer(d_in["output"], choices_from_prompt(d_in["prompt"]))
+        if extracted.status != AnswerStatus.OK:
+            return None
+        correct = extracted.choice == int(d_in["gold_answer"])
+
+    if correct_only and not correct:
+        return None
+
+    if chat_format:
+        content = {"messages":
+            [
+                {"role": "user", "content": d_in["prompt"]},
+                {
+                    "role": "assistant",
+                    "content": d_in["output"],
+                },
+            ]
+        }
+    else:
+        content = {
+            "problem": d_in["prompt"],
+            "response": d_in["output"]
         }
-        if correct_only and not bool(d_in["correct"]): continue
-        output_data.append(d_out)
-
-    jsonfile = jsonlines.open(output_file, "w")
-    for d in output_data:
-        jsonfile.write(d)
-    # jsonfile.write(psg_url_mapping)
-    print(f"Wrote {len(output_data)} records to {output_file}")
+
+    d_out = {
+        "id": str(uuid.uuid4()),
+        "qidx": d_in["qidx"],
+        "qhash": d_in["qhash"],
+        "source": f'{model}_{dataset}_{prompt_type}',
+        "solution": "",
+        **content,
+        "ground_truth": d_in["gold_answer"],
+        "correct": correct if parsed_only else d_in["correct"],
+    }
+    # Same formatting as jsonlines.Writer
+    return str(d_in["qhash"]), json.dumps(d_out, ensure_ascii=False) + '\n'
+
+
+class SeenSet:
+    """An on-disk set of (source, qhash) pairs."""
+
+    def __init__(self, file: Path):
+        file.unlink(missing_ok=True)
+        self.connection = sqlite3.connect(str(file))
+        self.connection.execute('CREATE TABLE seen (source TEXT, qhash TEXT, PRIMARY KEY (source, qhash)) WITHOUT ROWID')
+
+    def add(self, source: str, qhash: str) -> bool:
+        """Add the pair, returns False if it was already in the set."""
+        cursor = self.connection.execute('INSERT OR IGNORE INTO seen VALUES (?, ?)', (source, qhash))
+        return cursor.rowcount == 1
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+class ShardWriter:
+    """Writes jsonl lines into files of at most max_bytes (a single larger line gets a shard of its own)."""
+
+    def __init__(self, out_folder: Path, name: str, max_bytes: int):
+        self.out_folder = out_folder
+        self.name = name
+        self.max_bytes = max_bytes
+
+        self.shards: List[Dict[str, Any]] = []
+        self.__handle__ = None
+
+    def write(self, line: str):
+        data = line.encode('utf-8')
+        if self.__handle__ is None or (self.shards[-1]['bytes'] > 0 and self.shards[-1]['bytes'] + len(data) > self.max_bytes):
+            self.__open_next__()
+        self.__handle__.write(data)
+        self.shards[-1]['bytes'] += len(data)
+        self.shards[-1]['records'] += 1
+
+    def __open_next__(self):
+        if self.__handle__ is not None:
+            self.__handle__.close()
+        file_name = f'{self.name}-{len(self.shards):05d}.jsonl'
+        self.__handle__ = (self.out_folder / file_name).open('wb')
+        self.shards.append({'file': file_name, 'records': 0, 'bytes': 0})
+
+    def close(self):
+        if self.__handle__ is not None:
+            self.__handle__.close()
+
+
+def parse_selection(text: str) -> Selection:
+    parts = text.split('|')
+    assert len(parts) == 3, f'A selection is "model|dataset|prompt_type", got {text}'
+    return parts[0], parts[1], parts[2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert eval outputs into granite long cot jsonl shards.')
+    parser.add_argument('input_file', type=str, help='Distill json or answer log (.answers.jsonl), path or name in DISTILL_FOLDER.')
+    parser.add_argument('--select', type=parse_selection, action='append', default=None, help='"model|dataset|prompt_type", can be repeated.')
+    parser.add_argument('--correct-only', action='store_true', help='Only keep answers the model got right.')
+    parser.add_argument('--parsed-only', action='store_true', help='Drop outputs whose answer can not be extracted (see above).')
+    parser.add_argument('--keep-duplicates', action='store_true', help='Do not drop answers whose qhash was already written.')
+    parser.add_argument('--no-chat-format', action='store_true', help='Write problem/response instead of chat messages.')
+    parser.add_argument('--max-shard-mb', type=float, default=256, help='Maximum size of an output shard.')
+    parser.add_argument('--workers', type=int, default=4, help='Processes building records (0 builds them in this process).')
+    parser.add_argument('--batch-size', type=int, default=256, help='Examples handed to the workers at a time.')
+    parser.add_argument('--out-dir', type=Path, default=GRANITE_LCOT_FOLDER)
+    args = parser.parse_args()
+
+    input_file = Path(args.input_file)
+    if not input_file.exists():
+        input_file = Path(f'{DISTILL_FOLDER}/{args.input_file}')
+    assert input_file.name.endswith('.json') or input_file.name.endswith('.jsonl'), f"Please provide a json or jsonl input file. Got {input_file}"
+
+    selections = args.select or [DEFAULT_SELECTION]
+    chat_format = not args.no_chat_format
+
+    name = input_file.name.replace('.answers.jsonl', '').replace('.jsonl', '').replace('.json', '')
+    args.out_dir.mkdir(exist_ok=True, parents=True)
+    # Shards of an earlier conversion of the same input would otherwise be mixed in with the new ones.
+    for stale in args.out_dir.glob(f'{name}-[0-9][0-9][0-9][0-9][0-9].jsonl'):
+        stale.unlink()
+
+    writer = ShardWriter(args.out_dir, name, int(args.max_shard_mb * 1024 * 1024))
+    seen = SeenSet(args.out_dir / f'.{name}.seen.sqlite')
+    pool = Pool(args.workers) if args.workers > 0 else None
+
+    counts = {f'{m}_{d}_{p}': {'read': 0, 'written': 0, 'filtered': 0, 'duplicates': 0} for m, d, p in selections}
+
+    jobs = ((selection, raw, chat_format, args.correct_only, args.parsed_only) for selection, raw in iter_examples(input_file, selections))
+    while True:
+        # Batches keep memory bounded (Pool.imap would read the whole input ahead of the writer).
+        batch = list(itertools.islice(jobs, args.batch_size))
+        if len(batch) == 0:
+            break
+
+        records = pool.map(build_record, batch) if pool is not None else [build_record(x) for x in batch]
+        for (selection, _, _, _, _), record in zip(batch, records):
+            source = '_'.join(selection)
+            counts[source]['read'] += 1
+            if record is None:
+                counts[source]['filtered'] += 1
+                continue
+
+            qhash, line = record
+            if not args.keep_duplicates and not seen.add(source, qhash):
+                counts[source]['duplicates'] += 1
+                continue
+
+            writer.write(line)
+            counts[source]['written'] += 1
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    writer.close()
+    seen.close()
+    (args.out_dir / f'.{name}.seen.sqlite').unlink()
+
+    manifest = {
+        'input_file': str(input_file),
+        'selections': [list(x) for x in selections],
+        'chat_format': chat_format,
+        'correct_only': args.correct_only,
+        'parsed_only': args.parsed_only,
+        'max_shard_bytes': writer.max_bytes,
+        'shards': writer.shards,
+        'counts': counts,
+    }
+    with (args.out_dir / f'{name}.manifest.json').open('w') as f:
+        json.dump(manifest, f, indent=2)
+
+    for source, c in counts.items():
+        print(f'{source}: read {c["read"]}, wrote {c["written"]} ({c["filtered"]} filtered, {c["duplicates"]} duplicate qhashes)')
+    print(f"Wrote {sum([x['records'] for x in writer.shards])} records to {len(writer.shards)} shard(s) in {args.out_dir}")
 
 
 if __name__ == "__main__":
@@ -22,6 +22,7 @@ from src.model import OpenAIModel
 from src.logic_tree.tree import LogicTree, LogicNode, LogicNodeFactType
 from src.madlib.madlib import Madlib
 from src.utils.paths import OUTPUT_FOLDER, ROOT_FOLDER
+from src.utils.hashing import story_hash_id
 
 from src.dataset_types.murder_mystery_dataset import MurderMysteryDataset
 
@@ -276,7 +277,7 @@ def main():
                     answers=[murderer_idx],
                     choices=[choices],
                     intermediate_trees=[[x['used_tree'] for x in _suspect_trees]],
-                    intermediate_data=[[{'suspect_info': safe_suspects_dict, 'victim_info': victim_dict, 'story_hash_id': hash(intro)}]]
+                    intermediate_data=[[{'suspect_info': safe_suspects_dict, 'victim_info': victim_dict, 'story_hash_id': story_hash_id(intro)}]]
                 )
             )
 
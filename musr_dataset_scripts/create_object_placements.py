@@ -249,7 +249,6 @@ Output:
         people = []
         people_data = []
         moves = []
-        move_strs = []
         locations = []
         world_state = []
 
@@ -292,9 +291,6 @@ Reason - She noticed the milk was left out for too long and put it back before i
                 if move_data['item'] not in [x[0] for x in world_state]:
                     world_state.append([move_data['item'], move_data['from']])
 
-                move_str = f'{move_data["mover"]} moves {respect_article(move_data["item"], people)} to {respect_article(move_data["to"], people)}.'
-                move_strs.append(move_str)
-
             people = list(sorted(set(people)))
             items = list(sorted(set(items)))
             locations = list(sorted(set(locations)))
@@ -311,29 +307,12 @@ Reason - She noticed the milk was left out for too long and put it back before i
                 print("ERROR: YOU CAN'T MENTION AN ITEM IN THE JUSTIFICATION")
                 continue
 
-            # To check if the moves produced by the model are valid, we recreate them using our code.  This also gives
-            # us the belief states and observations of other people in the story.  This could be cleaner, but deadlines.
-            max_retries = 100_000
-            mri = 0
-            sampled = False
-            while mri < max_retries:
-                mri += 1
-                events, beliefs, actual_locs, event_structure = creator.create_sequence_v2(
-                    items, deepcopy(locations), people, max_sequence_length=max_sequence_len, chance_subject_sees=chance_to_see, initial_starting_positions=world_state
-                )
-
-                retry = False
-                for gidx, (gm, e) in enumerate(zip(move_strs, events[1:])):
-                    move = e[0]
-                    if move.lower() != gm.lower():
-                        retry = True
-                        break
-                if retry:
-                    continue
-                sampled = True
-                break
-            if not sampled:
-                raise Exception("Couldn't get a sample from the code that matched the gold move from GPT.")
+            # To check if the moves produced by the model are valid, we replay them with our code (it raises if a move is
+            # impossible).  This also samples who saw each move, giving us the belief states of other people in the story.
+            events, beliefs, actual_locs, event_structure = creator.create_sequence_from_moves(
+                [(x['mover'], x['item'], x['to']) for x in moves], items, deepcopy(locations), people,
+                max_sequence_length=max_sequence_len, chance_subject_sees=chance_to_see, initial_starting_positions=world_state
+            )
 
             question, answers = creator.generate_end_questions(
                 ending_beliefs=beliefs[-1], people=people, items=items, locations=locations, event_structure=deepcopy(event_structure)
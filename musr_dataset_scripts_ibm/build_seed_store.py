@@ -0,0 +1,36 @@
+"""
+RUN THIS FILE TO COMPILE A FOLDER OF DOMAIN SEED LISTS INTO A PACKED SEED STORE.
+
+Every "{name}.json" (a list of strings) in the folder becomes the key "{name}" of the store (see
+src/madlib/seed_store.py).  Dataset scripts load the store with mmap instead of parsing the json files in every process,
+and fall back to the json files when the store is missing or older than them, so rerun this after editing the seeds.
+
+Usage:
+
+    python build_seed_store.py [{seed_folder}] [{out_file}]
+
+By default this compiles DOMAIN_SEED_FOLDER into DOMAIN_SEED_STORE (see src/utils/paths.py).
+"""
+
+import sys
+from pathlib import Path
+
+from src.madlib.seed_store import build_seed_store
+from src.utils.paths import DOMAIN_SEED_FOLDER, DOMAIN_SEED_STORE
+
+
+def main():
+    seed_folder = Path(sys.argv[1]) if len(sys.argv) > 1 else DOMAIN_SEED_FOLDER
+    out_file = Path(sys.argv[2]) if len(sys.argv) > 2 else (DOMAIN_SEED_STORE if len(sys.argv) == 1 else seed_folder / DOMAIN_SEED_STORE.name)
+
+    seed_files = {x.stem: x for x in sorted(seed_folder.glob('*.json'))}
+    assert len(seed_files) > 0, f'No seed json files in {seed_folder}'
+
+    counts = build_seed_store(seed_files, out_file)
+    for key, count in counts.items():
+        print(f'{key}: {count}')
+    print(f'Wrote {sum(counts.values())} seeds ({out_file.stat().st_size} bytes) to {out_file}')
+
+
+if __name__ == "__main__":
+    main()
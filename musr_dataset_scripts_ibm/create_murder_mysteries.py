@@ -12,16 +12,22 @@ NOTE: By default, datasets go into "{ROOT_FOLDER}/datasets/{dataset_name}.json"
 import copy
 import json
 import sys
+from contextlib import contextmanager
 from datetime import time, datetime
 from pathlib import Path
 import random
-from src import cache
-from src.model import OpenAIModel, HFModel, RitsModel
+from typing import List, Dict, Any
+from src import cache, tracer
+from src.model import Model, OpenAIModel, HFModel, RitsModel
 from src.logic_tree.tree import LogicTree, LogicNode, LogicNodeFactType
 from src.madlib.madlib import Madlib
-from src.utils.paths import OUTPUT_FOLDER, DOMAIN_SEED_FOLDER
+from src.madlib.seed_store import SeedStore
+from src.utils.paths import OUTPUT_FOLDER, DOMAIN_SEED_FOLDER, DOMAIN_SEED_STORE
+from src.utils.sharding import SampleReservation
+from src.utils.hashing import story_hash_id
 
 from src.dataset_types.murder_mystery_dataset import MurderMysteryDataset
+from src.validators import FactPrecheck
 
 random.seed()
 
@@ -121,6 +127,239 @@ example_node_completions = [example1_node_completion, example2_node_completion,
 example_descriptions = [example1_description, example2_description, example3_description]
 
 
+SEED_FILES = {
+    "male_names": 'male_names.json',
+    "female_names": 'female_names.json',
+    "male_relationships": 'male_relationships.json',
+    "female_relationships": 'female_relationships.json',
+    "motives": 'strong_motives.json',
+    "murder_weapons": 'murder_weapons.json',
+    "relationships": 'relationships.json',
+    "crime_scenes": 'crime_scenes.json',
+    'red_herrings': 'suspicious_facts.json',
+}
+
+
+def load_madlib() -> Madlib:
+    """
+    The domain seed lists murder mysteries are sampled from.  Uses the packed seed store (see build_seed_store.py)
+    when there is an up to date one, the seed json files otherwise.
+    """
+    seed_files = {Path(v).stem: DOMAIN_SEED_FOLDER / v for v in SEED_FILES.values()}
+    if DOMAIN_SEED_STORE.exists():
+        store = SeedStore(DOMAIN_SEED_STORE)
+        if not store.is_stale(seed_files):
+            return Madlib.from_seed_store(store, {k: Path(v).stem for k, v in SEED_FILES.items()})
+
+    return Madlib({k: DOMAIN_SEED_FOLDER / v for k, v in SEED_FILES.items()})
+
+
+@contextmanager
+def traced_story(example_idx: int, trace_file: Path = None):
+    """
+    The 'story' span of a story.  When it is done, however it ends (a skipped story `continue`s out of it), its rollup
+    is printed and its spans are appended to trace_file.
+    """
+    try:
+        with tracer.span('story', idx=example_idx) as story_span:
+            yield story_span
+    finally:
+        if trace_file:
+            print('STORY TRACE: ' + ' | '.join([f'{k} {v:.4g}' for k, v in tracer.rollup(story_span).items()]))
+            tracer.flush(trace_file)
+
+
+def create_murder_mysteries(
+        creator: MurderMysteryDataset,
+        madlib: Madlib,
+        model_to_use: Model,
+        model_validator_model: Model,
+        model_validator_early_escape_model: Model,
+        max_examples: int,
+        out_file: Path = None,
+        dataset: List[Dict[str, Any]] = None,
+        previously_sampled_items: List[List[str]] = None,
+        reservation: SampleReservation = None,
+        tree_depth: int = 3,
+        max_number_of_suspects: int = 2,
+        max_structure_completion_retries: int = 3,
+        max_num_suspicious_facts: int = 1,
+        use_validators: bool = True,
+        cost_models: List[Model] = (),
+        max_concurrency: int = 4,
+        chapter_deadline: float = None,
+        use_fact_precheck: bool = False,
+        trace_file: Path = None
+) -> List[Dict[str, Any]]:
+    """
+    The creation loop for murder mysteries.  main() calls this once, the sharded driver
+    (create_sharded_dataset.py) calls it once per worker process.
+
+    :param creator: The dataset builder.
+    :param madlib: Madlib with the domain seeds (see load_madlib())
+    :param model_to_use: Model used for the deductions and the story.
+    :param model_validator_model: See MurderMysteryDataset.create_suspect_trees
+    :param model_validator_early_escape_model: See MurderMysteryDataset.create_suspect_trees
+    :param max_examples: How many stories to create (each story creates one example per suspect).
+    :param out_file: Where to save the dataset (saved after every example).
+    :param dataset: Examples we already have (we append to this).
+    :param previously_sampled_items: Victim samples we already used (see DatasetBuilder.sample_madlib)
+    :param reservation: Shared reservation so parallel workers never sample the same victim (see DatasetBuilder.sample_madlib)
+    :param cost_models: Models whose total_cost is tallied (and reset) per example.
+    :param max_concurrency: Max # of suspect trees / chapters being created at once for a story.
+    :param chapter_deadline: Seconds the chapters of a story may take (see MurderMysteryDataset.create_chapter), the
+        story is skipped if they take longer.
+    :param use_fact_precheck: Skip the LLM fact recall for facts that are clearly written into a chapter (see
+        src/validators/fact_precheck.py).  Off until measure_fact_precheck.py shows its precision is good enough.
+    :param trace_file: If given, the run is traced (see src/utils/tracing.py): the tokens / cost / llm calls of every
+        story (skipped ones too) are printed and its spans are appended to this file (Chrome trace, or jsonl for a .jsonl
+        file) once it is done.
+    """
+
+    if dataset is None:
+        dataset = []
+    if previously_sampled_items is None:
+        previously_sampled_items = []
+
+    total_cost = 0
+
+    if trace_file:
+        tracer.enable()
+
+    # CREATION LOGIC
+    for example_idx in range(max_examples):
+        with traced_story(example_idx, trace_file):
+            story_start_time = datetime.now()
+            print(f"STORY: {example_idx+1}")
+
+            # Setup Scenario (MadLib)
+            constant_sampled_items = [['male_names', 'female_names'], 'crime_scenes', 'murder_weapons']
+            constant_sampled_names = ['victim', 'crime_scene', 'murder_weapon']
+            variable_sampled_items = [['male_names,male_relationships', 'female_names,female_relationships'], 'motives', 'crime_scenes']
+            variable_sampled_names = ['suspect', 'role', 'motive', 'alibi']
+
+            description_string = "Victim: {victim}\nCrime Scene: {crime_scene}\nMurder Weapon: {murder_weapon}"
+            variable_string = 'Suspect: {suspect}\nRole in story: {role}\nThe suspect\'s motive: {motive}'
+
+            victim_string, victim_dict, sampled = creator.sample_madlib(madlib, constant_sampled_items, previously_sampled=previously_sampled_items, description_string_format=description_string, sampled_item_names=constant_sampled_names, reservation=reservation)
+            victim_dict = victim_dict[0]
+            previously_sampled_items = sampled
+
+            suspect_strings, suspect_dicts, _ = creator.sample_madlib(madlib, variable_sampled_items, previously_sampled=[[None,None,None,victim_dict['crime_scene']]], n_samples=max_number_of_suspects, description_string_format=variable_string, sampled_item_names=variable_sampled_names)
+
+            _, suspicious_fact_dicts, _ = creator.sample_madlib(madlib, ['red_herrings'], n_samples=max_num_suspicious_facts * len(suspect_dicts), description_string_format='{red_herrings}')
+            random.shuffle(suspicious_fact_dicts)
+            for s in suspect_dicts:
+                s['red_herrings'] = []
+                for n in range(max_num_suspicious_facts):
+                    s['red_herrings'].append(suspicious_fact_dicts.pop()['red_herrings'])
+
+            scenario = f'{victim_string[0]}\n'
+            d = f'{scenario}'.strip()
+            for idx, s in enumerate(suspect_strings):
+                suspect_dicts[idx]['description'] = f"{scenario}{s}".strip()
+                d += f"\n\n{s}\nRed herring: {suspect_dicts[idx]['red_herrings'][0]}"
+
+            # Victim dict should have the victim name, crime scene, and murder weapon (things specific to the victim)
+            # Suspect dicts should have the the name of the victim, their role in the story, their suspicious fact and motive.
+
+            stage_start_time = datetime.now()
+            suspect_trees = creator.create_suspect_trees(
+                model_to_use,
+                victim_dict,
+                suspect_dicts,
+                example_trees,
+                example_node_completions,
+                example_descriptions,
+                depth=tree_depth,
+                bf_factor={2: 1.0},
+                chance_to_prune=0.0,
+                chance_to_prune_all=0.0,
+                max_num_of_suspicious_facts=max_num_suspicious_facts,
+                max_retries_on_error=max_structure_completion_retries,
+                retry_model=model_to_use,
+                progress_bar=True,
+                use_validators=use_validators,
+                model_validator_model=model_validator_model,
+                model_validator_early_escape_model=model_validator_early_escape_model,
+                test_completion_prompt=False,
+                max_concurrency=max_concurrency
+            )
+            stage_times = {'suspect trees': (datetime.now() - stage_start_time).total_seconds()}
+
+            suspect_trees = creator.create_chapter_trees(suspect_trees, max_num_of_suspicious_facts=max_num_suspicious_facts)
+
+            stage_start_time = datetime.now()
+            chapter_timings = []
+            suspect_trees = creator.create_chapter(
+                model_to_use, suspect_trees, validate_model=model_to_use, max_concurrency=max_concurrency,
+                deadline=chapter_deadline, timings=chapter_timings, fact_precheck=FactPrecheck() if use_fact_precheck else None
+            )
+            stage_times['chapters'] = (datetime.now() - stage_start_time).total_seconds()
+
+            print('STAGE TIMES: ' + ' | '.join([f'{k} {v:.1f}s' for k, v in stage_times.items()]))
+            for t in sorted(chapter_timings, key=lambda x: -x['total']):
+                print(f"  {t['suspect']} ({t['chapter']}): {t['total']:.1f}s, draft {t['draft']:.1f}s, {len(t['validation_rounds'])} validation round(s) {sum(t['validation_rounds']):.1f}s{' (hit deadline)' if t['hit_deadline'] else ''}")
+            if suspect_trees is None:
+                print("Boaz Add - Bad suspect_trees. skip this one. I do not know how to delete from the redis cache")
+                continue
+
+            # Because we only created chapters of the murder, we need an introduction to it.  Here we create a prompt to do that.
+            sus_strings = ", ".join([x['suspect_info']['suspect'] for x in suspect_trees])
+            intro_prompt = f"Create an intro for this murder mystery.  It should only be 1 or 2 sentences.  Only write the intro nothing else. \n\nScenario:\n{victim_dict['victim']} was killed with a {victim_dict['murder_weapon']} at a {victim_dict['crime_scene']}. Detective Winston is on the case, interviewing suspects. The suspects are {sus_strings}.\n\nOutput:\n"
+            with tracer.span('intro'):
+                intro, _ = creator.inference(intro_prompt, model_to_use)
+
+            # Iterate through the suspects (the curr suspect is the murderer)
+            for sidx in range(len(suspect_trees)):
+                murderer_idx = sidx
+
+                _suspect_trees = copy.deepcopy(suspect_trees)
+
+                for sidx, s in enumerate(_suspect_trees):
+                    _suspect_trees[sidx]['used_chapter'] = _suspect_trees[sidx][
+                        'innocent_chapter' if sidx != murderer_idx else 'murderer_chapter']
+                    _suspect_trees[sidx]['used_tree'] = _suspect_trees[sidx][
+                        'innocent_tree' if sidx != murderer_idx else 'murderer_tree']
+                    _suspect_trees[sidx]['is_murderer'] = sidx == murderer_idx
+
+                chapters = [(x['suspect_info']['suspect'], x['used_chapter'].strip()) for x in _suspect_trees]
+                random.shuffle(chapters)
+
+                story = f"{intro}\n\n" + "\n\n".join([x[1] for x in chapters])
+
+                choices = [x['suspect_info']["suspect"] for x in _suspect_trees]
+
+                call_cost = sum([m.total_cost for m in cost_models])
+                total_cost += call_cost
+                print(f'EXAMPLE COST: {call_cost:.2f} | TOTAL COST SO FAR: {total_cost:.2f}')
+                for m in cost_models:
+                    m.total_cost = 0.0
+
+                safe_suspects_dict = [{k: v.to_json() if isinstance(v, LogicTree) else v for k, v in x.items()} for x in _suspect_trees]
+                dataset.append(
+                    creator.create_dataset_question_object(
+                        context=story,
+                        questions=['Who is the most likely murderer?'],
+                        answers=[murderer_idx],
+                        choices=[choices],
+                        intermediate_trees=[[x['used_tree'] for x in _suspect_trees]],
+                        intermediate_data=[[{'suspect_info': safe_suspects_dict, 'victim_info': victim_dict, 'story_hash_id': story_hash_id(intro)}]]
+                    )
+                )
+
+                if out_file:
+                    json.dump(dataset, out_file.open('w'))
+            print(f"GENERATION TIME for STORY {example_idx + 1}: {(datetime.now() - story_start_time) * 1000} secs")
+    if out_file:
+        json.dump(dataset, out_file.open('w'))
+    if trace_file:
+        tracer.flush(trace_file, last=True)
+
+    print(f"TOTAL COST: {total_cost} | {total_cost / max(1, max_examples)} per example.")
+    return dataset
+
+
 def main():
     redis_logical_db = int(sys.argv[1])
     # CACHE
@@ -144,8 +383,6 @@ def main():
 
     dataset = []
 
-    total_cost = 0
-
     # Models we foudn helpful to use.  In our finalized dataset, we only used gpt4.
     phi4_gpt35 = RitsModel(engine='microsoft/phi-4', api_endpoint='chat', api_max_attempts=30, temperature=1.0, max_tokens=1500, num_samples=1, prompt_cost=0.0015/1000, completion_cost=0.002/1000)
     # phi4_16k35 = RitsModel(engine='microsoft/phi-4', api_endpoint='chat', api_max_attempts=30, temperature=1.0, max_tokens=2400, num_samples=1, prompt_cost=0.003/1000, completion_cost=0.004/1000)
@@ -162,19 +399,7 @@ def main():
 
     creator = MurderMysteryDataset()
 
-    madlib = Madlib(
-        {
-            "male_names": DOMAIN_SEED_FOLDER / 'male_names.json',
-            "female_names": DOMAIN_SEED_FOLDER / 'female_names.json',
-            "male_relationships": DOMAIN_SEED_FOLDER / 'male_relationships.json',
-            "female_relationships": DOMAIN_SEED_FOLDER / 'female_relationships.json',
-            "motives": DOMAIN_SEED_FOLDER / 'strong_motives.json',
-            "murder_weapons": DOMAIN_SEED_FOLDER / 'murder_weapons.json',
-            "relationships": DOMAIN_SEED_FOLDER / 'relationships.json',
-            "crime_scenes": DOMAIN_SEED_FOLDER / 'crime_scenes.json',
-            'red_herrings': DOMAIN_SEED_FOLDER / 'suspicious_facts.json',
-        }
-    )
+    madlib = load_madlib()
 
     previously_sampled_items = []
 
@@ -185,121 +410,23 @@ def main():
         previously_sampled_items.extend([[x["victim"], x["crime_scene"], x["murder_weapon"]] for y in data for x in [y['questions'][0]['intermediate_data'][0]['victim_info']]])
         dataset = data
 
-    # CREATION LOGIC
-    for example_idx in range(max_examples):
-        story_start_time = datetime.now()
-        print(f"STORY: {example_idx+1}")
-
-        # Setup Scenario (MadLib)
-        constant_sampled_items = [['male_names', 'female_names'], 'crime_scenes', 'murder_weapons']
-        constant_sampled_names = ['victim', 'crime_scene', 'murder_weapon']
-        variable_sampled_items = [['male_names,male_relationships', 'female_names,female_relationships'], 'motives', 'crime_scenes']
-        variable_sampled_names = ['suspect', 'role', 'motive', 'alibi']
-
-        description_string = "Victim: {victim}\nCrime Scene: {crime_scene}\nMurder Weapon: {murder_weapon}"
-        variable_string = 'Suspect: {suspect}\nRole in story: {role}\nThe suspect\'s motive: {motive}'
-
-        victim_string, victim_dict, sampled = creator.sample_madlib(madlib, constant_sampled_items, previously_sampled=previously_sampled_items, description_string_format=description_string, sampled_item_names=constant_sampled_names)
-        victim_dict = victim_dict[0]
-        previously_sampled_items = sampled
-
-        suspect_strings, suspect_dicts, _ = creator.sample_madlib(madlib, variable_sampled_items, previously_sampled=[[None,None,None,victim_dict['crime_scene']]], n_samples=max_number_of_suspects, description_string_format=variable_string, sampled_item_names=variable_sampled_names)
-
-        _, suspicious_fact_dicts, _ = creator.sample_madlib(madlib, ['red_herrings'], n_samples=max_num_suspicious_facts * len(suspect_dicts), description_string_format='{red_herrings}')
-        random.shuffle(suspicious_fact_dicts)
-        for s in suspect_dicts:
-            s['red_herrings'] = []
-            for n in range(max_num_suspicious_facts):
-                s['red_herrings'].append(suspicious_fact_dicts.pop()['red_herrings'])
-
-        scenario = f'{victim_string[0]}\n'
-        d = f'{scenario}'.strip()
-        for idx, s in enumerate(suspect_strings):
-            suspect_dicts[idx]['description'] = f"{scenario}{s}".strip()
-            d += f"\n\n{s}\nRed herring: {suspect_dicts[idx]['red_herrings'][0]}"
-
-        # Victim dict should have the victim name, crime scene, and murder weapon (things specific to the victim)
-        # Suspect dicts should have the the name of the victim, their role in the story, their suspicious fact and motive.
-
-        suspect_trees = creator.create_suspect_trees(
-            model_to_use,
-            victim_dict,
-            suspect_dicts,
-            example_trees,
-            example_node_completions,
-            example_descriptions,
-            depth=tree_depth,
-            bf_factor={2: 1.0},
-            chance_to_prune=0.0,
-            chance_to_prune_all=0.0,
-            max_num_of_suspicious_facts=max_num_suspicious_facts,
-            max_retries_on_error=max_structure_completion_retries,
-            retry_model=model_to_use,
-            progress_bar=True,
-            use_validators=use_validators,
-            model_validator_model=phi4_gpt4,
-            model_validator_early_escape_model=phi4_16k35,
-            test_completion_prompt=False
-        )
-
-        suspect_trees = creator.create_chapter_trees(suspect_trees, max_num_of_suspicious_facts=max_num_suspicious_facts)
-
-        suspect_trees = creator.create_chapter(model_to_use, suspect_trees, validate_model=model_to_use)
-        if suspect_trees is None:
-            print("Boaz Add - Bad suspect_trees. skip this one. I do not know how to delete from the redis cache")
-            continue
-
-        # Because we only created chapters of the murder, we need an introduction to it.  Here we create a prompt to do that.
-        sus_strings = ", ".join([x['suspect_info']['suspect'] for x in suspect_trees])
-        intro_prompt = f"Create an intro for this murder mystery.  It should only be 1 or 2 sentences.  Only write the intro nothing else. \n\nScenario:\n{victim_dict['victim']} was killed with a {victim_dict['murder_weapon']} at a {victim_dict['crime_scene']}. Detective Winston is on the case, interviewing suspects. The suspects are {sus_strings}.\n\nOutput:\n"
-        intro, _ = creator.inference(intro_prompt, model_to_use)
-
-        # Iterate through the suspects (the curr suspect is the murderer)
-        for sidx in range(len(suspect_trees)):
-            murderer_idx = sidx
-
-            _suspect_trees = copy.deepcopy(suspect_trees)
-
-            for sidx, s in enumerate(_suspect_trees):
-                _suspect_trees[sidx]['used_chapter'] = _suspect_trees[sidx][
-                    'innocent_chapter' if sidx != murderer_idx else 'murderer_chapter']
-                _suspect_trees[sidx]['used_tree'] = _suspect_trees[sidx][
-                    'innocent_tree' if sidx != murderer_idx else 'murderer_tree']
-                _suspect_trees[sidx]['is_murderer'] = sidx == murderer_idx
-
-            chapters = [(x['suspect_info']['suspect'], x['used_chapter'].strip()) for x in _suspect_trees]
-            random.shuffle(chapters)
-
-            story = f"{intro}\n\n" + "\n\n".join([x[1] for x in chapters])
-
-            choices = [x['suspect_info']["suspect"] for x in _suspect_trees]
-
-            call_cost = phi4_gpt35.total_cost + phi4_16k35.total_cost + phi4_gpt4.total_cost
-            total_cost += call_cost
-            print(f'EXAMPLE COST: {call_cost:.2f} | TOTAL COST SO FAR: {total_cost:.2f}')
-            phi4_gpt35.total_cost = 0.0
-            phi4_16k35.total_cost = 0.0
-            phi4_gpt4.total_cost = 0.0
-
-            safe_suspects_dict = [{k: v.to_json() if isinstance(v, LogicTree) else v for k, v in x.items()} for x in _suspect_trees]
-            dataset.append(
-                creator.create_dataset_question_object(
-                    context=story,
-                    questions=['Who is the most likely murderer?'],
-                    answers=[murderer_idx],
-                    choices=[choices],
-                    intermediate_trees=[[x['used_tree'] for x in _suspect_trees]],
-                    intermediate_data=[[{'suspect_info': safe_suspects_dict, 'victim_info': victim_dict, 'story_hash_id': hash(intro)}]]
-                )
-            )
-
-            if out_file:
-                json.dump(dataset, out_file.open('w'))
-        print(f"GENERATION TIME for STORY {example_idx + 1}: {(datetime.now() - story_start_time) * 1000} secs")
-    if out_file:
-        json.dump(dataset, out_file.open('w'))
-
-    print(f"TOTAL COST: {total_cost} | {total_cost / max_examples} per example.")
+    create_murder_mysteries(
+        creator,
+        madlib,
+        model_to_use,
+        model_validator_model=phi4_gpt4,
+        model_validator_early_escape_model=phi4_16k35,
+        max_examples=max_examples,
+        out_file=out_file,
+        dataset=dataset,
+        previously_sampled_items=previously_sampled_items,
+        tree_depth=tree_depth,
+        max_number_of_suspects=max_number_of_suspects,
+        max_structure_completion_retries=max_structure_completion_retries,
+        max_num_suspicious_facts=max_num_suspicious_facts,
+        use_validators=use_validators,
+        cost_models=[phi4_gpt35, phi4_16k35, phi4_gpt4]
+    )
 
 
 if __name__ == "__main__":
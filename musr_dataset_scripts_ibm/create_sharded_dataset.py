@@ -0,0 +1,134 @@
+"""
+RUN THIS FILE TO CREATE A DATASET WITH SEVERAL WORKER PROCESSES AT ONCE.
+
+Each worker runs the normal creation loop of a domain script (i.e. create_murder_mysteries()) with its own seed and its
+own output file.  Madlib samples are reserved through a shared book (see SampleReservation) so two workers never write
+about the same victim at the same crime scene with the same weapon.  When every worker is done, the worker files are
+merged (in worker order, so the merged dataset only depends on the seeds) and the throughput is reported.
+
+Usage:
+
+    python create_sharded_dataset.py {n_workers} {max_examples} [--redis-db 0] [--seed 0] [--dry-run]
+        [--record trace.jsonl] [--replay trace.worker0.jsonl trace.worker1.jsonl ...] [--replay-latency recorded]
+        [--trace trace.json]
+
+Use --dry-run to run the whole pipeline offline with the DryRunModel stand-in (no api keys, no cost).  That is how you
+check the driver itself (and how fast the non-LLM parts of the pipeline are).
+
+Use --record to save every LLM call of a run to a trace ("{stem}.worker{idx}.jsonl" per worker) and --replay to run
+again offline on those outputs (same seed and number of workers), with the recorded latencies or --replay-latency
+(see src/model/replay.py).
+
+Use --trace to write where every story spends its time, tokens and cost (story -> suspect trees -> deductions ->
+validators, chapters -> fact recall, intro) as a Chrome trace, or jsonl for a .jsonl file, one file per worker (see
+src/utils/tracing.py).
+
+NOTE: By default, datasets go into "{OUTPUT_FOLDER}/custom_{domain}_{timestamp}.json"
+"""
+
+import argparse
+import random
+from datetime import datetime
+from pathlib import Path
+from typing import List
+
+from src import cache
+from src.model import RitsModel, DryRunModel, ReplayModel, RecordingModel
+from src.dataset_types.murder_mystery_dataset import MurderMysteryDataset
+from src.utils.paths import OUTPUT_FOLDER
+from src.utils.sharding import run_sharded, SampleReservation, shard_file
+
+import create_murder_mysteries
+
+
+def murder_mystery_worker(
+        worker_idx: int,
+        n_examples: int,
+        seed: int,
+        out_file: Path,
+        reservation: SampleReservation,
+        redis_logical_db: int = None,
+        dry_run: bool = False,
+        dry_run_latency: float = 0.0,
+        record: Path = None,
+        replay: List[Path] = None,
+        replay_latency: str = 'recorded',
+        trace: Path = None
+):
+    """One worker process of the murder mystery creation loop (see create_murder_mysteries.py)."""
+
+    random.seed(seed)
+
+    if replay:
+        model = ReplayModel(replay, latency=replay_latency, seed=seed)
+    elif dry_run:
+        model = DryRunModel(latency=dry_run_latency)
+    else:
+        if redis_logical_db is not None:
+            cache.enable(db=redis_logical_db)
+        model = RitsModel(engine='microsoft/phi-4', api_endpoint='chat', api_max_attempts=30, temperature=1.0, max_tokens=1500, num_samples=1, prompt_cost=0.0015/1000, completion_cost=0.002/1000)
+
+    if record is not None:
+        model = RecordingModel(model, shard_file(record, worker_idx))
+
+    print(f'WORKER {worker_idx} | seed {seed} | {n_examples} stories -> {out_file}')
+
+    create_murder_mysteries.create_murder_mysteries(
+        MurderMysteryDataset(),
+        create_murder_mysteries.load_madlib(),
+        model,
+        model_validator_model=model,
+        model_validator_early_escape_model=model,
+        max_examples=n_examples,
+        out_file=out_file,
+        reservation=reservation,
+        cost_models=[model],
+        trace_file=shard_file(trace, worker_idx) if trace is not None else None
+    )
+
+
+DOMAINS = {
+    'murder_mysteries': murder_mystery_worker,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create a MuSR dataset with several worker processes.')
+    parser.add_argument('n_workers', type=int, help='Number of worker processes.')
+    parser.add_argument('max_examples', type=int, help='Total number of stories to create (split between workers).')
+    parser.add_argument('--domain', default='murder_mysteries', choices=list(DOMAINS.keys()))
+    parser.add_argument('--redis-db', type=int, default=None, help='Redis logical db for the cache (shared by all workers).')
+    parser.add_argument('--seed', type=int, default=0, help='Base seed, every worker seed is derived from it.')
+    parser.add_argument('--dry-run', action='store_true', help='Use the offline DryRunModel instead of a real LLM.')
+    parser.add_argument('--dry-run-latency', type=float, default=0.0, help='Seconds per DryRunModel call.')
+    parser.add_argument('--record', type=Path, default=None, help='Record every LLM call to this trace (one file per worker).')
+    parser.add_argument('--replay', type=Path, nargs='+', default=None, help='Replay LLM calls from these traces instead of calling a model.')
+    parser.add_argument('--replay-latency', default='recorded', help='Latency of replayed calls (seconds, "recorded", "lognormal:2,0.5", ...).')
+    parser.add_argument('--trace', type=Path, default=None, help='Trace every story to this file (one file per worker).')
+    parser.add_argument('--out-file', type=Path, default=None)
+    args = parser.parse_args()
+
+    out_file = args.out_file
+    if out_file is None:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        out_file = OUTPUT_FOLDER / f'custom_{args.domain}_{timestamp}.json'
+    out_file.parent.mkdir(exist_ok=True, parents=True)
+
+    run_sharded(
+        DOMAINS[args.domain],
+        n_workers=args.n_workers,
+        max_examples=args.max_examples,
+        out_file=out_file,
+        base_seed=args.seed,
+        redis_logical_db=args.redis_db,
+        dry_run=args.dry_run,
+        dry_run_latency=args.dry_run_latency,
+        record=args.record,
+        replay=args.replay,
+        replay_latency=args.replay_latency,
+        trace=args.trace
+    )
+
+
+if __name__ == "__main__":
+    main()
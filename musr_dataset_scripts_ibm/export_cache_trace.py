@@ -0,0 +1,34 @@
+"""
+RUN THIS FILE TO EXPORT THE REDIS LLM CACHE OF PAST RUNS AS A TRACE FOR ReplayModel.
+
+Every cached model output (optionally only keys matching --match, e.g. "microsoft/phi-4*") is written as one jsonl
+record with its cache key.  Replay it with a key_model configured like the model that filled the cache:
+
+    model = ReplayModel('cache_trace.jsonl', key_model=RitsModel(engine='microsoft/phi-4', api_endpoint='chat', ...))
+
+Usage:
+
+    python export_cache_trace.py {trace_file} [--redis-db 0] [--match *]
+"""
+
+import argparse
+from pathlib import Path
+
+from src import cache
+from src.model.replay import export_cache
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the redis LLM cache as a replay trace.')
+    parser.add_argument('trace_file', type=Path)
+    parser.add_argument('--redis-db', type=int, default=0)
+    parser.add_argument('--match', default='*', help='Only export keys matching this redis pattern.')
+    args = parser.parse_args()
+
+    cache.enable(db=args.redis_db)
+    written = export_cache(cache, args.trace_file, match=args.match)
+    print(f'Exported {written} cache entries to {args.trace_file}')
+
+
+if __name__ == "__main__":
+    main()
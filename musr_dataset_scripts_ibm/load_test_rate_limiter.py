@@ -0,0 +1,123 @@
+"""
+RUN THIS FILE TO CHECK THE SHARED RATE LIMITER AGAINST A LOCAL FAKE ENDPOINT THAT INJECTS RATE LIMIT ERRORS.
+
+Starts a small OpenAI compatible chat completions server on localhost that only lets --server-rpm requests through per
+minute (answering the rest with a 429 and a Retry-After header, unless --no-retry-after) and randomly rate limits
+another --inject share of them.  Then --calls RitsModel calls are made from --threads threads against it, through
+several RitsModel instances that all share the same limiter (src/model/rate_limiter.py), and how many calls made it,
+how many 429s were hit, the wall time and the concurrency cap the limiter settled on are printed.
+
+Nothing leaves the machine, no api keys are needed.
+
+Usage:
+
+    python load_test_rate_limiter.py [--calls 200] [--threads 32] [--models 4] [--server-rpm 600] [--inject 0.05]
+        [--latency 0.05] [--client-rpm None] [--max-concurrency 16] [--no-retry-after]
+"""
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.model import RitsModel
+from src.model.rate_limiter import TokenBucket
+
+
+def make_server(server_rpm: float, inject: float, latency: float, retry_after: bool) -> ThreadingHTTPServer:
+    bucket = TokenBucket(server_rpm, capacity=max(1., server_rpm / 60.))
+    lock = threading.Lock()
+    stats = {'ok': 0, 'limited': 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+
+            with lock:
+                now = time.monotonic()
+                wait = bucket.wait_time(1, now)
+                limited = wait > 0 or random.random() < inject
+                if not limited:
+                    bucket.take(1, now)
+                stats['limited' if limited else 'ok'] += 1
+
+            if limited:
+                payload = json.dumps({'error': {'message': 'Rate limit reached', 'type': 'rate_limit_error'}}).encode()
+                self.send_response(429)
+                if retry_after:
+                    self.send_header('retry-after-ms', str(int(1000 * max(wait, 0.1))))
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                return
+
+            time.sleep(latency)
+            prompt = body.get('messages', [{}])[-1].get('content', '')
+            payload = json.dumps({
+                'id': 'fake', 'object': 'chat.completion', 'created': int(time.time()), 'model': body.get('model'),
+                'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': f'Echo: {prompt}'}}],
+                'usage': {'prompt_tokens': len(prompt) // 4, 'completion_tokens': 4, 'total_tokens': len(prompt) // 4 + 4}
+            }).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.stats = stats
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the shared rate limiter against a fake 429 injecting endpoint.')
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--models', type=int, default=4, help='Model instances sharing the endpoint (and so the limiter).')
+    parser.add_argument('--server-rpm', type=float, default=600)
+    parser.add_argument('--inject', type=float, default=0.05, help='Share of requests rate limited at random.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds the server takes per answer.')
+    parser.add_argument('--client-rpm', type=float, default=None, help='requests_per_minute given to the models.')
+    parser.add_argument('--max-concurrency', type=int, default=16)
+    parser.add_argument('--no-retry-after', action='store_true', help='Do not send Retry-After (backoff with jitter only).')
+    args = parser.parse_args()
+
+    server = make_server(args.server_rpm, args.inject, args.latency, not args.no_retry_after)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_address[1]}/v1'
+    os.environ.setdefault('RITS_API_KEY', 'fake')
+
+    models = [
+        RitsModel(engine='fake/model', base_url=base_url, api_endpoint='chat', api_max_attempts=30, temperature=1.0,
+                  max_tokens=16, requests_per_minute=args.client_rpm, max_concurrency=args.max_concurrency)
+        for _ in range(args.models)
+    ]
+    limiter = models[0].rate_limiter
+    assert all([x.rate_limiter is limiter for x in models]), 'Models of the same endpoint should share a limiter.'
+
+    def call(idx):
+        # Go around the cache, every call should hit the server.
+        out = models[idx % len(models)].__safe_openai_chat_call__(f'Call {idx}')
+        return not isinstance(out, dict)
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        results = list(executor.map(call, range(args.calls)))
+    elapsed = time.time() - start
+    server.shutdown()
+
+    print(f'{sum(results)}/{args.calls} calls succeeded in {elapsed:.1f}s ({60 * sum(results) / elapsed:.0f} per minute, server allows {args.server_rpm:.0f}).')
+    print(f'Server answered {server.stats["ok"]} requests and rate limited {server.stats["limited"]}.')
+    print(f'Limiter: {limiter.total_rate_limited} rate limit errors, concurrency cap {limiter.limit}/{limiter.max_concurrency}, {limiter.total_wait:.1f}s spent waiting for a slot in total.')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+RUN THIS FILE TO MEASURE HOW WELL THE LEXICAL FACT PRECHECK AGREES WITH THE LLM FACT RECALL.
+
+For every chapter of a murder mystery dataset (the murderer_chapter / innocent_chapter of each suspect in the
+intermediate data) the facts of its tree are checked both by FactPrecheck (src/validators/fact_precheck.py) and by the
+LLM fact recall prompt of MurderMysteryDataset.  Taking the LLM as ground truth:
+
+- precision: of the facts the precheck calls clearly present, how many the LLM also says are supported (a miss here
+  means a fact slips through validation unchecked).
+- recall: of the facts the LLM says are supported, how many the precheck catches (i.e. how many calls it saves).
+
+The LLM judgments are saved to a jsonl file, pass it back with --judgments to try other thresholds without calling
+the model again.
+
+Usage:
+
+    python measure_fact_precheck.py {dataset_file} [--judgments judgments.jsonl] [--max-chapters 100]
+        [--redis-db 0] [--dry-run] [--min-unigram 0.9] [--min-bigram 0.75] [--min-content-words 3]
+"""
+
+import argparse
+import json
+from pathlib import Path
+
+from src import cache
+from src.logic_tree.tree import LogicTree
+from src.model import RitsModel, DryRunModel
+from src.dataset_types.murder_mystery_dataset import MurderMysteryDataset
+from src.validators import FactPrecheck
+
+
+def iter_chapters(dataset_file: Path):
+    """Yield (chapter, facts) for every distinct chapter of a murder mystery dataset."""
+    seen = set()
+    for example in json.load(dataset_file.open('r')):
+        for question in example['questions']:
+            for data in question['intermediate_data'] or []:
+                for suspect in (data or {}).get('suspect_info', []):
+                    for chapter_type in ['murderer', 'innocent']:
+                        chapter = suspect.get(f'{chapter_type}_chapter')
+                        tree = suspect.get(f'{chapter_type}_tree')
+                        if chapter is None or tree is None or chapter in seen:
+                            continue
+                        seen.add(chapter)
+
+                        tree = LogicTree.from_json(tree) if isinstance(tree, dict) else tree
+                        yield chapter, list(sorted(list(set([x.value for x in tree.get_facts()]))))
+
+
+def score(judgments, precheck: FactPrecheck):
+    true_positives = false_positives = supported = total = 0
+    for record in judgments:
+        story_ngrams = precheck.story_ngrams(record['chapter'])
+        for fact, llm_supported in zip(record['facts'], record['supported']):
+            present = precheck.is_present(fact, record['chapter'], story_ngrams)
+            true_positives += present and llm_supported
+            false_positives += present and not llm_supported
+            supported += llm_supported
+            total += 1
+
+    precision = true_positives / (true_positives + false_positives) if true_positives + false_positives > 0 else float('nan')
+    recall = true_positives / max(1, supported)
+    skipped = (true_positives + false_positives) / max(1, total)
+    return precision, recall, skipped, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precision / recall of the fact precheck against the LLM fact recall.')
+    parser.add_argument('dataset_file', type=Path)
+    parser.add_argument('--judgments', type=Path, default=None, help='Jsonl of LLM judgments (read if it exists, else written).')
+    parser.add_argument('--max-chapters', type=int, default=None)
+    parser.add_argument('--redis-db', type=int, default=None)
+    parser.add_argument('--dry-run', action='store_true', help='Use the offline DryRunModel instead of a real LLM.')
+    parser.add_argument('--min-unigram', type=float, default=0.9)
+    parser.add_argument('--min-bigram', type=float, default=0.75)
+    parser.add_argument('--min-content-words', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.judgments is not None and args.judgments.exists():
+        judgments = [json.loads(x) for x in args.judgments.open('r') if x.strip()]
+    else:
+        if args.dry_run:
+            model = DryRunModel()
+        else:
+            if args.redis_db is not None:
+                cache.enable(db=args.redis_db)
+            model = RitsModel(engine='microsoft/phi-4', api_endpoint='chat', api_max_attempts=30, temperature=1.0, max_tokens=1500, num_samples=1, prompt_cost=0.0015/1000, completion_cost=0.002/1000)
+
+        creator = MurderMysteryDataset()
+        judgments = []
+        out = args.judgments.open('w') if args.judgments is not None else None
+        for cidx, (chapter, facts) in enumerate(iter_chapters(args.dataset_file)):
+            if args.max_chapters is not None and cidx >= args.max_chapters:
+                break
+            unsupported, _ = creator.recall_facts(chapter, facts, model)
+            record = {'chapter': chapter, 'facts': facts, 'supported': [x not in unsupported for x in facts]}
+            judgments.append(record)
+            if out is not None:
+                out.write(json.dumps(record) + '\n')
+                out.flush()
+            print(f'Chapter {cidx + 1}: {len(facts) - len(unsupported)}/{len(facts)} facts supported | cost {model.total_cost:.2f}')
+        if out is not None:
+            out.close()
+
+    precheck = FactPrecheck(args.min_unigram, args.min_bigram, args.min_content_words)
+    precision, recall, skipped, total = score(judgments, precheck)
+    print(f'{len(judgments)} chapters, {total} facts, {sum([sum(x["supported"]) for x in judgments])} supported by the LLM.')
+    print(f'unigram >= {args.min_unigram}, bigram >= {args.min_bigram}: precision {precision:.3f} | recall {recall:.3f} | facts skipped {100 * skipped:.1f}%')
+
+    print('Other thresholds (unigram / bigram: precision, recall, skipped):')
+    for min_unigram in [0.8, 0.9, 1.0]:
+        for min_bigram in [0.5, 0.75, 1.0]:
+            precision, recall, skipped, _ = score(judgments, FactPrecheck(min_unigram, min_bigram, args.min_content_words))
+            print(f'  {min_unigram:.1f} / {min_bigram:.1f}: {precision:.3f}, {recall:.3f}, {100 * skipped:.1f}%')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+RUN THIS FILE TO RECOMPUTE THE story_hash_id OF EXISTING MURDER MYSTERY DATASETS.
+
+Older datasets set story_hash_id to python's hash(intro), which is salted per process.  The contrastive versions of a
+story (same intro, different murderer) written by the same process agree with each other, but ids from different runs
+or workers can never be compared, so eval's exclude_contrastive_examples cannot dedup across files.
+
+This rewrites every story_hash_id with the stable, content addressed id (see src/utils/hashing.py) in one pass per file.
+
+The intro is recovered from the context: stories are written as "{intro}\\n\\n{chapter}\\n\\n{chapter}..." and the
+intro is prompted to be 1 or 2 sentences, so it is the first paragraph.  The contrastive versions of a story (grouped
+by their old id, which is consistent within a file) must all agree on it, the migration stops if they don't.
+
+Usage:
+
+    python migrate_story_hash_ids.py {dataset_file} [{dataset_file} ...] [--out-dir {folder}]
+
+By default files are rewritten in place.
+"""
+
+import argparse
+import json
+import os
+from pathlib import Path
+from typing import List, Dict, Any
+
+from src.utils.hashing import story_hash_id
+
+
+def shared_intro(contexts: List[str]) -> str:
+    """
+    The intro shared by the contrastive versions of a story: the first paragraph of the context.  (Not the longest
+    common prefix, with 3+ suspects the versions can also share the chapter that was shuffled first.)
+    """
+    intros = {x.split('\n\n')[0] for x in contexts}
+    assert len(intros) == 1, f'The contrastive versions of a story start with different intros: {sorted(intros)}'
+    return intros.pop()
+
+
+def migrate(dataset: List[Dict[str, Any]]) -> int:
+    """
+    Recompute the story_hash_id of every example in place.
+
+    :param dataset: A murder mystery dataset (list of examples from create_dataset_question_object)
+    :return: Number of examples updated.
+    """
+
+    groups = {}
+    for eidx, example in enumerate(dataset):
+        data = example['questions'][0].get('intermediate_data')
+        if not data or not data[0] or data[0].get('story_hash_id') is None:
+            continue
+        groups.setdefault(data[0]['story_hash_id'], []).append(eidx)
+
+    updated = 0
+    for old_id, eidxs in groups.items():
+        new_id = story_hash_id(shared_intro([dataset[eidx]['context'] for eidx in eidxs]))
+        for eidx in eidxs:
+            for question in dataset[eidx]['questions']:
+                for data in question.get('intermediate_data') or []:
+                    if data and 'story_hash_id' in data:
+                        data['story_hash_id'] = new_id
+            updated += 1
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recompute story_hash_id with a stable digest for existing datasets.')
+    parser.add_argument('files', type=Path, nargs='+', help='Murder mystery dataset files (json).')
+    parser.add_argument('--out-dir', type=Path, default=None, help='Write migrated files here instead of in place.')
+    args = parser.parse_args()
+
+    for file in args.files:
+        dataset = json.load(file.open('r'))
+        updated = migrate(dataset)
+
+        out_file = file if args.out_dir is None else args.out_dir / file.name
+        out_file.parent.mkdir(exist_ok=True, parents=True)
+
+        # Write next to the destination first so a crash never leaves a half written dataset behind.
+        tmp_file = out_file.parent / f'.{out_file.name}.tmp'
+        with tmp_file.open('w') as f:
+            json.dump(dataset, f)
+        os.replace(tmp_file, out_file)
+
+        print(f'{file}: updated {updated} / {len(dataset)} examples -> {out_file}')
+
+
+if __name__ == "__main__":
+    main()
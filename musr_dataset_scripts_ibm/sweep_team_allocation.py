@@ -0,0 +1,43 @@
+"""
+RUN THIS FILE TO SEE HOW HARD THE TEAM ALLOCATION ASSIGNMENTS ARE BEFORE GENERATING A DATASET.
+
+Samples many skill / cooperation matrices with TeamAllocationDataset.build_assignments_batch (no LLM calls) and prints
+histograms of the margin between the gold assignment and the next best one, before and after the perturbations, and
+of how many perturbations were made.  Use it to pick max_updates / stop_margin for build_assignment.
+
+Usage:
+
+    python sweep_team_allocation.py [--samples 1000000] [--seed 0] [--max-updates 10] [--stop-margin 2]
+"""
+
+import argparse
+
+from src.dataset_types.assignment_engine import histogram
+from src.dataset_types.team_allocation import TeamAllocationDataset
+
+
+def print_histogram(name, counts, total):
+    print(f'{name}:')
+    for value, count in counts.items():
+        print(f'  {value:>3}: {count:>10} ({100 * count / max(1, total):5.1f}%)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Margin / perturbation histograms of sampled team allocation matrices.')
+    parser.add_argument('--samples', type=int, default=1_000_000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-updates', type=int, default=10)
+    parser.add_argument('--stop-margin', type=int, default=2)
+    args = parser.parse_args()
+
+    batch = TeamAllocationDataset().build_assignments_batch(
+        args.samples, seed=args.seed, max_updates=args.max_updates, stop_margin=args.stop_margin
+    )
+
+    print_histogram('Initial margin', histogram(batch['initial_margins']), args.samples)
+    print_histogram('Final margin', histogram(batch['margins']), args.samples)
+    print_histogram('Perturbations', histogram(batch['updates']), args.samples)
+
+
+if __name__ == "__main__":
+    main()
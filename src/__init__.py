@@ -1,3 +1,4 @@
 from src.utils.redis_cache import RedisCache
+from src.utils.tracing import tracer
 
 cache = RedisCache(disabled=True)
@@ -3,14 +3,19 @@ import time
 from typing import Dict, Any, List, Callable, Union
 from copy import deepcopy
 import random
+import itertools
+import contextvars
 from tqdm import tqdm
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait
 
 from src.utils.model_utils import format_output
+from src.utils.sharding import SampleReservation
+from src.utils.tracing import tracer
 
 random.seed(0)
 
-from src.madlib.madlib import Madlib
+from src.madlib.madlib import Madlib, MadlibExhaustedError, SampleHistory
 from src.logic_tree.tree import LogicNode, LogicTree, LogicNodeFactType
 from src.model import Model, OpenAIModel, HFModel
 from src.validators import Validator, StructureValidator
@@ -236,7 +241,9 @@ class DatasetBuilder:
             description_string_format: str = None,
             previously_sampled: List[str] = None,
             sampled_item_names: List[str] = None,
-            n_samples: int = 1
+            n_samples: int = 1,
+            reservation: SampleReservation = None,
+            exact: bool = False
     ):
         """
         Complicated sampling method for getting items from a madlib.
@@ -250,31 +257,44 @@ class DatasetBuilder:
         of passing them in as a list.  I.E.
         sampled_items=['motive', ['female_names,female_relationships', 'male_names,male_relationships']]
 
+        By default samples are drawn at random and redrawn until they are new, which never ends once every combination
+        has been used.  With exact=True, combinations are drawn without replacement (see Madlib.combinations()) so each
+        one is tried at most once, and MadlibExhaustedError is raised as soon as there is no unused one left.  The two
+        modes use the random state differently, so they give different (equally random) samples for the same seed.
+
         :param madlib: The Madlib to sample from
         :param sampled_items: What to sample (names, see above for details)
         :param description_string_format: For the strings returned, how do we format the sampled items, i.e. "{name}'s motive is {motive}."
         :param previously_sampled: What was previously sampled from the madlib (to ensure uniqueness)
         :param sampled_item_names: Rename from the sampled_items list i.e. when sampled_items = ["motive", "motive"] we can set sampled_item_names=["motive_1", "motive_2"] so we can distinguish in "description_string_format"
         :param n_samples: How many samples to pull.
-        :return: List of strings formatted, List of dictionaries of sampled items, List of previously sampled items including the ones we sampled here.
+        :param reservation: Shared reservation (see SampleReservation) so parallel workers never keep the same sample.
+        :param exact: Sample unused combinations without replacement and fail fast when they run out (see above).
+        :return: List of strings formatted, List of dictionaries of sampled items, List of previously sampled items including the ones we sampled here (a SampleHistory, pass it back in as previously_sampled).
         """
         if description_string_format is None:
             description_string_format = ''
-        if previously_sampled is None:
-            previously_sampled = []
+        if not isinstance(previously_sampled, SampleHistory):
+            previously_sampled = SampleHistory(previously_sampled or [])
 
         out_strings = []
         out_dicts = []
         n = 0
         while n < n_samples:
+            if exact:
+                keys, sample = self.__draw_unused_combination__(madlib, sampled_items)
+            else:
+                keys = [y for x in sampled_items for y in (x.split(',') if isinstance(x, str) else random.sample(x, 1)[0].split(','))]
+                sample = [madlib.sample(i, [])[0] for i in keys]
+
+            if sample in previously_sampled:
+                continue
+            if reservation is not None and not reservation.reserve(sample):
+                continue
+
             out_string = deepcopy(description_string_format)
-            sample = []
             out_dict = {}
-            for idx, i in enumerate([y for x in sampled_items for y in (x.split(',') if isinstance(x, str) else random.sample(x, 1)[0].split(','))]):
-                ignore_list = [x[idx] for x in previously_sampled]
-                val = madlib.sample(i, [])[0]
-                sample.append(val)
-
+            for idx, (i, val) in enumerate(zip(keys, sample)):
                 if sampled_item_names is None:
                     out_string = out_string.replace('{'+i+'}', val)
                     out_dict[i] = val
@@ -282,14 +302,29 @@ class DatasetBuilder:
                     out_string = out_string.replace('{'+sampled_item_names[idx]+'}', val)
                     out_dict[sampled_item_names[idx]] = val
 
-            if sample in previously_sampled:
-                continue
             n+=1
             previously_sampled.append(sample)
             out_strings.append(out_string)
             out_dicts.append(out_dict)
         return out_strings, out_dicts, previously_sampled
 
+    @staticmethod
+    def __draw_unused_combination__(madlib: Madlib, sampled_items: List[Union[str, List[str]]]):
+        """
+        One never drawn combination for sample_madlib(exact=True), picking among the keys sampled_items allows (the
+        alternatives that still have combinations left).
+        """
+        patterns = [
+            [y for x in choice for y in x.split(',')]
+            for choice in itertools.product(*[[x] if isinstance(x, str) else x for x in sampled_items])
+        ]
+        available = [p for p in patterns if len(madlib.combinations(p)) > 0]
+        if len(available) == 0:
+            raise MadlibExhaustedError(f'Every combination of {sampled_items} has been sampled.')
+
+        keys = random.choice(available)
+        return keys, madlib.combinations(keys).draw()
+
     def build_structure(
             self,
             depth: int = 4,
@@ -456,10 +491,11 @@ class DatasetBuilder:
             for c in children:
                 iteratively_complete(description, tree, c, model, retry_model, completion_prompt_fn, pbar, max_retries_on_error=max_retries_on_error, test_prompt=test_prompt)
 
-        if use_iterative_complete_v2:
-            [self.iteratively_complete_v2(description, tree, x, model, retry_model, completion_prompt_fn, pbar, max_retries_on_error=max_retries_on_error, test_prompt=test_prompt, validators=validators) for x in tree.nodes]
-        else:
-            [iteratively_complete(description, tree, x, model, retry_model, completion_prompt_fn, pbar, max_retries_on_error=max_retries_on_error, test_prompt=test_prompt) for x in tree.nodes]
+        with tracer.span('tree', root=tree.nodes[0].value[:80] if len(tree.nodes) > 0 else ''):
+            if use_iterative_complete_v2:
+                [self.iteratively_complete_v2(description, tree, x, model, retry_model, completion_prompt_fn, pbar, max_retries_on_error=max_retries_on_error, test_prompt=test_prompt, validators=validators) for x in tree.nodes]
+            else:
+                [iteratively_complete(description, tree, x, model, retry_model, completion_prompt_fn, pbar, max_retries_on_error=max_retries_on_error, test_prompt=test_prompt) for x in tree.nodes]
 
         return tree
 
@@ -480,6 +516,41 @@ class DatasetBuilder:
 
         return output, raw
 
+    def run_concurrently(
+            self,
+            jobs: List[Callable[[], Any]],
+            max_concurrency: int = 1,
+            timeout: float = None
+    ) -> List[Any]:
+        """
+        Run independent jobs (usually ones that spend their time waiting on LLM calls, like complete_structure) on a
+        pool of threads.
+
+        :param jobs: Functions without arguments.
+        :param max_concurrency: Max # of jobs running at once (1 runs them one after the other in this thread, unless
+            there is a timeout).
+        :param timeout: Seconds to wait for all the jobs.  When it runs out, a concurrent.futures.TimeoutError is
+            raised, jobs that have not started are cancelled and the running ones are left to finish in the background
+            (their results are dropped).
+        :return: The result of every job, in the order of jobs (an exception in a job is raised here).
+
+        Jobs run in a copy of the caller's context, so their tracing spans are children of the caller's current span.
+        """
+        if (max_concurrency <= 1 or len(jobs) <= 1) and timeout is None:
+            return [job() for job in jobs]
+
+        pool = ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(jobs))))
+        futures = [pool.submit(contextvars.copy_context().run, job) for job in jobs]
+        try:
+            done, not_done = wait(futures, timeout=timeout)
+            if len(not_done) > 0:
+                raise TimeoutError(f'{len(not_done)} of {len(jobs)} jobs did not finish in {timeout:.1f} seconds.')
+            return [f.result() for f in futures]
+        finally:
+            for f in futures:
+                f.cancel()
+            pool.shutdown(wait=False)
+
     def create_dataset_question_object(
             self,
             context: str,
@@ -564,32 +635,35 @@ class DatasetBuilder:
 
             # Do any of our validators fail?
             all_valid = True
-            while retry_idx <= max_retries_on_error:
-                all_valid = True
-                # time_stamp_a = time.time()
-                raw = model.inference(prompt)
-                # print(f"Inference call took {time.time()-time_stamp_a} ms")
-
-                # output = raw.choices[0]['message']['content']
-                # output = raw.choices[0].message.content
-                output = format_output(model, raw)
-
-                facts_from_story, cs_knowledge = parse_out(output)
-
-                for v in validators:
-                    valid, retry_prompt = v(node, facts_from_story, cs_knowledge, output)
-                    if not valid:
-                        # If we fail, we will append the retry prompt from the validator to our deduction prompt before
-                        # we ask for the new deduction.
-                        prompt_parts = prompt.split('Entailment Step to Complete:')
+            with tracer.span('deduction', node=node.value[:80]) as span:
+                while retry_idx <= max_retries_on_error:
+                    all_valid = True
+                    with tracer.span('attempt', retry=retry_idx):
+                        raw = model.inference(prompt)
 
-                        prompt = prompt_parts[0] + f'\n\n{retry_prompt}\n\nEntailment Step to Complete:\n{prompt_parts[1]}'
-                        all_valid = False
+                        # output = raw.choices[0]['message']['content']
+                        # output = raw.choices[0].message.content
+                        output = format_output(model, raw)
+
+                        facts_from_story, cs_knowledge = parse_out(output)
+
+                        for v in validators:
+                            with tracer.span('validator', validator=type(v).__name__) as validator_span:
+                                valid, retry_prompt = v(node, facts_from_story, cs_knowledge, output)
+                                validator_span.set(valid=valid)
+                            if not valid:
+                                # If we fail, we will append the retry prompt from the validator to our deduction prompt before
+                                # we ask for the new deduction.
+                                prompt_parts = prompt.split('Entailment Step to Complete:')
+
+                                prompt = prompt_parts[0] + f'\n\n{retry_prompt}\n\nEntailment Step to Complete:\n{prompt_parts[1]}'
+                                all_valid = False
+                                break
+                    if all_valid:
                         break
-                if all_valid:
-                    break
 
-                retry_idx += 1
+                    retry_idx += 1
+                span.set(retries=min(retry_idx, max_retries_on_error), valid=all_valid)
 
             if not all_valid:
                 print('ERROR Validators Failed (Killing Branch)')
@@ -0,0 +1,248 @@
+"""
+Exhaustive assignment scoring for team allocation.
+
+An assignment puts each of N people on one of K tasks (with a fixed number of people per task).  Its score is the sum
+of every person's skill at the task they got plus the cooperation score of every two people sharing a task:
+
+    score(a) = sum_p skills[p, a[p]] + sum_{p < q, a[p] == a[q]} cooperation[p, q]
+
+This is linear in the parameters theta = [skills (N x K, row major), cooperation (upper triangle, row major)], so the
+engine enumerates every assignment once into a 0/1 design matrix and all scores are one matrix product
+(design @ theta).  Changing one parameter by d changes the scores by d * design[:, j], which is how AssignmentState
+applies perturbations without rescoring.
+
+Example (the classic 3 people, 2 tasks setup where one person works alone and two work together):
+
+    engine = AssignmentEngine(n_people=3, task_sizes=[1, 2])
+    gold = engine.index([0, 1, 1])
+    state = engine.state(skills=[[3, 1], [1, 2], [1, 3]], cooperation=[[0, 1, 1], [1, 0, 2], [1, 2, 0]], gold=gold)
+    state.margin                                    # gold score - best other score
+    state.set(engine.skill_index(1, 0), 3, min_margin=1)
+"""
+
+import itertools
+import random
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+
+class AssignmentEngine:
+    """Enumerates the assignments of n_people to tasks of the given sizes and scores them."""
+
+    def __init__(self, n_people: int, task_sizes: Sequence[int]):
+        """
+        :param n_people: N, the number of people.
+        :param task_sizes: How many people each of the K tasks gets (must add up to N).
+        """
+        assert sum(task_sizes) == n_people, f'Task sizes {task_sizes} do not add up to {n_people} people.'
+
+        self.n_people = n_people
+        self.task_sizes = list(task_sizes)
+        self.n_tasks = len(task_sizes)
+
+        # Every distinct arrangement of the task labels, in lexicographic order (for [1, 2] that is person 0 alone,
+        # then person 1 alone, then person 2 alone).
+        labels = [k for k, size in enumerate(self.task_sizes) for _ in range(size)]
+        self.assignments = np.array(sorted(set(itertools.permutations(labels))), dtype=np.int8).reshape(-1, n_people)
+        self.n_assignments = self.assignments.shape[0]
+
+        self.pairs = np.triu_indices(n_people, 1)
+        self.n_skills = n_people * self.n_tasks
+        self.n_params = self.n_skills + len(self.pairs[0])
+
+        people = np.arange(n_people)
+        self.design = np.zeros((self.n_assignments, self.n_params), dtype=np.int8)
+        self.design[np.arange(self.n_assignments)[:, None], people * self.n_tasks + self.assignments] = 1
+        self.design[:, self.n_skills:] = self.assignments[:, self.pairs[0]] == self.assignments[:, self.pairs[1]]
+
+        self.__rows__ = {tuple(a): i for i, a in enumerate(self.assignments.tolist())}
+
+    def index(self, assignment: Sequence[int]) -> int:
+        """Row of an assignment given as the task of every person."""
+        return self.__rows__[tuple(assignment)]
+
+    def groups(self, row: int, people: List[str]) -> List[List[str]]:
+        """The (sorted) names of the people on each task for an assignment row."""
+        return [list(sorted([people[p] for p in range(self.n_people) if self.assignments[row, p] == k])) for k in range(self.n_tasks)]
+
+    def skill_index(self, person: int, task: int) -> int:
+        """Position of skills[person, task] in theta."""
+        return person * self.n_tasks + task
+
+    def cooperation_index(self, person_a, person_b):
+        """
+        Position of cooperation[person_a, person_b] (== cooperation[person_b, person_a]) in theta.  Works elementwise
+        on arrays of people too.
+        """
+        p, q = np.minimum(person_a, person_b), np.maximum(person_a, person_b)
+        assert np.all(p != q), 'Nobody cooperates with themselves.'
+        return self.n_skills + p * self.n_people - p * (p + 1) // 2 + (q - p - 1)
+
+    def params(self, skills, cooperation) -> np.ndarray:
+        """
+        theta for skill / cooperation matrices (both can have leading batch dimensions).
+
+        :param skills: (..., N, K)
+        :param cooperation: (..., N, N), only the upper triangle is used.
+        """
+        skills = np.asarray(skills)
+        cooperation = np.asarray(cooperation)
+        return np.concatenate([skills.reshape(*skills.shape[:-2], self.n_skills), cooperation[..., self.pairs[0], self.pairs[1]]], -1)
+
+    def matrices(self, theta):
+        """Inverse of params(): the (..., N, K) skills and the symmetric (..., N, N) cooperation (0 on the diagonal)."""
+        theta = np.asarray(theta)
+        skills = theta[..., :self.n_skills].reshape(*theta.shape[:-1], self.n_people, self.n_tasks)
+        cooperation = np.zeros((*theta.shape[:-1], self.n_people, self.n_people), dtype=theta.dtype)
+        cooperation[..., self.pairs[0], self.pairs[1]] = theta[..., self.n_skills:]
+        cooperation[..., self.pairs[1], self.pairs[0]] = theta[..., self.n_skills:]
+        return skills, cooperation
+
+    def scores(self, theta) -> np.ndarray:
+        """Score of every assignment, (..., n_assignments) for theta of shape (..., n_params)."""
+        return np.asarray(theta, dtype=np.int32) @ self.design.T.astype(np.int32)
+
+    def margins(self, scores, gold) -> np.ndarray:
+        """Score of the gold assignment minus the best other score (> 0 means gold is the unique best)."""
+        scores = np.asarray(scores)
+        gold = np.broadcast_to(np.asarray(gold), scores.shape[:-1])
+        gold_scores = np.take_along_axis(scores, gold[..., None], -1)[..., 0]
+        others = scores.copy()
+        np.put_along_axis(others, gold[..., None], np.iinfo(others.dtype).min, -1)
+        return gold_scores - others.max(-1)
+
+    def state(self, skills, cooperation, gold: int) -> 'AssignmentState':
+        return AssignmentState(self, self.params(skills, cooperation), gold)
+
+    def sample_state(
+            self,
+            gold: int,
+            levels: Sequence[int] = (1, 2, 3),
+            min_margin: int = 1,
+            max_tries: int = 100
+    ) -> 'AssignmentState':
+        """
+        Random skill / cooperation levels for which gold is the best assignment by at least min_margin.  Levels are
+        drawn uniformly, then parameters only the gold uses are raised (or ones it doesn't use lowered) until every
+        other assignment is beaten.
+
+        :param gold: The row that has to win.
+        :param levels: The allowed values of every parameter, in increasing order.
+        :param min_margin: Required gap between the gold score and any other score.
+        :param max_tries: How many fresh draws to try before giving up (raises an Exception).
+        """
+        levels = list(levels)
+        for _ in range(max_tries):
+            state = AssignmentState(self, np.array([random.choice(levels) for _ in range(self.n_params)]), gold)
+
+            while state.margin < min_margin:
+                rival = state.best_other()
+                up = [j for j in np.flatnonzero(self.design[gold] > self.design[rival]) if state.theta[j] < levels[-1]]
+                down = [j for j in np.flatnonzero(self.design[rival] > self.design[gold]) if state.theta[j] > levels[0]]
+                if len(up) > 0:
+                    j = random.choice(up)
+                    state.set(j, levels[levels.index(state.theta[j]) + 1])
+                elif len(down) > 0:
+                    j = random.choice(down)
+                    state.set(j, levels[levels.index(state.theta[j]) - 1])
+                else:
+                    break
+
+            if state.margin >= min_margin:
+                return state
+        raise Exception(f'Could not make assignment {gold} win by {min_margin} in {max_tries} tries.')
+
+
+class AssignmentState:
+    """
+    One set of skill / cooperation levels with the scores of every assignment, kept up to date incrementally.
+    """
+
+    def __init__(self, engine: AssignmentEngine, theta: np.ndarray, gold: int):
+        self.engine = engine
+        self.theta = np.array(theta, dtype=np.int32)
+        self.gold = gold
+        self.scores = engine.scores(self.theta)
+
+    @property
+    def margin(self) -> int:
+        return int(self.engine.margins(self.scores, self.gold))
+
+    def best_other(self) -> int:
+        """The highest scoring assignment other than gold (the first one on ties)."""
+        others = self.scores.copy()
+        others[self.gold] = np.iinfo(others.dtype).min
+        return int(others.argmax())
+
+    def worst_other(self) -> int:
+        """The lowest scoring assignment other than gold (the first one on ties)."""
+        others = self.scores.copy()
+        others[self.gold] = np.iinfo(others.dtype).max
+        return int(others.argmin())
+
+    def ranking(self) -> List[int]:
+        """Assignment rows from the best score to the worst (ties keep row order)."""
+        return [int(x) for x in np.argsort(-self.scores, kind='stable')]
+
+    def set(self, param: int, value: int, min_margin: Optional[int] = None) -> bool:
+        """
+        Change one parameter (see AssignmentEngine.skill_index / cooperation_index), updating the scores by the delta.
+
+        :param min_margin: If given, the change is only applied when the gold still wins by at least this much.
+        :return: Whether the change was applied.
+        """
+        delta = int(value) - int(self.theta[param])
+        if delta == 0:
+            return True
+
+        scores = self.scores + delta * self.engine.design[:, param]
+        if min_margin is not None and self.engine.margins(scores, self.gold) < min_margin:
+            return False
+
+        self.scores = scores
+        self.theta[param] = value
+        return True
+
+    def harden(self, target_margin: int, max_updates: int, levels: Sequence[int] = (1, 2, 3), min_margin: int = 1) -> int:
+        """
+        Make the best non gold assignment more competitive, one level of one parameter at a time, until the gold only
+        wins by target_margin.  A change never drops the margin below min_margin.
+
+        :return: Number of updates applied.
+        """
+        levels = list(levels)
+        updates = 0
+        while self.margin > target_margin and updates < max_updates:
+            rival = self.best_other()
+            options = [
+                j for j in np.flatnonzero(self.engine.design[rival] > self.engine.design[self.gold])
+                if self.theta[j] < levels[-1]
+            ]
+            random.shuffle(options)
+            applied = False
+            for j in options:
+                if self.set(j, levels[levels.index(self.theta[j]) + 1], min_margin=min_margin):
+                    applied = True
+                    break
+            if not applied:
+                break
+            updates += 1
+        return updates
+
+    def matrices(self):
+        return self.engine.matrices(self.theta)
+
+    def people_levels(self, people: List[str]):
+        """The {name: {'skills': [...], 'cooperation': [...]}} structure TeamAllocationDataset uses."""
+        skills, cooperation = self.matrices()
+        return {
+            name: {'skills': [int(x) for x in skills[p]], 'cooperation': [int(x) for x in cooperation[p]]}
+            for p, name in enumerate(people)
+        }
+
+
+def histogram(values) -> Dict[int, int]:
+    """{value: count} of an integer array (e.g. the margins of TeamAllocationDataset.build_assignments_batch)."""
+    values, counts = np.unique(np.asarray(values), return_counts=True)
+    return {int(v): int(c) for v, c in zip(values, counts)}
@@ -0,0 +1,277 @@
+"""
+Batched belief tracking for object placements.
+
+ObjectPlacementsDataset.create_sequence_v2 simulates one sequence of moves at a time with nested dicts (person -> item
+-> location), copying them every step.  This does the same simulation for many sequences at once on small integer
+coded NumPy arrays: people, items and locations are indices into the lists the engine was made with, the world of
+every sequence is an (items,) array of locations and what people believe is a (people, items) array.
+
+The history is kept in arrays preallocated for the whole run (one slot per step), so a step never allocates per
+sequence, and any sequence can be rendered back into the exact outputs of create_sequence_v2 (events, beliefs,
+actual_locs, event_structure) with SequenceBatch.to_sequence().
+
+Example:
+
+    engine = BeliefEngine(items=['apple', 'key'], locs=['desk', 'fridge', 'shelf'], people=['Ann', 'Bob', 'Cy'])
+    batch = engine.simulate(10_000, max_sequence_length=3, chance_subject_sees=0.33, seed=0)
+
+    batch.who_knows(0)              # (10_000, 3) bool, who knows where the apple is at the end of each sequence
+    batch.false_beliefs().mean()    # How many people are wrong about an item, on average (a difficulty signal)
+    events, beliefs, actual_locs, event_structure = batch.to_sequence(0)
+"""
+
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+def __masked_choice__(rng: np.random.Generator, mask: np.ndarray) -> np.ndarray:
+    """
+    Uniformly pick one True index along the last axis of mask for every row (-1 for rows without any).  The argmax of
+    iid uniform draws restricted to the allowed entries is uniform over them.
+    """
+    draws = rng.random(mask.shape)
+    draws[~mask] = -1.
+    choice = draws.argmax(-1)
+    choice[~mask.any(-1)] = -1
+    return choice
+
+
+class SequenceBatch:
+    """
+    The result of BeliefEngine.simulate().  Arrays are indexed [sequence, step, ...], step 0 is the opening scene.
+
+    actual: (n, steps + 1, items) where every item is.
+    beliefs: (n, steps + 1, people, items) where everyone thinks every item is.
+    known: (n, steps + 1, people, items) whether someone knows where an item is.
+    movers, moved_items, targets: (n, steps) the move of every step (-1 if nobody could move anything, those steps
+        are skipped, like create_sequence_v2 does).
+    saw_move: (n, steps, people) who saw the move (the mover always does).
+    saw_at_target: (n, steps, items) items the mover found at the target location they didn't know were there.
+    """
+
+    def __init__(self, engine: 'BeliefEngine', actual, beliefs, known, movers, moved_items, targets, saw_move, saw_at_target):
+        self.engine = engine
+        self.actual = actual
+        self.beliefs = beliefs
+        self.known = known
+        self.movers = movers
+        self.moved_items = moved_items
+        self.targets = targets
+        self.saw_move = saw_move
+        self.saw_at_target = saw_at_target
+
+    def __len__(self):
+        return self.actual.shape[0]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """Number of moves in each sequence."""
+        return (self.movers >= 0).sum(-1)
+
+    def who_knows(self, item: int, step: int = -1) -> np.ndarray:
+        """(n, people) bool, who knows where item is after step (default the end of the sequence)."""
+        return self.known[:, step, :, item]
+
+    def false_beliefs(self, step: int = -1) -> np.ndarray:
+        """(n,) number of (person, item) pairs where the person thinks the item is somewhere it isn't."""
+        return (self.beliefs[:, step] != self.actual[:, step, None, :]).sum((-1, -2))
+
+    def to_sequence(self, idx: int):
+        """
+        Render one sequence into the outputs of ObjectPlacementsDataset.create_sequence_v2.
+
+        :param idx: Which sequence of the batch.
+        :return: events, beliefs, actual_locs, event_structure
+        """
+        items, locs, people = self.engine.items, self.engine.locs, self.engine.people
+
+        def respect_article(item):
+            if any([item.startswith(name) for name in people]):
+                return item
+            return f'the {item}'
+
+        def locations(step):
+            return {items[i]: locs[l] for i, l in enumerate(self.actual[idx, step])}
+
+        events = [
+            [f'{n} sees {respect_article(i)} at {respect_article(l)}.' for n in people for (i, l) in locations(0).items()]
+        ]
+        beliefs = [
+            {n: {items[i]: locs[l] for i, l in enumerate(self.beliefs[idx, 0, p])} for p, n in enumerate(people)}
+        ]
+        actual_locs = [locations(0)]
+        event_structure = [
+            {
+                'event': 'opening scene',
+                'immutable_sequence': events[0],
+                'sequence': []
+            }
+        ]
+
+        for step in range(self.movers.shape[1]):
+            if self.movers[idx, step] < 0:
+                continue
+
+            mover = people[self.movers[idx, step]]
+            item = items[self.moved_items[idx, step]]
+            location = locs[self.targets[idx, step]]
+
+            updates = []
+            structure = {
+                'event': f'{mover} moves {respect_article(item)} to {respect_article(location)}.',
+                'immutable_sequence': [],
+                'sequence': []
+            }
+            updates.append(structure['event'])
+
+            for i in np.flatnonzero(self.saw_at_target[idx, step]):
+                _update = f'{mover} saw {respect_article(items[i])} at {respect_article(location)} when moving {respect_article(item)}.'
+                structure['immutable_sequence'].append(_update)
+                updates.append(_update)
+
+            for p, subject in enumerate(people):
+                if subject == mover:
+                    continue
+                if self.saw_move[idx, step, p]:
+                    _update = f'{subject} saw {respect_article(item)} move to {respect_article(location)}.'
+                else:
+                    _update = f'{subject} did not see {respect_article(item)} move to {respect_article(location)}.'
+                updates.append(_update)
+                structure['sequence'].append(_update)
+
+            event_structure.append(structure)
+            beliefs.append({
+                n: {items[i]: locs[l] for i, l in enumerate(self.beliefs[idx, step + 1, p])} for p, n in enumerate(people)
+            })
+            actual_locs.append(locations(step + 1))
+            events.append(updates)
+
+        return events, beliefs, actual_locs, event_structure
+
+
+class BeliefEngine:
+    """
+    Simulates batches of object placement sequences with the rules of create_sequence_v2: a mover picks an item they
+    know the location of and moves it somewhere else (each item can go to the same location at most
+    max_location_use_per_item times), the mover notices anything already at that location, and everyone else sees the
+    move with chance_subject_sees.
+    """
+
+    def __init__(
+            self,
+            items: List[str],
+            locs: List[str],
+            people: List[str],
+            initial_starting_positions: List[Tuple[str, str]] = None
+    ):
+        """
+        :param items: List of items people can move
+        :param locs: List of locations someone can move items to.
+        :param people: List of people who can move stuff
+        :param initial_starting_positions: Where the items are to begin with (items missing from it start at a random
+            location in every sequence).  Like create_sequence_v2, the given items come first in the item order.
+        """
+        if initial_starting_positions is not None:
+            starting = {item: loc for (item, loc) in initial_starting_positions}
+            items = list(starting.keys()) + [x for x in items if x not in starting]
+        else:
+            starting = {}
+
+        self.items = list(items)
+        self.locs = list(locs)
+        self.people = list(people)
+
+        assert len(self.locs) > 1, 'Items need at least two locations to move between.'
+        self.starting_positions = np.array([self.locs.index(starting[x]) if x in starting else -1 for x in self.items], dtype=np.int16)
+
+    def simulate(
+            self,
+            n_sequences: int,
+            max_sequence_length: int = 10,
+            chance_subject_sees: float = 0.25,
+            max_location_use_per_item: int = 2,
+            allowed_movers: List[str] = None,
+            seed: Optional[int] = None
+    ) -> SequenceBatch:
+        """
+        Simulate n_sequences independent sequences at once.
+
+        NOTE: create_sequence_v2 can pick an item that has no location left to go to (and crash), here such items are
+        not picked.
+
+        :param n_sequences: How many sequences to simulate.
+        :param max_sequence_length: Max # of moves
+        :param chance_subject_sees: Chance for someone (who is not the mover) to see the item move.
+        :param max_location_use_per_item: # of times an item can move to the same location.
+        :param allowed_movers: People who can move things (everyone if None)
+        :param seed: Seed of the numpy generator used for the simulation.
+        """
+        rng = np.random.default_rng(seed)
+        n, n_people, n_items, n_locs = n_sequences, len(self.people), len(self.items), len(self.locs)
+        rows = np.arange(n)
+
+        actual = np.empty((n, max_sequence_length + 1, n_items), dtype=np.int16)
+        beliefs = np.empty((n, max_sequence_length + 1, n_people, n_items), dtype=np.int16)
+        known = np.empty((n, max_sequence_length + 1, n_people, n_items), dtype=bool)
+        movers = np.full((n, max_sequence_length), -1, dtype=np.int16)
+        moved_items = np.full((n, max_sequence_length), -1, dtype=np.int16)
+        targets = np.full((n, max_sequence_length), -1, dtype=np.int16)
+        saw_move = np.zeros((n, max_sequence_length, n_people), dtype=bool)
+        saw_at_target = np.zeros((n, max_sequence_length, n_items), dtype=bool)
+
+        start = np.broadcast_to(self.starting_positions, (n, n_items)).copy()
+        random_start = start < 0
+        start[random_start] = rng.integers(0, n_locs, random_start.sum())
+
+        actual[:, 0] = start
+        beliefs[:, 0] = start[:, None, :]
+        known[:, 0] = True
+
+        can_move = np.ones(n_people, dtype=bool)
+        if allowed_movers is not None:
+            can_move[:] = [x in allowed_movers for x in self.people]
+
+        uses = np.zeros((n, n_items, n_locs), dtype=np.int16)
+        loc_ids = np.arange(n_locs)
+
+        for step in range(max_sequence_length):
+            now_actual, now_known = actual[:, step], known[:, step]
+
+            open_targets = (uses < max_location_use_per_item) & (loc_ids != now_actual[:, :, None])
+            possible_items = now_known & open_targets.any(-1)[:, None, :]
+            possible_movers = possible_items.any(-1) & can_move
+
+            mover = __masked_choice__(rng, possible_movers)
+            active = mover >= 0
+            safe_mover = np.where(active, mover, 0)
+            item = __masked_choice__(rng, possible_items[rows, safe_mover] & active[:, None])
+            safe_item = np.where(active, item, 0)
+            target = __masked_choice__(rng, open_targets[rows, safe_item] & active[:, None])
+            safe_target = np.where(active, target, 0)
+
+            next_actual = now_actual.copy()
+            next_known = now_known.copy()
+
+            # The mover now has seen any items at the target.
+            found = (now_actual == safe_target[:, None]) & ~now_known[rows, safe_mover] & active[:, None]
+            next_known[rows, safe_mover] |= found
+
+            next_actual[rows, safe_item] = np.where(active, safe_target, now_actual[rows, safe_item])
+            uses[rows, safe_item, safe_target] += active
+
+            sees = rng.random((n, n_people)) < chance_subject_sees
+            sees[rows, safe_mover] = True
+            next_known[rows, :, safe_item] = np.where(active[:, None], sees, now_known[rows, :, safe_item])
+
+            actual[:, step + 1] = next_actual
+            known[:, step + 1] = next_known
+            beliefs[:, step + 1] = np.where(next_known, next_actual[:, None, :], beliefs[:, step])
+
+            movers[:, step] = mover
+            moved_items[:, step] = np.where(active, item, -1)
+            targets[:, step] = np.where(active, target, -1)
+            saw_move[:, step] = sees & active[:, None]
+            saw_at_target[:, step] = found
+
+        return SequenceBatch(self, actual, beliefs, known, movers, moved_items, targets, saw_move, saw_at_target)
@@ -4,6 +4,8 @@ from typing import List, Dict, Union, Callable, Tuple
 from functools import partial
 import random
 from copy import deepcopy
+import time
+from concurrent.futures import TimeoutError
 
 random.seed(0)
 
@@ -11,7 +13,8 @@ from src.madlib.madlib import Madlib
 from src.logic_tree.tree import LogicTree, LogicNode, LogicNodeFactType
 from src.dataset_builder import DatasetBuilder
 from src.model.openai import Model
-from src.validators import StructureValidator, Validator, ForbiddenTextValidator, ModelValidator
+from src.utils.tracing import tracer
+from src.validators import StructureValidator, Validator, ForbiddenTextValidator, ModelValidator, FactPrecheck
 
 # We use this to overwrite the original _base_completion_prompt_intro_ in dataset_builder.py
 # Specifically, this is used when we are creating the means, motive, and opportunity branches for a suspect.
@@ -294,12 +297,17 @@ class MurderMysteryDataset(DatasetBuilder):
             test_completion_prompt: bool = False,
             use_validators: bool = True,
             model_validator_model: Model = None,
-            model_validator_early_escape_model: Model = None
+            model_validator_early_escape_model: Model = None,
+            max_concurrency: int = 4
     ):
         """
         Here we create the trees for each suspect.  A suspects tree will have a means, motive, opportunity, and
         suspicious fact(s) branch.
 
+        The MMO and suspicious fact trees of every suspect are independent, so they are filled in concurrently (up to
+        max_concurrency at a time).  Their templates are still built one after the other in suspect order (building a
+        template uses the global random state), so the trees are the same as building them serially.
+
         :param model: See datasetbuilder
         :param victim_info: Dictionary of sampled items for the victim
         :param suspect_infos: Dictionary of sampled items for the suspects
@@ -318,9 +326,12 @@ class MurderMysteryDataset(DatasetBuilder):
         :param use_validators: See datasetbuilder
         :param model_validator_model: For the model validators, which model should we use (confusing but look at model validator for more info)
         :param model_validator_early_escape_model: For the model validators, which early escape model should we use (confusing but look at model validator for more info)
+        :param max_concurrency: Max # of trees being filled in at once (1 fills them in one after the other).
         """
 
         suspect_trees = []
+        suspects = []
+        jobs = []
 
         victim = victim_info['victim']
         murder_weapon = victim_info['murder_weapon']
@@ -392,8 +403,10 @@ class MurderMysteryDataset(DatasetBuilder):
                         )
                     ])
 
-            # Create a template tree, then fill it out.
-            tree = self.complete_structure(
+            # Create a template tree, then fill it out (below, with the other trees).
+            tree_job = len(jobs)
+            jobs.append(partial(
+                self.complete_structure,
                 self.build_structure(
                     depth=depth,
                     bf_factor=bf_factor,
@@ -412,9 +425,10 @@ class MurderMysteryDataset(DatasetBuilder):
                 test_prompt=test_completion_prompt,
                 validators=validators,
                 use_iterative_complete_v2=use_validators
-            )
+            ))
 
             cf_description = ''
+            sus_job = None
 
             # Create the supsicious facts for a suspect
             if max_num_of_suspicious_facts:
@@ -442,7 +456,9 @@ class MurderMysteryDataset(DatasetBuilder):
 
                 cf_description = f'''{suspect_name} is a {suspect_info["role"]}... and they are super suspicious.'''.strip()
 
-                sus_tree = self.complete_structure(
+                sus_job = len(jobs)
+                jobs.append(partial(
+                    self.complete_structure,
                     self.build_structure(
                         depth=depth,
                         bf_factor=bf_factor,
@@ -464,8 +480,16 @@ class MurderMysteryDataset(DatasetBuilder):
                     test_prompt=test_completion_prompt,
                     validators=validators,
                     use_iterative_complete_v2=use_validators
-                )
-                tree.nodes[0].children.extend(sus_tree.nodes[0].children)
+                ))
+
+            suspects.append((tree_job, sus_job, description, cf_description, suspect_info))
+
+        # Stitch the filled in trees back together in suspect order.
+        trees = self.run_concurrently(jobs, max_concurrency=max_concurrency)
+        for tree_job, sus_job, description, cf_description, suspect_info in suspects:
+            tree = trees[tree_job]
+            if sus_job is not None:
+                tree.nodes[0].children.extend(trees[sus_job].nodes[0].children)
 
             suspect_trees.append({
                 'tree': tree,
@@ -520,20 +544,73 @@ class MurderMysteryDataset(DatasetBuilder):
             model: Model,
             suspect_trees: List[Dict[str, any]],
             facts_only: bool = False,
-            validate_model: Model = None
+            validate_model: Model = None,
+            max_concurrency: int = 4,
+            deadline: float = None,
+            timings: List[Dict[str, any]] = None,
+            fact_precheck: FactPrecheck = None
 
     ) -> List[Dict[str, any]]:
         """
         Often it is too difficult for LLMs to generate stories that include all facts from a list if the list is long.
         Therefore, we generate the story in chapters.
 
+        Every suspect gets a murderer chapter and an innocent chapter.  These are independent, so all of them are
+        written (and validated) concurrently.  The prompts are still made one after the other in suspect order (making
+        a prompt shuffles the facts with the global random state), so the chapters are the same as writing them
+        serially.
+
         :param model: The model used to generate the story.
         :param suspect_trees: The suspect trees (a list of dictionaries that contain a murderer_tree and innocent_tree)
         :param validate_model: Model used to validate that the facts are entailed by the story. (highly encouraged but
             will take a long time)
+        :param max_concurrency: Max # of chapters being written at once (1 writes them one after the other).
+        :param deadline: Seconds the whole call may take.  Once it has passed, chapters stop their validation rounds
+            (keeping what they have).  If a chapter is still not done when it has passed, None is returned (like a
+            badly formatted tree).
+        :param timings: If given, a record per chapter is appended to it: {'suspect', 'chapter' (murderer/innocent),
+            'draft' (seconds for the first draft), 'validation_rounds' (seconds per round), 'hit_deadline', 'total'}.
+        :param fact_precheck: See fact_recall_story_validation.
         """
 
-        # Create a chapter per suspect.
+        start_time = time.time()
+        stop_at = start_time + deadline if deadline is not None else None
+
+        def write_chapter(prompt, tree, suspect, chapter):
+            with tracer.span('chapter', suspect=suspect, chapter=chapter) as span:
+                chapter_start = time.time()
+                output, _ = self.inference(prompt, model)
+                timing = {'draft': time.time() - chapter_start, 'validation_rounds': [], 'hit_deadline': False}
+
+                unsupported = -1
+
+                # Validate that this chapters facts are all entailed. (or at least try to entail them)
+                if validate_model is not None:
+                    for ridx in range(3):
+                        if stop_at is not None and time.time() > stop_at:
+                            timing['hit_deadline'] = True
+                            break
+
+                        round_start = time.time()
+                        with tracer.span('validation round', round=ridx) as round_span:
+                            new_output, new_unsupported = self.fact_recall_story_validation(output, tree, validate_model, fact_precheck=fact_precheck)
+                            round_span.set(unsupported=new_unsupported)
+                        timing['validation_rounds'].append(time.time() - round_start)
+
+                        if output == new_output:
+                            break
+                        elif unsupported == -1 or unsupported >= new_unsupported:
+                            output = new_output
+                            unsupported = new_unsupported
+                        else:
+                            break
+
+                timing['total'] = time.time() - chapter_start
+                span.set(hit_deadline=timing['hit_deadline'])
+            return output, timing
+
+        # Create a chapter per suspect (one for when the suspect is the murderer and one for when they are innocent).
+        jobs = []
         for sidx, s in enumerate(suspect_trees):
             description = s['description']
 
@@ -545,73 +622,49 @@ class MurderMysteryDataset(DatasetBuilder):
 
             innocent_description = '\n'.join(desc)
 
-            # Start by creating a chapter for when the suspect is the murderer.
             # assert len(s['murderer_tree'].nodes[0].children) == 3, 'Bad tree format'
             if len(s['murderer_tree'].nodes[0].children) != 3:
                 print("Boaz add - replace assert with if as I do not know how to fix it. Bad format. Skipping ")
                 return None
-
-            prompt = create_story_prompt__facts_only(description, s['murderer_tree'])
-
-            output, _ = self.inference(prompt, model)
-
-            unsupported = -1
-
-            # Validate that this chapters facts are all entailed. (or at least try to entail them)
-            if validate_model is not None:
-                for _ in range(3):
-                    new_output, new_unsupported = self.fact_recall_story_validation(output, s['murderer_tree'], validate_model)
-
-                    if output == new_output:
-                        break
-                    elif unsupported == -1 or unsupported >= new_unsupported:
-                        output = new_output
-                        unsupported = new_unsupported
-                    else:
-                        break
-
-            suspect_trees[sidx]['murderer_chapter'] = output
-
-            # Repeat but create an innocent chapter.
             assert len(s['innocent_tree'].nodes[0].children) == 3, 'Bad tree format'
-            prompt = create_story_prompt__facts_only(innocent_description, s['innocent_tree'])
 
-            output, _ = self.inference(prompt, model)
-            unsupported = -1
+            suspect = s['suspect_info']['suspect']
+            jobs.append(partial(write_chapter, create_story_prompt__facts_only(description, s['murderer_tree']), s['murderer_tree'], suspect, 'murderer'))
+            jobs.append(partial(write_chapter, create_story_prompt__facts_only(innocent_description, s['innocent_tree']), s['innocent_tree'], suspect, 'innocent'))
 
-            if validate_model is not None:
-                for _ in range(3):
-                    new_output, new_unsupported = self.fact_recall_story_validation(output, s['innocent_tree'], validate_model)
+        try:
+            chapters = self.run_concurrently(
+                jobs, max_concurrency=max_concurrency, timeout=max(0., stop_at - time.time()) if stop_at is not None else None
+            )
+        except TimeoutError as e:
+            print(f"ERROR: Chapters were not written before the deadline ({deadline} seconds). Skipping. {e}")
+            return None
 
-                    if output == new_output:
-                        break
-                    elif unsupported == -1 or unsupported >= new_unsupported:
-                        output = new_output
-                        unsupported = new_unsupported
-                    else:
-                        break
+        for sidx, s in enumerate(suspect_trees):
+            for cidx, chapter in enumerate(['murderer', 'innocent']):
+                output, timing = chapters[2 * sidx + cidx]
+                suspect_trees[sidx][f'{chapter}_chapter'] = output
 
-            suspect_trees[sidx]['innocent_chapter'] = output
+                if timings is not None:
+                    timings.append({'suspect': s['suspect_info']['suspect'], 'chapter': chapter, **timing})
 
         return suspect_trees
 
-    def fact_recall_story_validation(
+    def recall_facts(
             self,
             ctx: str,
-            tree: LogicTree,
+            facts: List[str],
             model: Model
-    ):
+    ) -> Tuple[List[str], List[str]]:
         """
-        Given some story/chapter/context ensure that all the facts from the tree are entailed by the context.
-
-        Entailment is checked via an LLM and prompt.
+        Ask an LLM which of the facts are supported by some story/chapter/context.
 
-        :param ctx: Context that should entail all the facts from the tre.
-        :param tree: Tree used to create the context.
+        :param ctx: Context that should entail all the facts.
+        :param facts: The facts to check.
         :param model: Model to run the entailment check on.
+        :return: The unsupported facts and the models reason for each of them.
         """
 
-        facts = list(sorted(list(set([x.value for x in tree.get_facts()]))))
         facts_str = "\n".join([f'{fidx+1} - {x}' for fidx, x in enumerate(facts)])
 
         unsupported = []
@@ -628,7 +681,8 @@ Here are the facts:
 
 Are the facts supported by the given story?  Answer in this format: "Fact Answer - (Fact idx): (your step-by-step reasoning), ANSWER: Yes" or "ANSWER: No"
         '''.strip()
-        output, _ = self.inference(prompt, model, temperature=0.0)
+        with tracer.span('recall', facts=len(facts)) as span:
+            output, _ = self.inference(prompt, model, temperature=0.0)
 
         pbar.set_description(f'Validating each fact is supported in the story | cost = {model.total_cost - curr_cost:.2f}')
 
@@ -643,6 +697,38 @@ Are the facts supported by the given story?  Answer in this format: "Fact Answer
                 unsupported.append(f)
                 unsupported_reasons.append(l)
 
+        span.set(unsupported=len(unsupported))
+        return unsupported, unsupported_reasons
+
+    def fact_recall_story_validation(
+            self,
+            ctx: str,
+            tree: LogicTree,
+            model: Model,
+            fact_precheck: FactPrecheck = None
+    ):
+        """
+        Given some story/chapter/context ensure that all the facts from the tree are entailed by the context.
+
+        Entailment is checked via an LLM and prompt.
+
+        :param ctx: Context that should entail all the facts from the tre.
+        :param tree: Tree used to create the context.
+        :param model: Model to run the entailment check on.
+        :param fact_precheck: If given, facts it finds clearly stated in the context are not sent to the model.
+        """
+
+        facts = list(sorted(list(set([x.value for x in tree.get_facts()]))))
+
+        uncertain_facts = facts
+        if fact_precheck is not None:
+            _, uncertain_facts = fact_precheck.split(facts, ctx)
+            tracer.annotate(prechecked=len(facts) - len(uncertain_facts))
+            if len(uncertain_facts) == 0:
+                return ctx, 0
+
+        unsupported, unsupported_reasons = self.recall_facts(ctx, uncertain_facts, model)
+
         if len(unsupported) == 0:
             return ctx, len(unsupported)
 
@@ -674,5 +760,6 @@ For example, if the story was "Bob is a cat.  I like cool things" and the missin
 Output:
         '''
 
-        new_ctx, _ = self.inference(new_story_prompt, model, temperature=0.0)
+        with tracer.span('rewrite', unsupported=len(unsupported)):
+            new_ctx, _ = self.inference(new_story_prompt, model, temperature=0.0)
         return new_ctx, len(unsupported)
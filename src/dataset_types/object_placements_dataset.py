@@ -205,6 +205,165 @@ class ObjectPlacementsDataset(DatasetBuilder):
 
         return events, beliefs, actual_locs, event_structure
 
+    def create_sequence_from_moves(
+            self,
+            moves: List[Tuple[str, str, str]],
+            items: List[str],
+            locs: List[str],
+            people: List[str],
+            max_sequence_length: int = 10,
+            chance_subject_sees: float = 0.25,
+            max_location_use_per_item: int = 2,
+            initial_starting_positions: List[Tuple[str, str]] = None
+    ):
+        """
+        Constrained version of create_sequence_v2 for a known list of moves (the ones GPT4 proposed).  Instead of
+        simulating random sequences until one starts with the gold moves, the movers, items and locations are taken
+        from the moves and only the free choices (who sees each move) are sampled.
+
+        A move is only valid if the mover knows where the item is, the item isn't already at the location and the
+        item hasn't used up the location (max_location_use_per_item).  When a later move depends on someone seeing
+        an earlier one (the next mover of an item has to know where it is) that person is made to see it, everyone
+        else sees the move with chance_subject_sees.
+
+        The outputs have the same structure as create_sequence_v2 (one event per move).
+
+        :param moves: (mover, item, location) of every move, in order.  Names are matched case insensitively against
+            people, items and locs.
+        :param items: List of items people can move
+        :param locs: List of locations someone can move items to.
+        :param people: List of people who can move stuff
+        :param max_sequence_length: Max # of moves (moves past this are ignored)
+        :param chance_subject_sees: Chance for someone (who is not the mover) to see the item move.
+        :param max_location_use_per_item: # of times an item can move.
+        :param initial_starting_positions: Where the items are currently.
+        :raises Exception: If the moves can't happen (unknown names or a move breaking one of the rules above).
+        """
+
+        def respect_article(item, people):
+            if any([item.startswith(name) for name in people]):
+                return item
+            return f'the {item}'
+
+        def resolve(name, options, kind):
+            for x in options:
+                if x.lower() == name.lower():
+                    return x
+            raise Exception(f'Move {midx + 1} uses an unknown {kind}: {name}')
+
+        alive_locs_per_item = {item: deepcopy(locs) for item in items}
+
+        if initial_starting_positions is not None:
+            items_to_locations = {
+                item: loc for (item, loc) in initial_starting_positions
+            }
+            for item in items:
+                if item in list(items_to_locations.keys()):
+                    continue
+                else:
+                    items_to_locations[item] = random.sample(locs, 1)[0]
+
+            items = list(items_to_locations.keys())
+
+        else:
+            items_to_locations = {
+                item: loc for item, loc in zip(items, [random.sample(locs, 1)[0] for _ in range(len(items))])
+            }
+
+        resolved_moves = []
+        for midx, (mover, item, location) in enumerate(moves[:max_sequence_length]):
+            resolved_moves.append((resolve(mover, people, 'person'), resolve(item, items, 'item'), resolve(location, locs, 'location')))
+        moves = resolved_moves
+
+        # Who has to see each move so that the next mover of the same item knows where it is.  They don't have to if
+        # they moved it there themselves or if they'll see it when moving something else to the same spot first.
+        must_see = [set() for _ in moves]
+        for midx, (mover, item, location) in enumerate(moves):
+            for nidx in range(midx + 1, len(moves)):
+                if moves[nidx][1] != item:
+                    continue
+                next_mover = moves[nidx][0]
+                if next_mover != mover and not any([m == next_mover and l == location for (m, _, l) in moves[midx + 1:nidx]]):
+                    must_see[midx].add(next_mover)
+                break
+
+        items_to_people_info = {
+            item: {name: {'known_location': True} for name in people} for item in items
+        }
+        location_histories = {item: {loc: 0 for loc in locs} for item in items}
+
+        events = [
+            [f'{n} sees {respect_article(i, people)} at {respect_article(l, people)}.' for n in people for (i, l) in items_to_locations.items()]
+        ]
+        beliefs = [
+            {n: {i: l for (i, l) in items_to_locations.items()} for n in people}
+        ]
+        actual_locs = [deepcopy(items_to_locations)]
+        event_structure = [
+            {
+                'event': 'opening scene',
+                'immutable_sequence': events[0],
+                'sequence': []
+            }
+        ]
+
+        for midx, (mover, item, location) in enumerate(moves):
+            if not items_to_people_info[item][mover]['known_location']:
+                raise Exception(f'Move {midx + 1}: {mover} does not know where {item} is.')
+            if items_to_locations[item] == location:
+                raise Exception(f'Move {midx + 1}: {item} is already at {location}.')
+            if location not in alive_locs_per_item[item]:
+                raise Exception(f'Move {midx + 1}: {item} was already moved to {location} {max_location_use_per_item} times.')
+
+            updates = []
+            structure = {
+                'event': '',
+                'immutable_sequence': [],
+                'sequence': []
+            }
+
+            # Mover updates
+            _update = f'{mover} moves {respect_article(item, people)} to {respect_article(location, people)}.'
+            updates.append(_update)
+            structure['event'] = _update
+
+            # The mover now has seen any items at the current spot.
+            for i in [x for x in items if items_to_locations[x] == location and not items_to_people_info[x][mover]['known_location']]:
+                items_to_people_info[i][mover]['known_location'] = True
+                _update = f'{mover} saw {respect_article(i, people)} at {respect_article(location, people)} when moving {respect_article(item, people)}.'
+                structure['immutable_sequence'].append(_update)
+                updates.append(_update)
+
+            items_to_locations[item] = location
+            location_histories[item][location] += 1
+
+            if location_histories[item][location] == max_location_use_per_item:
+                alive_locs_per_item[item].remove(location)
+
+            for subject in [x for x in people if x != mover]:
+                sees_update = random.random() < chance_subject_sees or subject in must_see[midx]
+
+                if sees_update:
+                    items_to_people_info[item][subject]['known_location'] = True
+                    _update = f'{subject} saw {respect_article(item, people)} move to {respect_article(location, people)}.'
+                    updates.append(_update)
+                    structure['sequence'].append(_update)
+                else:
+                    items_to_people_info[item][subject]['known_location'] = False
+                    _update = f'{subject} did not see {respect_article(item, people)} move to {respect_article(location, people)}.'
+                    updates.append(_update)
+                    structure['sequence'].append(_update)
+
+            event_structure.append(structure)
+
+            beliefs.append({
+                name: {item: items_to_locations[item] if items_to_people_info[item][name]['known_location'] else beliefs[-1][name][item] for item in items} for name in people
+            })
+            actual_locs.append(deepcopy(items_to_locations))
+            events.append(updates)
+
+        return events, beliefs, actual_locs, event_structure
+
     def generate_end_questions(
             self,
             ending_beliefs: Dict[str, Dict[str, str]],
@@ -4,11 +4,14 @@ from functools import partial
 import random
 from copy import deepcopy
 
+import numpy as np
+
 random.seed(0)
 
 from src.madlib.madlib import Madlib
 from src.logic_tree.tree import LogicTree, LogicNode, LogicNodeFactType
 from src.dataset_builder import DatasetBuilder
+from src.dataset_types.assignment_engine import AssignmentEngine
 from src.model.openai import OpenAIModel
 from src.validators import StructureValidator, ForbiddenTextValidator
 
@@ -68,6 +71,9 @@ class TeamAllocationDataset(DatasetBuilder):
 
         Note: we don't need to know the skills here yet (they're just skill 1 and 2 for now)
 
+        Scoring is done by AssignmentEngine (src/dataset_types/assignment_engine.py) which handles any number of people
+        and tasks if you want to build harder variants.
+
         :param people: List of names for people
         """
 
@@ -81,51 +87,18 @@ class TeamAllocationDataset(DatasetBuilder):
                 return x
             return random.sample([BAD, OKAY, GOOD][x:y], 1)[0]
 
-        best_pair = [[people[0]], list(sorted([people[1], people[2]]))]
+        # people[0] works alone on the first skill, the other two work together on the second.
+        engine = AssignmentEngine(n_people=3, task_sizes=[1, 2])
+        gold = engine.index([0, 1, 1])
+        best_pair = engine.groups(gold, people)
 
         paired_score = asgn()
-        people_levels = {
-            people[0]: {'skills': [asgn(), BAD], 'cooperation': [N, BAD, BAD]},
-            people[1]: {'skills': [BAD, asgn()], 'cooperation': [BAD, N, paired_score]},
-            people[2]: {'skills': [BAD, asgn()], 'cooperation': [BAD, paired_score, N]},
-        }
-
-        def score(pair):
-            pair_sum = 0
-            pair_sum += people_levels[pair[0][0]]['skills'][0]
-            pair_sum += sum([people_levels[pair[1][0]]['skills'][1], people_levels[pair[1][1]]['skills'][1]])
-            pair_sum += people_levels[pair[1][0]]['cooperation'][people.index(pair[1][1])]
-
-            return pair_sum
-
-        def score_pairs(pairs):
-            gold_pair = None
-            scored_pairs = []
-            for p in pairs:
-                s = score(p)
-                if p == best_pair:
-                    gold_pair = [s, p]
-                    continue
-                scored_pairs.append([s, p])
-
-
-            return [gold_pair, *scored_pairs]
-
-        def gen_pairs():
-            pairs = []
-            for i in people:
-                for j in people:
-                    for x in people:
-                        if len(list(set([i, j, x]))) != 3:
-                            continue
-                        p = [[i], list(sorted([j, x]))]
-                        if p in pairs:
-                            continue
-                        pairs.append(p)
-            return pairs
-
-        scored_pairs = score_pairs(gen_pairs())
-        delta = scored_pairs[0][0] - max([x[0] for x in scored_pairs[1:]])
+        state = engine.state(
+            skills=[[asgn(), BAD], [BAD, asgn()], [BAD, asgn()]],
+            cooperation=[[N, BAD, BAD], [BAD, N, paired_score], [BAD, paired_score, N]],
+            gold=gold
+        )
+        delta = state.margin
 
         max_updates = 10
         update_idx = 0
@@ -136,27 +109,117 @@ class TeamAllocationDataset(DatasetBuilder):
             update_idx += 1
 
             # max_allowed_assignment = min(3, delta-1)
-            second_best = list(sorted(scored_pairs[1:], key=lambda x: x[0]))[0][1]
+            second_best = engine.groups(state.worst_other(), people)
+            alone = people.index(second_best[0][0])
 
             group = 1 if random.random() > 0.75 else 0
             if group == 0:
-                people_levels[second_best[0][0]]['skills'][0] = asgn(x=people_levels[second_best[0][0]]['skills'][0])  # Chance at a better skill level.
+                param = engine.skill_index(alone, 0)  # Chance at a better skill level.
             else:
                 inc = 1 if random.random() > 0.66 else 0
                 if inc == 0:
                     person = random.sample(second_best[1], 1)[0]
-                    people_levels[person]['skills'][1] = asgn(x=people_levels[person]['skills'][1])
+                    param = engine.skill_index(people.index(person), 1)
                 else:
-                    people_levels[second_best[1][0]]['cooperation'][people.index(second_best[0][0])] = asgn(x=people_levels[second_best[1][0]]['cooperation'][people.index(second_best[0][0])])
-                    people_levels[second_best[0][0]]['cooperation'][people.index(second_best[1][0])] = people_levels[second_best[0][0]]['cooperation'][people.index(second_best[1][0])]
+                    param = engine.cooperation_index(people.index(second_best[1][0]), alone)
+            state.set(param, asgn(x=int(state.theta[param])))
 
-            scored_pairs = score_pairs(gen_pairs())
-            delta = scored_pairs[0][0] - max([x[0] for x in scored_pairs[1:]])
+            delta = state.margin
 
             # This should never happen (meaning that there is an assignment better than the gold).  But it's here just
             # in case.
             assert delta > 0, 'WRONG!'
-        return people_levels, best_pair, [x[1] for x in scored_pairs]
+        return state.people_levels(people), best_pair, [engine.groups(x, people) for x in [gold, *[x for x in range(engine.n_assignments) if x != gold]]]
+
+    def build_assignments_batch(
+            self,
+            n_samples: int,
+            seed: int = None,
+            max_updates: int = 10,
+            stop_margin: int = 2,
+            chunk_size: int = 1_000_000
+    ) -> Dict[str, np.ndarray]:
+        """
+        Vectorized build_assignment for many matrices at once, to study how hard the generated assignments are (the
+        margin between the gold and the next best assignment) before spending anything on the LLM.
+
+        Draws follow the same distribution as build_assignment (with numpy's generator instead of random).  Without
+        names, the "first" person of a pair is the one with the lower index.
+
+        :param n_samples: How many matrices to sample (0 gives empty arrays).
+        :param seed: Seed for numpy's random generator.
+        :param max_updates: Max # of perturbations per matrix (build_assignment uses 10)
+        :param stop_margin: Matrices are perturbed while the gold wins by more than this (build_assignment uses 2)
+        :param chunk_size: Matrices simulated at a time (bounds memory).
+        :return: Dict of arrays over the samples: "skills" (n, 3, 2), "cooperation" (n, 3, 3), "gold" (n,) row of the
+            gold assignment in AssignmentEngine(3, [1, 2]), "initial_margins" (n,), "margins" (n,), "updates" (n,).
+        """
+        assert n_samples >= 0, f'n_samples must be 0 or more, got {n_samples}.'
+        rng = np.random.default_rng(seed)
+        engine = AssignmentEngine(n_people=3, task_sizes=[1, 2])
+        gold = engine.index([0, 1, 1])
+
+        chunks = []
+        # n_samples=0 still runs one (empty) chunk, so the arrays come back empty with the right shapes.
+        for start in range(0, max(n_samples, 1), chunk_size):
+            n = min(chunk_size, n_samples - start)
+            rows = np.arange(n)
+
+            def asgn(x):
+                # Same as asgn() in build_assignment: a level strictly above x (1 is BAD, 3 is GOOD), 3 stays 3.
+                return np.where(x >= 3, 3, x + 1 + np.floor(rng.random(x.shape) * (3 - x)).astype(x.dtype))
+
+            paired_score = asgn(np.zeros(n, dtype=np.int32))
+            skills = np.ones((n, 3, 2), dtype=np.int32)
+            skills[:, 0, 0], skills[:, 1, 1], skills[:, 2, 1] = asgn(np.zeros((3, n), dtype=np.int32))
+            cooperation = np.ones((n, 3, 3), dtype=np.int32)
+            cooperation[:, 1, 2] = cooperation[:, 2, 1] = paired_score
+
+            theta = engine.params(skills, cooperation)
+            scores = engine.scores(theta)
+            initial_margins = engine.margins(scores, gold)
+            margins = initial_margins.copy()
+            updates = np.zeros(n, dtype=np.int32)
+
+            for _ in range(max_updates):
+                active = margins > stop_margin
+                if not active.any():
+                    break
+                updates += active
+
+                others = scores.copy()
+                others[:, gold] = np.iinfo(others.dtype).max
+                second_best = engine.assignments[others.argmin(-1)]
+                alone = second_best.argmin(-1)
+                pair = np.sort(np.argsort(second_best, -1, kind='stable')[:, 1:], -1)
+
+                group = (rng.random(n) > 0.75).astype(int)
+                inc = (rng.random(n) > 0.66).astype(int)
+                member = pair[rows, rng.integers(0, 2, n)]
+
+                param = np.where(
+                    group == 0,
+                    alone * engine.n_tasks,
+                    np.where(inc == 0, member * engine.n_tasks + 1, engine.cooperation_index(pair[:, 0], alone))
+                )
+                new_values = np.where(active, asgn(theta[rows, param]), theta[rows, param])
+                scores += (new_values - theta[rows, param])[:, None] * engine.design[:, param].T
+                theta[rows, param] = new_values
+                margins = engine.margins(scores, gold)
+
+            # Same check as build_assignment (only perturbed matrices are checked there as well).
+            assert (margins[updates > 0] > 0).all(), 'WRONG!'
+            skills, cooperation = engine.matrices(theta)
+            chunks.append({
+                'skills': skills,
+                'cooperation': cooperation,
+                'gold': np.full(n, gold),
+                'initial_margins': initial_margins,
+                'margins': margins,
+                'updates': updates
+            })
+
+        return {k: np.concatenate([c[k] for c in chunks]) for k in chunks[0].keys()}
 
     def create_facts(self, people_levels, people, skills):
         """
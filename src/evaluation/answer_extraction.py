@@ -0,0 +1,181 @@
+"""
+Find which answer choice a model output picks.
+
+The eval prompts ask the model to end with "ANSWER: (your answer here, including the choice number)".  extract_answer()
+looks for the last "answer:" line that names a choice, scanning the output from the end (a window at a time, so long
+reasoning outputs are not lowercased and split line by line), and matches choice numbers and choice texts exactly
+("10" is not choice 1, "Ana" is not "Anabel").
+
+When no single choice is found, the result says why:
+
+- no_answer: there is no "answer:" line naming a choice,
+- ambiguous: the last answer line names more than one choice,
+- truncated: no answer line at all and the output looks cut off (an unclosed <think> block or no closing punctuation).
+
+The eval falls back to a random choice for all of these (like it always has); the granite converter can use the status
+to drop those outputs from distillation data without running the eval again.
+
+Example:
+
+    answer = extract_answer(output, ['Mackenzie', 'Ana'])
+    if answer.status == AnswerStatus.OK:
+        print(answer.choice)  # 1 based, like the eval's gold answers
+"""
+
+import re
+from enum import Enum
+from typing import List, Optional, Tuple
+
+__answer_pattern__ = re.compile(r'answer[ \t]*:', re.IGNORECASE)
+__number_pattern__ = re.compile(r'(?<![\d.])(\d+)(?![\d]|\.\d)')
+__choice_line_pattern__ = re.compile(r'^(\d+) - (.+)$', re.MULTILINE)
+
+# Characters a finished output usually ends with.
+__closing_chars__ = set('.!?)]}"\'*`>')
+
+__initial_window__ = 4096
+# Windows overlap by this much so an "answer:" split between two of them is still found.
+__window_overlap__ = 32
+
+
+class AnswerStatus(Enum):
+    OK = 'ok'
+    NO_ANSWER = 'no_answer'
+    AMBIGUOUS = 'ambiguous'
+    TRUNCATED = 'truncated'
+
+
+class ExtractedAnswer:
+    def __init__(self, choice: Optional[int], status: AnswerStatus, text: str = None):
+        """
+        :param choice: The picked choice (1 based) or None.
+        :param status: AnswerStatus.OK when a single choice was found, otherwise why not.
+        :param text: The answer line that decided it (what follows "answer:").
+        """
+        self.choice = choice
+        self.status = status
+        self.text = text
+
+    def __repr__(self):
+        return f'ExtractedAnswer(choice={self.choice}, status={self.status.value}, text={self.text!r})'
+
+
+def choice_spans(lowered: str, choices: List[str]) -> List[Tuple[int, int, int]]:
+    """(start, end, choice) of every exact occurrence of a choice text in a lowercased answer line."""
+    spans = []
+    for idx, choice in enumerate(choices):
+        choice = str(choice).strip().lower()
+        if choice:
+            spans.extend([(m.start(), m.end(), idx + 1) for m in re.finditer(r'(?<!\w)' + re.escape(choice) + r'(?!\w)', lowered)])
+    return spans
+
+
+def longest_spans(spans: List[Tuple[int, int, int]]) -> List[Tuple[int, int, int]]:
+    """The longest spans that do not overlap ("kitchen drawer" wins over the "kitchen" inside it)."""
+    kept = []
+    for span in sorted(spans, key=lambda x: (x[0] - x[1], x[0])):
+        if all([span[1] <= k[0] or span[0] >= k[1] for k in kept]):
+            kept.append(span)
+    return kept
+
+
+def match_choices(text: str, choices: List[str]) -> List[int]:
+    """
+    The (1 based) choices an answer line names, by number or by their exact text.
+
+    Choice texts can contain each other (a "kitchen" and a "kitchen drawer"), so only the longest non-overlapping text
+    matches count, and when the line names exactly one choice number, text matches of that choice or of a choice whose
+    text is part of its text ("2 - kitchen drawer") agree with the number instead of making the answer ambiguous.
+    """
+    numbers = sorted({int(x) for x in __number_pattern__.findall(text) if 1 <= int(x) <= len(choices)})
+    texted = {choice for _, _, choice in longest_spans(choice_spans(text.lower(), choices))}
+
+    if len(numbers) == 1:
+        picked = str(choices[numbers[0] - 1]).strip().lower()
+        texted = {x for x in texted if str(choices[x - 1]).strip().lower() not in picked}
+
+    return sorted(set(numbers) | texted)
+
+
+def looks_truncated(output: str) -> bool:
+    if '<think>' in output and '</think>' not in output:
+        return True
+    stripped = output.rstrip()
+    return len(stripped) > 0 and stripped[-1] not in __closing_chars__
+
+
+def extract_answer(output: str, choices: List[str]) -> ExtractedAnswer:
+    """
+    :param output: The model output.
+    :param choices: The answer choices of the question (in prompt order).
+    """
+    if not output:
+        return ExtractedAnswer(None, AnswerStatus.NO_ANSWER)
+
+    # Look at a growing window at the end of the output, the answer is almost always in the last few lines.
+    saw_answer_line = False
+    end = len(output)
+    window = __initial_window__
+    while True:
+        start = max(0, end - window)
+
+        for m in reversed(list(__answer_pattern__.finditer(output, start, min(len(output), end + __window_overlap__)))):
+            if m.start() >= end:
+                # Already seen in the previous window.
+                continue
+            line_end = output.find('\n', m.end())
+            text = output[m.end():line_end if line_end >= 0 else len(output)].strip()
+            if not text:
+                continue
+            saw_answer_line = True
+
+            matched = match_choices(text, choices)
+            if len(matched) == 1:
+                return ExtractedAnswer(matched[0], AnswerStatus.OK, text)
+            if len(matched) > 1:
+                return ExtractedAnswer(None, AnswerStatus.AMBIGUOUS, text)
+
+        if start == 0:
+            break
+        end = start
+        window *= 2
+
+    if not saw_answer_line and looks_truncated(output):
+        return ExtractedAnswer(None, AnswerStatus.TRUNCATED)
+    return ExtractedAnswer(None, AnswerStatus.NO_ANSWER)
+
+
+def choices_from_prompt(prompt: str) -> List[str]:
+    """
+    The answer choices of an eval prompt (the last "1 - ...", "2 - ...", ... block, see format_choices()), for outputs
+    that were saved without their question.
+    """
+    choices = []
+    for m in __choice_line_pattern__.finditer(prompt):
+        number, text = int(m.group(1)), m.group(2).strip()
+        if number == 1:
+            choices = [text]
+        elif number == len(choices) + 1:
+            choices.append(text)
+    return choices
+
+
+if __name__ == "__main__":
+    # Regression cases (run this file to check them).
+
+    # Choice texts nested in each other: the choice number decides, the longest text match wins without one.
+    locations = ['kitchen', 'kitchen drawer', 'garage']
+    assert extract_answer('Reasoning...\nANSWER: 2 - kitchen drawer', locations).choice == 2
+    assert extract_answer('ANSWER: 1 - kitchen', locations).choice == 1
+    assert extract_answer('ANSWER: the kitchen drawer', locations).choice == 2
+    assert extract_answer('ANSWER: kitchen', locations).choice == 1
+    assert extract_answer('ANSWER: 2 - the garage', locations).status == AnswerStatus.AMBIGUOUS
+    assert extract_answer('ANSWER: kitchen or garage', locations).status == AnswerStatus.AMBIGUOUS
+
+    # Exact matches only.
+    assert extract_answer('ANSWER: 10', ['Mackenzie', 'Ana']).status == AnswerStatus.NO_ANSWER
+    assert extract_answer('ANSWER: Anabel', ['Mackenzie', 'Ana']).status == AnswerStatus.NO_ANSWER
+    assert extract_answer('ANSWER: 2 - Ana', ['Mackenzie', 'Ana']).choice == 2
+
+    assert extract_answer('<think> Mackenzie had the motive, but', ['Mackenzie', 'Ana']).status == AnswerStatus.TRUNCATED
+    print('ok')
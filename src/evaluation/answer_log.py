@@ -0,0 +1,135 @@
+"""
+Crash safe, incremental storage of eval answers.
+
+Every scored model answer is appended to a jsonl file as its own record (and flushed) the moment it is scored, so a
+crash only loses the calls that were still in flight.  When the eval is started again with the same answer log, the
+answers already in it are reused instead of asking the model again; they go through the exact same scoring, so the
+results (and the random fallback draws for unparsable answers) are identical to an uninterrupted run.
+
+A record is the raw answer the eval has always kept in run_data (qidx, qhash, prompt, output, model_parsed_answer,
+trees, data, randomly_selected, gold_answer, correct) plus where it belongs:
+
+    {"model": ..., "dataset": ..., "ablation": ..., "eidx": 0, "sample_idx": 0, "prompt_hash": ..., "vote": "2", ...}
+
+compact_answer_log() turns a log back into the legacy run_data json (see eval/compact_answers.py).
+"""
+
+import collections
+import json
+from pathlib import Path
+from typing import Any, Dict, Tuple
+
+from src.utils.hashing import stable_hash
+
+RecordKey = Tuple[str, str, str, str, int, int, str]
+
+LOCATION_KEYS = ['model', 'dataset', 'ablation', 'eidx', 'sample_idx', 'prompt_hash', 'vote']
+
+
+def prompt_hash(prompt: str) -> str:
+    """Id of the exact prompt sent to the model."""
+    return stable_hash(prompt, length=32)
+
+
+def record_key(model: str, dataset: str, ablation: str, qhash: str, qidx: int, sample_idx: int, prompt_hash: str) -> RecordKey:
+    """
+    What identifies an answer across runs.  The prompt hash is part of it because the contrastive versions of a murder
+    mystery share their qhash (story_hash_id), and so that editing a prompt never reuses stale answers.
+    """
+    return model, dataset, ablation, str(qhash), qidx, sample_idx, prompt_hash
+
+
+class AnswerLog:
+    """
+    Append only jsonl log of the scored answers of an eval.
+    """
+
+    def __init__(self, file: Path):
+        """
+        :param file: Path of the log, the answers already in it are loaded (a truncated last line from a crash is
+            ignored).
+        """
+        self.file = Path(file)
+        self.answers: Dict[RecordKey, Dict[str, Any]] = {}
+
+        if self.file.exists():
+            with self.file.open('r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.answers[self.key(record)] = record
+
+        self.file.parent.mkdir(exist_ok=True, parents=True)
+        self.__handle__ = self.file.open('a')
+
+    @staticmethod
+    def key(record: Dict[str, Any]) -> RecordKey:
+        return record_key(record['model'], record['dataset'], record['ablation'], record['qhash'], record['qidx'], record['sample_idx'], record['prompt_hash'])
+
+    def get(self, key: RecordKey) -> Dict[str, Any]:
+        """The logged answer for key, None if it was never answered."""
+        return self.answers.get(key)
+
+    def write(self, record: Dict[str, Any]):
+        """Append (and flush) one answer unless it is already in the log."""
+        key = self.key(record)
+        if key in self.answers:
+            return
+        self.answers[key] = record
+        self.__handle__.write(json.dumps(record) + '\n')
+        self.__handle__.flush()
+
+    def close(self):
+        self.__handle__.close()
+
+
+def compact_answer_log(file: Path) -> Dict[str, Any]:
+    """
+    Rebuild the legacy run_data structure ({model: {dataset: {ablation: {examples, correct, total}}}}) from an answer
+    log, voting over the self-consistency samples of each question the same way the eval does.
+
+    NOTE: Examples none of whose questions were answered (i.e. ablated prompts without trees) have no records, so they
+    do not get the empty entry the eval gives them in "examples".
+
+    :param file: Path to the answer log.
+    """
+    grouped = collections.OrderedDict()
+    with Path(file).open('r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            ablation = grouped.setdefault((record['model'], record['dataset'], record['ablation']), {})
+            question = ablation.setdefault(record['eidx'], collections.OrderedDict()).setdefault(record['qidx'], {})
+            question[record['sample_idx']] = record
+
+    run_data = {}
+    for (model_name, dataset_name, ablation_name), examples in grouped.items():
+        correct = 0
+        total = 0
+        answered_examples = []
+
+        for eidx in sorted(examples.keys()):
+            answered_questions = []
+            for qidx, samples in examples[eidx].items():
+                raw_answers = [{k: v for k, v in samples[i].items() if k not in LOCATION_KEYS} for i in sorted(samples.keys())]
+                answer_outs = [samples[i]['vote'] for i in sorted(samples.keys())]
+
+                most_common = collections.Counter(answer_outs).most_common()[0][0]
+                if most_common == str(raw_answers[0]['gold_answer']):
+                    correct += 1
+                    answered_questions.append([x for x in raw_answers if x['correct']][0])
+                else:
+                    answered_questions.append([x for x in raw_answers if not x['correct'] and x['model_parsed_answer'] is not None])
+                total += 1
+            answered_examples.append(answered_questions)
+
+        run_data.setdefault(model_name, {}).setdefault(dataset_name, {})[ablation_name] = {
+            'examples': answered_examples,
+            'correct': correct,
+            'total': total
+        }
+    return run_data
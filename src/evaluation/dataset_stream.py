@@ -0,0 +1,195 @@
+"""
+Lazy access to the eval datasets.
+
+The eval scripts used to json.load() a dataset file, shuffle it and keep the whole thing (stories, questions and every
+reasoning tree) in memory for the length of the run.  DatasetStream instead indexes where each example lives in the file
+(one scan, see src/utils/json_stream.py) and parses an example only when it is used.  The reasoning trees are usually
+the bulk of an example and most prompt styles never look at them, so they are cut out before parsing unless asked for.
+
+Sampling (shuffle, contrastive filtering, offset and sample_size) happens over the example indices, in the same order as
+the old eager code, so with the same random state you get exactly the same examples.
+
+A stream keeps the file open (and mapped) until it is closed, use it as a context manager or close() it (closing a
+sample closes its stream).
+
+Example:
+
+    with DatasetStream(Path('murder_mysteries.json')) as stream:
+        dataset = stream.sample(randomize=True, offset=0, sample_size=50, exclude_contrastive_examples=True)
+
+        for example in dataset:
+            ...
+"""
+
+import hashlib
+import json
+import mmap
+import random
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Tuple
+
+from src.utils.json_stream import iter_value_spans
+
+TREES_KEY_PATH = ('questions', '*', 'intermediate_trees')
+
+
+class DatasetStream:
+    """
+    Random access to the examples of a dataset file, either a json list of examples (what the dataset scripts write) or a
+    jsonl file with one example per line.
+    """
+
+    def __init__(self, file: Path):
+        """
+        :param file: Path to the dataset.
+        """
+        self.file = Path(file)
+
+        self.__file_handle__ = self.file.open('rb')
+        if self.file.stat().st_size == 0:
+            self.buffer = b''
+        else:
+            self.buffer = mmap.mmap(self.__file_handle__.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.file.suffix == '.jsonl':
+            self.spans = self.__index_lines__()
+        else:
+            self.spans = [(start, end) for _, start, end in iter_value_spans(self.buffer, [('*',)])]
+
+    def __len__(self):
+        return len(self.spans)
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.__file_handle__.close()
+
+    def __enter__(self) -> 'DatasetStream':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __index_lines__(self) -> List[Tuple[int, int]]:
+        spans = []
+        start = 0
+        while start < len(self.buffer):
+            end = self.buffer.find(b'\n', start)
+            end = len(self.buffer) if end == -1 else end
+            if self.buffer[start:end].strip():
+                spans.append((start, end))
+            start = end + 1
+        return spans
+
+    def example_id(self, idx: int) -> str:
+        """Content addressed id of an example (the same example has the same id in any file, at any position)."""
+        start, end = self.spans[idx]
+        return hashlib.sha256(self.buffer[start:end]).hexdigest()[:32]
+
+    def example(self, idx: int, load_trees: bool = True) -> Dict[str, Any]:
+        """
+        Parse one example.
+
+        :param idx: Index of the example in the file.
+        :param load_trees: Parse the questions' intermediate_trees.  When False the key is left out of the questions
+            entirely (the trees are skipped over in the raw bytes, never parsed).
+        """
+        start, end = self.spans[idx]
+        raw = self.buffer[start:end]
+
+        if load_trees:
+            return json.loads(raw)
+
+        pieces = []
+        last = 0
+        for _, tree_start, tree_end in iter_value_spans(raw, [TREES_KEY_PATH]):
+            pieces.extend([raw[last:tree_start], b'null'])
+            last = tree_end
+        pieces.append(raw[last:])
+
+        example = json.loads(b''.join(pieces))
+        for question in example.get('questions', []):
+            if question.get('intermediate_trees', []) is None:
+                del question['intermediate_trees']
+        return example
+
+    def sample(
+            self,
+            randomize: bool = True,
+            offset: int = 0,
+            sample_size: int = None,
+            exclude_contrastive_examples: bool = False,
+            reverse_contrastive_sample: bool = False,
+            load_trees: bool = True,
+    ) -> 'DatasetSample':
+        """
+        Pick the examples of an eval run, the same way (and with the same random draws) as shuffling the loaded dataset
+        with random.shuffle(), filtering the contrastive stories and slicing [offset:offset + sample_size].
+
+        :param randomize: Shuffle the examples (uses the global random state, like the eval scripts always have).
+        :param offset: Skip this many examples (after shuffling and filtering).
+        :param sample_size: How many examples to keep (None for all of them).
+        :param exclude_contrastive_examples: For murder mysteries, keep one story per story_hash_id.
+        :param reverse_contrastive_sample: Keep the other stories of each story_hash_id instead.
+        :param load_trees: Parse the reasoning trees of the sampled examples (see example()).
+        """
+        order = list(range(len(self)))
+        if randomize:
+            random.shuffle(order)
+
+        indices = []
+        hashes_done = set()
+        for idx in order:
+            if sample_size is not None and len(indices) >= offset + sample_size:
+                break
+
+            if not exclude_contrastive_examples:
+                indices.append(idx)
+                continue
+
+            data = self.example(idx, load_trees=False)['questions'][0].get('intermediate_data')
+            story_hash_id = data[0].get('story_hash_id') if data and len(data) > 0 else None
+            if not story_hash_id:
+                indices.append(idx)
+                continue
+
+            if story_hash_id in hashes_done:
+                if reverse_contrastive_sample:
+                    indices.append(idx)
+            elif not reverse_contrastive_sample:
+                indices.append(idx)
+            hashes_done.add(story_hash_id)
+
+        indices = indices[offset:None if sample_size is None else offset + sample_size]
+        return DatasetSample(self, indices, load_trees=load_trees)
+
+
+class DatasetSample:
+    """The examples picked for an eval run, parsed on every iteration instead of being held in memory."""
+
+    def __init__(self, stream: DatasetStream, indices: List[int], load_trees: bool = True):
+        self.stream = stream
+        self.indices = indices
+        self.load_trees = load_trees
+
+    def __len__(self):
+        return len(self.indices)
+
+    def close(self):
+        """Close the stream the sample reads from."""
+        self.stream.close()
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        return self.stream.example(self.indices[idx], load_trees=self.load_trees)
+
+    def question_trees(self, idx: int, qidx: int) -> List[Any]:
+        """The reasoning trees of a question (parsed now, even when the sample leaves them out), idx is the position in the sample."""
+        return self.stream.example(self.indices[idx], load_trees=True)['questions'][qidx]['intermediate_trees']
+
+    def example_id(self, idx: int) -> str:
+        """See DatasetStream.example_id(), idx is the position in the sample."""
+        return self.stream.example_id(self.indices[idx])
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for idx in self.indices:
+            yield self.stream.example(idx, load_trees=self.load_trees)
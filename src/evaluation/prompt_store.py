@@ -0,0 +1,208 @@
+"""
+Compiled eval prompts.
+
+Every eval run used to build its prompts again (story + hint + question + choices, and for the ablated prompt styles the
+fact lists of every choice, which means parsing each reasoning tree and walking it).  A PromptStore holds the prompts of
+(dataset, ablation, example, question) once, built by compile() ahead of time, so the eval only looks prompts up and
+never needs the reasoning trees to make them.
+
+Prompts are content addressed: a prompt's id is its prompt_hash() (the same id the answer log uses), it is stored once
+however many questions / ablations share it, and two models given the same prompt id get byte-identical inputs.
+
+Entries are keyed on the prompt settings of the dataset and ablation (prompt_config_id(), so editing a hint compiles new
+prompts instead of reusing stale ones) and on the content of the example (DatasetStream.example_id()), not on its
+position in the file or in a shuffled sample.
+
+On disk, a store is a folder with
+
+- prompts.jsonl: {"id": ..., "prompt": ...} per unique prompt,
+- index.jsonl: {"config": ..., "example": ..., "qidx": 0, "prompt_id": ..., "tokens": ...} per question (prompt_id is
+  null for questions the ablation skips),
+- configs.json: the dataset / ablation settings behind every config id (for people reading the store).
+
+Example:
+
+    store = PromptStore(DISTILL_FOLDER / 'murder_mysteries.prompts')
+    with DatasetStream(dataset_file) as stream:
+        store.compile(stream, dataset_info, ablation)
+
+    prompt_id = store.prompt_id(dataset_info, ablation, sample.example_id(eidx), qidx)
+    prompt = store.prompt(prompt_id)
+"""
+
+import json
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from src.evaluation.answer_log import prompt_hash
+from src.evaluation.dataset_stream import DatasetStream
+from src.evaluation.prompts import build_prompt
+from src.utils.hashing import stable_hash
+
+# The keys of a dataset entry of the eval that change its prompts (see build_prompt()).
+DATASET_PROMPT_KEYS = ['hint', 'ex', 'skip_ablated', 'ablation_depth_modifier', 'allow_sorted_facts']
+# The keys of an ablation that never change its prompts.
+ABLATION_NON_PROMPT_KEYS = ['name', 'self_consistency_n', 'self_consistency_wave', 'self_consistency_confidence']
+
+IndexKey = Tuple[str, str, int]
+
+
+def prompt_config_id(dataset_info: Dict[str, Any], ablation: Dict[str, Any]) -> str:
+    """Id of everything about a dataset entry and an ablation that goes into their prompts."""
+    return stable_hash(json.dumps(prompt_config(dataset_info, ablation), sort_keys=True))
+
+
+def prompt_config(dataset_info: Dict[str, Any], ablation: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'dataset': {k: dataset_info[k] for k in DATASET_PROMPT_KEYS if k in dataset_info},
+        'ablation': {k: v for k, v in ablation.items() if k not in ABLATION_NON_PROMPT_KEYS},
+    }
+
+
+def needs_trees(ablation: Dict[str, Any]) -> bool:
+    """Do the prompts of the ablation use the reasoning trees (the fact list styles)?"""
+    return ablation.get('prompt') not in ('regular', 'cot', 'cot+')
+
+
+def estimate_tokens(prompt: str) -> int:
+    """Rough token count (~4 characters a token) for when no tokenizer is given."""
+    return len(prompt) // 4
+
+
+class PromptStore:
+    """A folder of compiled prompts (see the module docstring)."""
+
+    def __init__(self, folder: Path, count_tokens: Callable[[str], int] = None):
+        """
+        :param folder: Where the store lives (created if needed, an existing store is loaded).
+        :param count_tokens: Token count of a prompt (i.e. lambda x: len(tokenizer(x)['input_ids'])), defaults to
+            estimate_tokens().
+        """
+        self.folder = Path(folder)
+        self.folder.mkdir(exist_ok=True, parents=True)
+        self.count_tokens = count_tokens or estimate_tokens
+
+        self.prompts_file = self.folder / 'prompts.jsonl'
+        self.index_file = self.folder / 'index.jsonl'
+        self.configs_file = self.folder / 'configs.json'
+
+        self.configs: Dict[str, Any] = json.load(self.configs_file.open('r')) if self.configs_file.exists() else {}
+        self.index: Dict[IndexKey, Dict[str, Any]] = {}
+        self.compiled = set()
+        self.offsets: Dict[str, Tuple[int, int]] = {}
+
+        if self.index_file.exists():
+            with self.index_file.open('r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A compile that crashed can end in a partial line.
+                        continue
+                    self.index[(entry['config'], entry['example'], entry['qidx'])] = entry
+                    if entry.get('last'):
+                        self.compiled.add((entry['config'], entry['example']))
+
+        if self.prompts_file.exists():
+            self.__index_prompts__()
+
+        self.__prompts_handle__ = self.prompts_file.open('ab')
+        self.__index_handle__ = self.index_file.open('a')
+        self.__reader__ = self.prompts_file.open('rb')
+
+    def __index_prompts__(self):
+        with self.prompts_file.open('rb') as f:
+            start = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                # Lines start with {"id": "<id>", ... (written by add()), no need to parse the prompt.
+                self.offsets[line[8:8 + line[8:].index(b'"')].decode()] = (start, start + len(line))
+                start += len(line)
+
+        if start < self.prompts_file.stat().st_size:
+            # Drop the partial line of a compile that crashed, new prompts are appended after it.
+            with self.prompts_file.open('r+b') as f:
+                f.truncate(start)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def add(self, prompt: str) -> str:
+        """Store a prompt (once) and return its id."""
+        pid = prompt_hash(prompt)
+        if pid not in self.offsets:
+            line = (json.dumps({'id': pid, 'prompt': prompt}) + '\n').encode('utf-8')
+            start = self.__prompts_handle__.seek(0, 2)
+            self.__prompts_handle__.write(line)
+            self.__prompts_handle__.flush()
+            self.offsets[pid] = (start, start + len(line))
+        return pid
+
+    def prompt(self, prompt_id: str) -> str:
+        start, end = self.offsets[prompt_id]
+        self.__reader__.seek(start)
+        return json.loads(self.__reader__.read(end - start))['prompt']
+
+    def entry(self, dataset_info: Dict[str, Any], ablation: Dict[str, Any], example_id: str, qidx: int) -> Dict[str, Any]:
+        """The index entry of a question (raises a KeyError if it was never compiled)."""
+        key = (prompt_config_id(dataset_info, ablation), example_id, qidx)
+        if key not in self.index:
+            raise KeyError(f'No compiled prompt for {dataset_info.get("name")} | {ablation.get("name")} | example {example_id} question {qidx}, compile the dataset first.')
+        return self.index[key]
+
+    def prompt_id(self, dataset_info: Dict[str, Any], ablation: Dict[str, Any], example_id: str, qidx: int) -> Optional[str]:
+        """Id of the prompt of a question, None if the ablation skips it."""
+        return self.entry(dataset_info, ablation, example_id, qidx)['prompt_id']
+
+    def get(self, dataset_info: Dict[str, Any], ablation: Dict[str, Any], example_id: str, qidx: int) -> Optional[str]:
+        """The prompt of a question (what build_prompt() returns for it)."""
+        prompt_id = self.prompt_id(dataset_info, ablation, example_id, qidx)
+        return self.prompt(prompt_id) if prompt_id is not None else None
+
+    def compile(self, stream: DatasetStream, dataset_info: Dict[str, Any], ablation: Dict[str, Any]) -> Dict[str, int]:
+        """
+        Build and store the prompts of every example of a dataset for an ablation (examples compiled before are skipped).
+
+        :return: {'examples': compiled now, 'questions': ..., 'new_prompts': prompts that were not in the store yet, 'tokens': ...}
+        """
+        config = prompt_config_id(dataset_info, ablation)
+        if config not in self.configs:
+            self.configs[config] = {'dataset': dataset_info.get('name'), 'ablation': ablation.get('name'), **prompt_config(dataset_info, ablation)}
+            json.dump(self.configs, self.configs_file.open('w'), indent=2)
+
+        stats = {'examples': 0, 'questions': 0, 'new_prompts': 0, 'tokens': 0}
+        for idx in range(len(stream)):
+            example_id = stream.example_id(idx)
+            if (config, example_id) in self.compiled:
+                continue
+
+            example = stream.example(idx, load_trees=needs_trees(ablation))
+            questions = example['questions']
+            for qidx, question in enumerate(questions):
+                prompt = build_prompt(example['context'], question, dataset_info, ablation)
+
+                prompt_id, tokens = None, 0
+                if prompt is not None:
+                    stored = len(self.offsets)
+                    prompt_id = self.add(prompt)
+                    tokens = self.count_tokens(prompt)
+                    stats['new_prompts'] += len(self.offsets) - stored
+
+                # 'last' marks the example as done, so a crash in the middle of an example compiles all of it again.
+                entry = {'config': config, 'example': example_id, 'qidx': qidx, 'prompt_id': prompt_id, 'tokens': tokens, 'last': qidx == len(questions) - 1}
+                self.index[(config, example_id, qidx)] = entry
+                self.__index_handle__.write(json.dumps(entry) + '\n')
+
+                stats['questions'] += 1
+                stats['tokens'] += tokens
+
+            self.__index_handle__.flush()
+            self.compiled.add((config, example_id))
+            stats['examples'] += 1
+        return stats
+
+    def close(self):
+        self.__prompts_handle__.close()
+        self.__index_handle__.close()
+        self.__reader__.close()
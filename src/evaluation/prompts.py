@@ -0,0 +1,52 @@
+from typing import Any, Dict, Optional
+
+from src.logic_tree.tree import LogicTree
+
+
+def format_choices(question: Dict[str, Any]) -> str:
+    """The numbered answer choices of a question, one per line ("1 - choice")."""
+    return "\n".join([f'{idx + 1} - {x}' for idx, x in enumerate(question["choices"])])
+
+
+def build_prompt(context: str, question: Dict[str, Any], dataset_info: Dict[str, Any], ablation: Dict[str, Any]) -> Optional[str]:
+    """
+    The eval prompt for one question (see the ablations in eval/eval_ibm.py for the prompt styles).
+
+    :param context: The story.
+    :param question: The question object from the dataset (question, choices and, for the ablated styles,
+        intermediate_trees).
+    :param dataset_info: The dataset entry of the eval (hint, ex, skip_ablated, ablation_depth_modifier, ...).
+    :param ablation: The ablation entry of the eval (prompt, use_example, hint_before_question, include_cs, ...).
+    :return: The prompt, or None if the question is skipped for this ablation (ablated styles without trees).
+    """
+    d = dataset_info
+    a = ablation
+
+    choices = format_choices(question)
+
+    ex_str = ''
+    if a.get('use_example') and d.get('ex'):
+        ex_str = 'Here is an example of solving the task:\n\n' + d.get('ex') + '\n\nThis is the end of the example. The real task is below.\n\n---\n\n'
+
+    prompt_style = a.get('prompt')
+    if prompt_style == 'regular':
+        return f'{ex_str}{context}\n\n{question["question"]}\n\nPick one of the following choices:\n{choices}\n\nYou must pick one option. Finally, the last thing you generate should be "ANSWER: (your answer here, include the choice number)"'
+    elif prompt_style == 'cot':
+        return f'{ex_str}{context}\n\n{question["question"]}\n\nPick one of the following choices:\n{choices}\n\nYou must pick one option. Explain your reasoning step by step before you answer. Finally, the last thing you generate should be "ANSWER: (your answer here, include the choice number)"'
+    elif prompt_style == 'cot+':
+        if a.get("hint_before_question"):
+            return f'{ex_str}{context}\n\n{d["hint"]}\n\n{question["question"]}\n\nPick one of the following choices:\n{choices}\n\nYou must pick one option. Explain your reasoning step by step before you answer. Finally, the last thing you generate should be "ANSWER: (your answer here, including the choice number)"'
+        else:
+            return f'{ex_str}{context}\n\n{question["question"]}\n\nPick one of the following choices:\n{choices}\n\nYou must pick one option. {d["hint"]} Explain your reasoning step by step before you answer. Finally, the last thing you generate should be "ANSWER: (your answer here, including the choice number)"'
+
+    if len(question["intermediate_trees"]) == 0 or d.get('skip_ablated'):
+        return None
+
+    prompt = f'{ex_str}Answer the following questions given the list of facts per answer choice.\n\n'
+    for c, t in zip(choices.split('\n'), question['intermediate_trees']):
+        facts = list(set([x.value for x in LogicTree.from_json(t).get_facts(include_cs=a.get('include_cs', False), include_deductions_from_level=-1, no_facts_after_depth=a.get('no_facts_after_depth', 3) + d.get('ablation_depth_modifier', 0))]))
+        facts = list(sorted(facts)) if d.get('allow_sorted_facts', True) else facts
+        facts_str = "\n".join([f'- {x}' for x in facts])
+        prompt += f'Facts for Choice {c}:\n{facts_str}\n\n'
+    prompt += f'Given the list of facts per answer choice answer the following question\n\n{question["question"]}\n\nPick one of the following choices:\n{choices}\n\nYou must pick on option.  After you have found the answer, say it in this format "ANSWER: (your answer here, include the choice number)"'
+    return prompt
@@ -0,0 +1,327 @@
+"""
+Run the model calls of an eval concurrently, while the eval itself stays a plain serial loop.
+
+The eval plans its prompts in the order the old serial loop made them and hands each call to an InferenceRunner, which
+runs it on a bounded thread pool belonging to the model (so every model gets its own concurrency cap: an api model can
+have many requests in flight, a local huggingface model should only ever have one).  The eval then walks over the
+returned futures in that same order to score them, so parsing, the random fallback for unparsable answers and every
+count in run_data come out exactly as they would running one call at a time.
+
+Local models (huggingface, by default) share the GPU, so instead of a pool each they all go through one
+ExclusiveQueue: a single worker that runs one local call at a time and keeps serving the model it ran last while that
+model has calls waiting (switching models can mean swapping weights, see src/model/hf_registry.py).  API models keep
+their own pools, so they run while the local model is busy.
+
+The cache gives repeated calls of a prompt at temperature != 0 the keys ".0", ".1", ... in the order they are made.  To
+keep self-consistency samples (and ablations that share a prompt) mapped to the same cached outputs as a serial run,
+reserve_cache_key() takes the key of a call when it is submitted (in the serial order) and run_inference() makes the
+call under it, so repeated calls of a prompt can run at the same time.  Models whose inference is not cached have no
+key to reserve; their calls can be given a chain key instead: calls with the same chain key (same model, same prompt)
+run one after the other in submission order.
+
+Example:
+
+    runner = InferenceRunner(default_max_concurrency=8)
+    futures = [runner.submit(model, partial(run_inference, model, p, cache_key=reserve_cache_key(model, p))) for p in prompts]
+
+    for prompted in runner.prefetch(plan_examples(), max_pending=64):
+        ...
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+from functools import partial
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Deque, Dict, Hashable, Iterable, Iterator, Optional, Tuple
+
+from src import cache
+from src.model import Model, HFModel
+from src.utils.model_utils import format_output
+
+
+def reserve_cache_key(model: Model, prompt: str, system_prompt: str = None) -> Optional[str]:
+    """
+    Take the cache key run_inference() would call the model with now (see RedisCache.reserved_key()), None if the
+    model's inference is not cached.
+    """
+    cache_key = getattr(type(model).inference, 'cache_key', None)
+    if cache_key is None:
+        return None
+    if isinstance(model, HFModel):
+        return cache_key(model, prompt)
+    return cache_key(model, prompt, system_prompt=system_prompt)
+
+
+def run_inference(model: Model, prompt: str, system_prompt: str = None, cache_key: str = None) -> str:
+    """
+    Call the model the way the eval does and return the generated text.
+
+    :param model: Any of the model wrappers.
+    :param prompt: The (already templated for huggingface models) prompt.
+    :param system_prompt: Passed to the api models; huggingface models get it through their prompt template instead.
+    :param cache_key: The key reserve_cache_key() took for this call when it was planned.
+    """
+    with cache.reserved_key(cache_key):
+        if isinstance(model, HFModel):
+            return format_output(model, model.inference(prompt))
+        return format_output(model, model.inference(prompt, system_prompt=system_prompt))
+
+
+def submit_inference(
+        runner: 'InferenceRunner',
+        model: Model,
+        prompt: str,
+        system_prompt: str = None,
+        logged_output: str = None,
+        chain_key: Hashable = None,
+        max_concurrency: int = None
+) -> Future:
+    """
+    Submit one eval call: reserve its cache key (in plan order) and run it on the runner.
+
+    :param logged_output: The answer of this call from the answer log, if it has one.  The call is not run then, but its
+        cache key is still reserved, so the cache numbers the calls after it (".1", ".2", ...) like an uninterrupted run
+        would (otherwise the first unlogged sample would get ".0" and the cached output of sample 0).
+    :param chain_key: See InferenceRunner.submit(), only used for models whose inference is not cached.
+    """
+    cache_key = reserve_cache_key(model, prompt, system_prompt)
+    if logged_output is not None:
+        future = Future()
+        future.set_result(logged_output)
+        return future
+    return runner.submit(
+        model,
+        partial(run_inference, model, prompt, system_prompt=system_prompt, cache_key=cache_key),
+        chain_key=chain_key if cache_key is None else None,
+        max_concurrency=max_concurrency
+    )
+
+
+class ExclusiveQueue:
+    """
+    One worker thread for calls that must never run at the same time (models sharing a GPU).  Calls of one owner run in
+    submission order; the worker stays with the owner it ran last while that owner has calls queued, then moves on to the
+    owner that has been waiting longest.
+    """
+
+    def __init__(self):
+        self.queues: Dict[Hashable, Deque[Tuple[Future, Callable, tuple]]] = OrderedDict()
+        self.current: Hashable = None
+        self.switches = 0
+
+        self.__condition__ = threading.Condition()
+        self.__thread__ = None
+        self.__closed__ = False
+
+    def submit(self, owner: Hashable, fn: Callable, *args) -> Future:
+        future = Future()
+        with self.__condition__:
+            assert not self.__closed__, 'The queue was shut down.'
+            self.queues.setdefault(owner, deque()).append((future, fn, args))
+            if self.__thread__ is None:
+                self.__thread__ = threading.Thread(target=self.__work__, daemon=True)
+                self.__thread__.start()
+            self.__condition__.notify()
+        return future
+
+    def __next_call__(self) -> Tuple[Future, Callable, tuple]:
+        """Pop the next call (called holding the condition, with at least one call queued)."""
+        owner = self.current if self.current in self.queues else next(iter(self.queues))
+        if owner != self.current:
+            self.switches += 1
+            self.current = owner
+
+        queue = self.queues[owner]
+        call = queue.popleft()
+        if len(queue) == 0:
+            # Dropping the empty queue sends the owner to the back of the line for its next call.
+            del self.queues[owner]
+        return call
+
+    def __work__(self):
+        while True:
+            with self.__condition__:
+                while len(self.queues) == 0 and not self.__closed__:
+                    self.__condition__.wait()
+                if len(self.queues) == 0:
+                    return
+                future, fn, args = self.__next_call__()
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def drain(self, owner: Hashable):
+        """Wait until every call of owner submitted so far has run."""
+        wait([self.submit(owner, lambda: None)])
+
+    def shutdown(self, wait: bool = True):
+        with self.__condition__:
+            self.__closed__ = True
+            self.__condition__.notify_all()
+            thread = self.__thread__
+        if wait and thread is not None:
+            thread.join()
+
+
+class InferenceRunner:
+    """
+    Bounded per-model thread pools for model calls (one shared ExclusiveQueue for local models), with chained calls and
+    a running throughput.
+    """
+
+    def __init__(self, default_max_concurrency: int = 8, exclusive: Callable[[Model], bool] = None):
+        """
+        :param default_max_concurrency: Calls in flight per model unless submit() is given a cap for it.
+        :param exclusive: Which models go through the exclusive (GPU) queue instead of a pool of their own, defaults to
+            the huggingface models.
+        """
+        self.default_max_concurrency = default_max_concurrency
+        self.exclusive = exclusive if exclusive is not None else (lambda model: isinstance(model, HFModel))
+
+        self.pools: Dict[int, ThreadPoolExecutor] = {}
+        self.exclusive_queue = ExclusiveQueue()
+        self.chains: Dict[Hashable, Future] = {}
+
+        self.submitted = 0
+        self.completed = 0
+        self.started = time.time()
+
+        self.__lock__ = threading.RLock()
+
+    @property
+    def pending(self) -> int:
+        return self.submitted - self.completed
+
+    def throughput(self) -> float:
+        """Completed calls per minute since the runner was made."""
+        return self.completed / max(time.time() - self.started, 1e-6) * 60
+
+    def submit(
+            self,
+            model: Model,
+            fn: Callable[[], Any],
+            chain_key: Hashable = None,
+            max_concurrency: int = None
+    ) -> Future:
+        """
+        Schedule a call on the model's pool.
+
+        :param model: The model the call uses (picks the pool).
+        :param fn: The call itself (i.e. partial(run_inference, model, prompt, system_prompt)).
+        :param chain_key: Calls with the same key run one after the other, in the order they were submitted (the key
+            should include the model).
+        :param max_concurrency: Size of the model's pool, only used the first time the model is seen (ignored for
+            exclusive models).
+        """
+        with self.__lock__:
+            previous = self.chains.get(chain_key) if chain_key is not None else None
+
+            # Pools and the exclusive queue hand out the work of a model first in first out, so a chained call can only
+            # start after the call it waits on has already started (no deadlock, even with one worker).
+            if self.exclusive(model):
+                future = self.exclusive_queue.submit(self.__owner__(model), self.__run__, fn, previous)
+            else:
+                pool = self.pools.get(id(model))
+                if pool is None:
+                    pool = ThreadPoolExecutor(max_workers=max_concurrency or self.default_max_concurrency)
+                    self.pools[id(model)] = pool
+                future = pool.submit(self.__run__, fn, previous)
+            self.submitted += 1
+
+            if chain_key is not None:
+                self.chains[chain_key] = future
+                future.add_done_callback(lambda f: self.__release_chain__(chain_key, f))
+
+        return future
+
+    @staticmethod
+    def __owner__(model: Model) -> Hashable:
+        """Who a call of an exclusive model belongs to: huggingface models that share a checkpoint share its weights."""
+        return model.checkpoint if isinstance(model, HFModel) else id(model)
+
+    def __run__(self, fn: Callable[[], Any], previous: Future = None) -> Any:
+        if previous is not None:
+            wait([previous])
+        try:
+            return fn()
+        finally:
+            with self.__lock__:
+                self.completed += 1
+
+    def __release_chain__(self, chain_key: Hashable, future: Future):
+        with self.__lock__:
+            if self.chains.get(chain_key) is future:
+                del self.chains[chain_key]
+
+    def prefetch(self, items: Iterable[Any], max_pending: int) -> Iterator[Any]:
+        """
+        Iterate over items (a generator that submits calls as it goes), running ahead of the consumer until
+        max_pending calls are queued or running.  This keeps the pools busy without planning the whole eval up front.
+
+        :param items: The planned work, in the order it should be consumed.
+        :param max_pending: How many submitted-but-unfinished calls to allow before waiting on the consumer.
+        """
+        items = iter(items)
+        buffer = deque()
+        exhausted = False
+        while True:
+            while not exhausted and (len(buffer) == 0 or self.pending < max_pending):
+                try:
+                    buffer.append(next(items))
+                except StopIteration:
+                    exhausted = True
+            if len(buffer) == 0:
+                return
+            yield buffer.popleft()
+
+    def close(self, model: Model = None):
+        """
+        Wait for and shut down the pool of a model (or every pool and the exclusive queue).
+
+        :param model: The model whose pool to close, None for all of them.
+        """
+        if model is not None and self.exclusive(model):
+            self.exclusive_queue.drain(self.__owner__(model))
+            return
+
+        with self.__lock__:
+            if model is None:
+                pools = list(self.pools.values())
+                self.pools = {}
+            else:
+                pools = [self.pools.pop(id(model))] if id(model) in self.pools else []
+        for pool in pools:
+            pool.shutdown(wait=True)
+        if model is None:
+            self.exclusive_queue.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    # Regression check: answers reused from the answer log still take their cache key, so a resumed run gives the
+    # sample after them the same ".N" key as an uninterrupted run.
+    from datetime import timedelta
+
+    class SampledModel(Model):
+        engine = 'sampled'
+        temperature = 1.0
+
+        @cache.cached(data_ex=timedelta(days=1), prepended_key_attr='engine,temperature=float(0)')
+        def inference(self, prompt: str, *args, **kwargs):
+            return 'ANSWER: 1'
+
+    model = SampledModel()
+    runner = InferenceRunner()
+
+    # Samples 0 and 1 are in the answer log, sample 2 is not.
+    outputs = [submit_inference(runner, model, 'prompt', logged_output='ANSWER: 2') for _ in range(2)]
+    outputs.append(submit_inference(runner, model, 'prompt'))
+    assert [x.result() for x in outputs] == ['ANSWER: 2', 'ANSWER: 2', 'ANSWER: 1']
+    assert reserve_cache_key(model, 'prompt').endswith('.3'), 'the logged samples did not take their cache keys'
+
+    runner.close()
+    print('ok')
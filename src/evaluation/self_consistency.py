@@ -0,0 +1,134 @@
+"""
+Adaptive self-consistency: ask for self-consistency samples in waves and stop once more samples can not change the vote.
+
+Plain self-consistency always spends all n samples of a question, even when the first few agree.  SampleWaves submits
+the samples of a question a wave at a time (the first wave when the eval plans the question, so it runs ahead like any
+other call) and, after every wave the eval has scored, stops when
+
+- the leading answer can no longer be overtaken by the samples that are left (majority_is_decided()), so stopping
+  gives the same majority vote all n samples would have, or
+- the leader is ahead of the runner up with at least the given confidence (majority_confidence(), the Beta stopping
+  criterion of Adaptive-Consistency, Aggarwal et al. 2023).
+
+Samples are still submitted in sample order, so they map to the same cached outputs (and answer log records) as a
+plain self-consistency run; the samples that were not needed are simply never asked for.  The eval takes the cache key
+of every sample when it submits it (see reserve_cache_key() in src/evaluation/runner.py), so the samples of a wave run
+in parallel.
+
+Example:
+
+    samples = SampleWaves(partial(submit_sample, ...), n=9, wave_size=3, confidence=0.95)
+    for scidx, prompt, future in samples:
+        ...
+        samples.vote(answer)
+    print(samples.used, samples.majority())
+"""
+
+import collections
+import math
+from concurrent.futures import Future
+from typing import Callable, Iterator, List, Optional, Tuple
+
+Sample = Tuple[int, str, Future]
+
+
+def majority_is_decided(votes: List[str], n: int) -> bool:
+    """
+    True when no way of casting the remaining n - len(votes) votes changes the majority (collections.Counter ties go to
+    the answer seen first, like the eval's most_common()).
+    """
+    remaining = n - len(votes)
+    if remaining <= 0:
+        return True
+    if len(votes) == 0:
+        return False
+
+    ranked = collections.Counter(votes).most_common()
+    leader, lead = ranked[0]
+    order = {}
+    for v in votes:
+        order.setdefault(v, len(order))
+
+    for answer, count in ranked[1:]:
+        if count + remaining > lead or (count + remaining == lead and order[answer] < order[leader]):
+            return False
+    # An answer nobody gave yet would be seen after the leader, so it has to beat it outright.
+    return remaining <= lead
+
+
+def majority_confidence(votes: List[str]) -> float:
+    """
+    Probability that the leading answer is more likely than the runner up, given the votes so far: P(p > 1/2) for
+    p ~ Beta(lead + 1, second + 1) (uniform prior).
+    """
+    if len(votes) == 0:
+        return 0.0
+    counts = [c for _, c in collections.Counter(votes).most_common(2)] + [0]
+    a, b = counts[0] + 1, counts[1] + 1
+    # For integer a, b: P(p > 1/2) = P(Binomial(a + b - 1, 1/2) < a)
+    n = a + b - 1
+    return sum([math.comb(n, j) for j in range(a)]) / 2 ** n
+
+
+class SampleWaves:
+    """The self-consistency samples of one question, asked for a wave at a time (see the module docstring)."""
+
+    def __init__(
+            self,
+            submit: Callable[[int], Optional[Sample]],
+            n: int,
+            wave_size: int = None,
+            confidence: float = None
+    ):
+        """
+        :param submit: Asks for sample scidx, returns (scidx, prompt, future) or None if there is nothing to ask.
+        :param n: Most samples to use (self_consistency_n).
+        :param wave_size: Samples per wave, None asks for all n at once (plain self-consistency, never stops early).
+        :param confidence: Also stop once majority_confidence() reaches this (None only stops on a decided majority).
+        """
+        self.submit = submit
+        self.n = n
+        self.wave_size = wave_size if wave_size is not None else n
+        self.confidence = confidence
+
+        self.votes: List[str] = []
+        self.asked = 0
+        self.stopped_early = False
+        self.__wave__ = self.__next_wave__()
+
+    @property
+    def used(self) -> int:
+        """Samples asked for so far."""
+        return self.asked
+
+    def __next_wave__(self) -> List[Sample]:
+        wave = []
+        for scidx in range(self.asked, min(self.n, self.asked + self.wave_size)):
+            sample = self.submit(scidx)
+            if sample is not None:
+                wave.append(sample)
+        self.asked = min(self.n, self.asked + self.wave_size)
+        return wave
+
+    def vote(self, answer: str):
+        """Record the parsed answer of the sample that was just scored."""
+        self.votes.append(answer)
+
+    def done(self) -> bool:
+        if self.asked >= self.n:
+            return True
+        if majority_is_decided(self.votes, self.n):
+            return True
+        return self.confidence is not None and majority_confidence(self.votes) >= self.confidence
+
+    def majority(self) -> Optional[str]:
+        return collections.Counter(self.votes).most_common()[0][0] if len(self.votes) > 0 else None
+
+    def __iter__(self) -> Iterator[Sample]:
+        while True:
+            wave, self.__wave__ = self.__wave__, []
+            yield from wave
+            if len(wave) == 0 or self.done():
+                self.stopped_early = self.asked < self.n
+                return
+            self.__wave__ = self.__next_wave__()
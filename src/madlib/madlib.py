@@ -2,9 +2,15 @@ import pprint
 from pathlib import Path
 import json
 import random
-from typing import List, Dict, Union, Type
+from typing import List, Dict, Union, Type, Iterable, Sequence, Tuple
 import copy
 
+from src.madlib.seed_store import SeedStore
+
+
+class MadlibExhaustedError(Exception):
+    """Raised when every unique combination of a madlib sample has been used."""
+
 
 class Madlib:
     """
@@ -13,13 +19,30 @@ class Madlib:
 
     def __init__(
             self,
-            items: Dict[str, Union[List[str], Path]],
+            items: Dict[str, Union[List[str], Path, Sequence[str]]],
     ):
-        self.items = {}
-        for k, v in items.items():
-            if isinstance(v, Path):
-                v = json.load(v.open('r'))
-            self.items[k] = v
+        """
+        :param items: key -> list of strings, seed json file or a key of a SeedStore (see from_seed_store()).  Files
+            are only loaded the first time their key is sampled.
+        """
+        self.items = LazyItems(items)
+        # value -> every index it appears at (built the first time values of a key are excluded), so excluding values
+        # never has to scan the item list.
+        self.indices = {}
+
+        self.__combinations__ = {}
+
+    @classmethod
+    def from_seed_store(cls, store: Union[SeedStore, Path], keys: Dict[str, str]) -> 'Madlib':
+        """
+        A madlib over the lists of a packed seed store (see src/madlib/seed_store.py), nothing is read until sampled.
+
+        :param store: The store (or its path).
+        :param keys: madlib key -> key in the store, i.e. {'motives': 'strong_motives'}
+        """
+        if not isinstance(store, SeedStore):
+            store = SeedStore(store)
+        return cls({k: store[v] for k, v in keys.items()})
 
     def sample(
             self,
@@ -27,8 +50,134 @@ class Madlib:
             disallow_value_list: List[str] = (),
             num_samples: int = 1
     ) -> List[str]:
-        uniq_set = lambda item, vals: [x for x in self.items[item] if x not in vals]
-        return random.sample(uniq_set(item, disallow_value_list), num_samples)
+        """
+        Sample num_samples distinct entries of an item, never returning a value in disallow_value_list.
+
+        The random draws are the same as random.sample() over the list with the disallowed values filtered out, the
+        filtered list is just never built.
+        """
+        values = self.items[item]
+
+        excluded = []
+        if len(disallow_value_list) > 0:
+            if item not in self.indices:
+                self.indices[item] = {}
+                for idx, x in enumerate(values):
+                    self.indices[item].setdefault(x, []).append(idx)
+            excluded = sorted(set([idx for x in disallow_value_list for idx in self.indices[item].get(x, [])]))
+        if len(excluded) == 0:
+            return random.sample(values, num_samples)
+
+        positions = random.sample(range(len(values) - len(excluded)), num_samples)
+        return [values[self.__skip_excluded__(p, excluded)] for p in positions]
+
+    @staticmethod
+    def __skip_excluded__(position: int, excluded: List[int]) -> int:
+        """Index of the position-th entry that is not excluded (excluded is sorted)."""
+        idx = position
+        for e in excluded:
+            if e > idx:
+                break
+            idx += 1
+        return idx
+
+    def combinations(self, keys: Sequence[str]) -> 'CombinationSampler':
+        """
+        The (persistent) sampler over every combination of one value per key, see CombinationSampler.
+
+        :param keys: Items of the madlib, in order (i.e. ['names', 'crime_scenes', 'murder_weapons'])
+        """
+        keys = tuple(keys)
+        if keys not in self.__combinations__:
+            self.__combinations__[keys] = CombinationSampler(self, keys)
+        return self.__combinations__[keys]
+
+
+class LazyItems(dict):
+    """The item lists of a Madlib, a seed file is only read the first time its key is used."""
+
+    def __init__(self, sources: Dict[str, Union[List[str], Path, Sequence[str]]]):
+        super().__init__()
+        self.sources = dict(sources)
+
+    def __missing__(self, key: str):
+        source = self.sources[key]
+        if isinstance(source, Path):
+            source = json.load(source.open('r'))
+        self[key] = source
+        return source
+
+
+class CombinationSampler:
+    """
+    Draws combinations of one value per key uniformly at random and without replacement, so it can tell when there are
+    none left.
+
+    It is a Fisher-Yates shuffle over the combination indices done lazily: a draw swaps the picked slot with the last
+    remaining one and shrinks the range (swap-remove), and only the swapped slots are stored.  Every draw is O(1) no
+    matter how many combinations there are.
+    """
+
+    def __init__(self, madlib: Madlib, keys: Tuple[str, ...]):
+        self.madlib = madlib
+        self.keys = keys
+        self.sizes = [len(madlib.items[k]) for k in keys]
+
+        self.total = 1
+        for size in self.sizes:
+            self.total *= size
+        self.remaining = self.total
+
+        self.__swaps__ = {}
+
+    def __len__(self):
+        return self.remaining
+
+    def draw(self) -> List[str]:
+        """A combination that has not been drawn before (raises MadlibExhaustedError once they are all used)."""
+        if self.remaining == 0:
+            raise MadlibExhaustedError(f'All {self.total} combinations of {list(self.keys)} have been sampled.')
+
+        slot = random.randrange(self.remaining)
+        last = self.remaining - 1
+
+        combination_idx = self.__swaps__.get(slot, slot)
+        last_idx = self.__swaps__.pop(last, last)
+        if slot != last:
+            self.__swaps__[slot] = last_idx
+        self.remaining -= 1
+
+        sample = []
+        for key, size in zip(reversed(self.keys), reversed(self.sizes)):
+            combination_idx, value_idx = divmod(combination_idx, size)
+            sample.append(self.madlib.items[key][value_idx])
+        return list(reversed(sample))
+
+
+class SampleHistory(list):
+    """
+    The "previously_sampled" list of DatasetBuilder.sample_madlib(), with a set of the samples (as tuples) next to it so
+    "sample in history" is O(1) instead of a scan over every earlier sample.  Meant to be appended to, not edited.
+    """
+
+    def __init__(self, samples: Iterable[List[str]] = ()):
+        super().__init__(samples)
+        self.__keys__ = set([tuple(x) for x in self])
+
+    def __contains__(self, sample) -> bool:
+        return tuple(sample) in self.__keys__
+
+    def append(self, sample: List[str]):
+        super().append(sample)
+        self.__keys__.add(tuple(sample))
+
+    def extend(self, samples: Iterable[List[str]]):
+        for sample in samples:
+            self.append(sample)
+
+    def __iadd__(self, samples: Iterable[List[str]]):
+        self.extend(samples)
+        return self
 
 
 if __name__ == "__main__":
@@ -0,0 +1,181 @@
+"""
+A packed, memory mapped store of domain seed lists (names, relationships, motives, crime scenes, ...).
+
+Madlib used to json.load() every seed file it was given, in every process.  A seed store is one binary file compiled
+from a folder of seed json files (see musr_dataset_scripts_ibm/build_seed_store.py) that is opened with mmap: nothing
+is parsed up front, a string is only decoded when it is sampled, and every worker process reading the same store
+shares the same pages through the os page cache.
+
+Layout (all integers little endian):
+
+    b'MUSRSEED' | version (u32) | directory length (u32) | directory (utf-8 json)
+    then per key: offsets ((count + 1) x u64, relative to the blob) | blob (the utf-8 strings back to back)
+
+The directory maps every key to {"count": ..., "offsets": byte position of its offsets, "blob": byte position of its
+blob, "source": {"size": ..., "mtime": ...}}.
+
+Example:
+
+    build_seed_store({'male_names': DOMAIN_SEED_FOLDER / 'male_names.json'}, DOMAIN_SEED_FOLDER / 'seeds.store')
+    store = SeedStore(DOMAIN_SEED_FOLDER / 'seeds.store')
+    names = store['male_names']  # A lazy sequence of strings
+"""
+
+import json
+import mmap
+import struct
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Dict, List, Union
+
+MAGIC = b'MUSRSEED'
+VERSION = 1
+
+_HEADER = struct.Struct('<8sII')
+_OFFSET = struct.Struct('<Q')
+
+
+def build_seed_store(seed_files: Dict[str, Union[Path, List[str]]], out_file: Path) -> Dict[str, int]:
+    """
+    Compile seed lists into a store.
+
+    :param seed_files: key -> seed json file (a list of strings) or the list itself.
+    :param out_file: Where to write the store (written to a temp file first, then moved in place).
+    :return: key -> number of strings stored.
+    """
+    directory = {}
+    sections = []
+    position = 0
+    for key, source in seed_files.items():
+        source_info = None
+        if isinstance(source, Path):
+            stat = source.stat()
+            source_info = {'size': stat.st_size, 'mtime': stat.st_mtime}
+            source = json.load(source.open('r'))
+
+        encoded = [str(x).encode('utf-8') for x in source]
+        offsets = [0]
+        for x in encoded:
+            offsets.append(offsets[-1] + len(x))
+
+        offsets_bytes = b''.join([_OFFSET.pack(x) for x in offsets])
+        blob = b''.join(encoded)
+
+        directory[key] = {'count': len(encoded), 'offsets': position, 'blob': position + len(offsets_bytes), 'source': source_info}
+        sections.extend([offsets_bytes, blob])
+        position += len(offsets_bytes) + len(blob)
+
+    # Positions above are relative to the end of the header, which we only know once the directory is serialized.
+    header_size = _HEADER.size + len(json.dumps(directory).encode('utf-8'))
+    while True:
+        shifted = {k: {**v, 'offsets': v['offsets'] + header_size, 'blob': v['blob'] + header_size} for k, v in directory.items()}
+        directory_bytes = json.dumps(shifted).encode('utf-8')
+        if _HEADER.size + len(directory_bytes) == header_size:
+            break
+        header_size = _HEADER.size + len(directory_bytes)
+
+    out_file = Path(out_file)
+    tmp_file = out_file.parent / f'.{out_file.name}.tmp'
+    with tmp_file.open('wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(directory_bytes)))
+        f.write(directory_bytes)
+        for section in sections:
+            f.write(section)
+    tmp_file.replace(out_file)
+
+    return {k: v['count'] for k, v in directory.items()}
+
+
+class SeedList(Sequence):
+    """
+    The strings of one key of a SeedStore, decoded on access.  It reads through its store (never holding the mmap
+    itself), so it pickles like the store does: as the path.
+    """
+
+    def __init__(self, store: 'SeedStore', count: int, offsets: int, blob: int):
+        self.store = store
+        self.count = count
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(self.count))]
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError('seed index out of range')
+
+        buffer = self.store.buffer
+        start, = _OFFSET.unpack_from(buffer, self.offsets + idx * _OFFSET.size)
+        end, = _OFFSET.unpack_from(buffer, self.offsets + (idx + 1) * _OFFSET.size)
+        return buffer[self.blob + start:self.blob + end].decode('utf-8')
+
+
+class SeedStore:
+    """
+    Read only, memory mapped view of a store made by build_seed_store().  Pickles as its path, so handing it to worker
+    processes re-maps the same file instead of copying the strings.
+    """
+
+    def __init__(self, file: Path):
+        self.file = Path(file)
+        self.__open__()
+
+    def __open__(self):
+        with self.file.open('rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, directory_size = _HEADER.unpack_from(self.buffer, 0)
+        assert magic == MAGIC, f'{self.file} is not a seed store.'
+        assert version == VERSION, f'{self.file} is a version {version} seed store, expected version {VERSION}.'
+        self.directory = json.loads(self.buffer[_HEADER.size:_HEADER.size + directory_size].decode('utf-8'))
+
+    def __getstate__(self):
+        return {'file': self.file}
+
+    def __setstate__(self, state):
+        self.file = state['file']
+        self.__open__()
+
+    def keys(self) -> List[str]:
+        return list(self.directory.keys())
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.directory
+
+    def __getitem__(self, key: str) -> SeedList:
+        entry = self.directory[key]
+        return SeedList(self, entry['count'], entry['offsets'], entry['blob'])
+
+    def is_stale(self, seed_files: Dict[str, Path]) -> bool:
+        """True if any of the seed files is missing from the store or changed since the store was built."""
+        for key, file in seed_files.items():
+            source = self.directory.get(key, {}).get('source')
+            if source is None:
+                return True
+            stat = Path(file).stat()
+            if stat.st_size != source['size'] or stat.st_mtime != source['mtime']:
+                return True
+        return False
+
+
+if __name__ == "__main__":
+    # Check that a store, its lists and a Madlib over them survive pickling (what handing them to worker processes does).
+    import pickle
+    import tempfile
+
+    from src.madlib.madlib import Madlib
+
+    store_file = Path(tempfile.mkdtemp()) / 'seeds.store'
+    build_seed_store({'names': ['Mackenzie', 'Ana', 'Rory'], 'weapons': ['rope', 'knife']}, store_file)
+
+    madlib = Madlib.from_seed_store(store_file, {'names': 'names', 'weapons': 'weapons'})
+    copy = pickle.loads(pickle.dumps(madlib))
+    assert list(copy.items['names']) == ['Mackenzie', 'Ana', 'Rory']
+    assert copy.items['names'].store is copy.items['weapons'].store, 'lists of one store should share one mapping'
+    assert len(pickle.dumps(madlib)) < 1024, 'the store should pickle as its path'
+    print('ok')
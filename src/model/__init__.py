@@ -1,4 +1,7 @@
 from src.model.model import Model
 from src.model.openai import OpenAIModel
 from src.model.hf import HFModel
+from src.model.hf_registry import HFModelRegistry, hf_registry
 from src.model.rits import RitsModel
+from src.model.dry_run import DryRunModel
+from src.model.replay import ReplayModel, RecordingModel
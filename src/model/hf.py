@@ -10,7 +10,8 @@ from tqdm import tqdm
 from transformers import GPT2TokenizerFast, AutoModel, AutoTokenizer, Pipeline, AutoModelForCausalLM
 
 from src.model.model import Model
-from src import cache
+from src.model.hf_registry import Checkpoint, HFModelRegistry, hf_registry
+from src import cache, tracer
 
 
 class HFModel(Model):
@@ -19,6 +20,9 @@ class HFModel(Model):
 
     NOTE: the caching mechanism here is fairly aggressive and doesn't distinguish hyperparameters from the model
     (i.e. A model at temperature 1 vs 0.5 will have the same request cached under the same key!)
+
+    The weights live in an HFModelRegistry (src/model/hf_registry.py), so HFModels of the same checkpoint share them and
+    they can be unloaded.
     """
 
     model_name: str
@@ -28,11 +32,13 @@ class HFModel(Model):
             model_name: str,
             *args,
             load_in_4bit: bool = False,
+            registry: HFModelRegistry = None
     ):
         """
         :param model_name: Huggingface model name
         :param args: Model arguments that will be passed into AutoModelForCausalLM.from_pretrained().generate(,**args)
         :param load_in_4bit: Bits and Bytes quantization to 4bit.
+        :param registry: Where the weights are loaded, defaults to the process wide hf_registry.
         """
 
         self.model_name = model_name
@@ -40,15 +46,33 @@ class HFModel(Model):
 
         self.model_args = args
 
-        # Note initialized here so you can have instantiations of the model floating around.
-        self.model = None
-        self.tokenize = None
+        # Not loaded here so you can have instantiations of the model floating around.
+        self.registry = registry if registry is not None else hf_registry
+
+    @property
+    def checkpoint(self) -> Checkpoint:
+        return self.model_name, self.load_in_4bit
+
+    @property
+    def model(self):
+        """The loaded model, None if it is not loaded."""
+        loaded = self.registry.peek(self.checkpoint)
+        return loaded.model if loaded is not None else None
 
-    def load_model(self):
-        self.model = AutoModelForCausalLM.from_pretrained(self.model_name, device_map="auto", load_in_4bit=self.load_in_4bit)
-        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+    @property
+    def tokenizer(self):
+        """The loaded tokenizer, None if it is not loaded."""
+        loaded = self.registry.peek(self.checkpoint)
+        return loaded.tokenizer if loaded is not None else None
 
+    def load_model(self, warmup: bool = False):
+        self.registry.preload([self.checkpoint], warmup=warmup)
 
+    def unload_model(self) -> bool:
+        return self.registry.unload(self.checkpoint)
+
+
+    @tracer.traced('llm', attrs=lambda self, *args, **kwargs: {'model': self.model_name})
     @cache.cached(data_ex=timedelta(days=30), no_data_ex=timedelta(hours=1), prepended_key_attr='model_name')
     def inference(self, prompt: str, *args, tokenizer_args=None, model_args=None, decode_args=None, **kwargs) -> Any:
         if model_args is None:
@@ -62,17 +86,18 @@ class HFModel(Model):
         if decode_args is None:
             decode_args = {}
 
-        if not self.model or not self.tokenizer:
-            self.load_model()
-
         messages = [
             {"role": "user", "content": prompt}
         ]
 
-        chat = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-        # print(prompt)
+        # Loads the checkpoint if needed (and keeps it loaded until the call is done).
+        with self.registry.use(self.checkpoint) as (model, tokenizer):
+            chat = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+            # print(prompt)
 
-        model_inputs = self.tokenizer(chat, return_tensors="pt", **tokenizer_args).to('cuda')
-        output = self.model.generate(**model_inputs, **model_args)
-        output = self.tokenizer.decode(output[0], skip_special_tokens=True, **decode_args)
+            model_inputs = tokenizer(chat, return_tensors="pt", **tokenizer_args).to('cuda')
+            output = model.generate(**model_inputs, **model_args)
+            prompt_tokens = model_inputs['input_ids'].shape[-1]
+            tracer.annotate(prompt_tokens=prompt_tokens, completion_tokens=output.shape[-1] - prompt_tokens)
+            output = tokenizer.decode(output[0], skip_special_tokens=True, **decode_args)
         return output
@@ -0,0 +1,179 @@
+"""
+Huggingface checkpoints, loaded once per process.
+
+HFModel used to load its checkpoint into itself on its first inference, and nothing ever unloaded it (the eval's
+`del m` only drops one of the references to it).  Now every HFModel asks a registry for its weights: a checkpoint
+(model name + quantization) is loaded once and shared by every HFModel that uses it, whatever their generation args.
+With a memory budget set, the least recently used checkpoints are unloaded to make room for the one being loaded.
+
+Only the registry holds on to the weights (HFModel looks them up on every call), so unloading a checkpoint actually
+frees its memory.  Checkpoints that are in the middle of a call are never unloaded.
+
+Preloading (optionally with a one token warm up generation) moves the load time to startup instead of the first eval
+call.
+
+Example:
+
+    hf_registry.memory_budget = 40 * 1024 ** 3  # bytes, None for no limit
+    hf_registry.preload([HFModel('microsoft/Phi-4-reasoning-plus').checkpoint], warmup=True)
+
+    with hf_registry.use(('microsoft/Phi-4-reasoning-plus', False)) as (model, tokenizer):
+        ...
+
+    hf_registry.unload(('microsoft/Phi-4-reasoning-plus', False))
+"""
+
+import gc
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+# (huggingface model name, load_in_4bit)
+Checkpoint = Tuple[str, bool]
+
+
+def load_checkpoint(checkpoint: Checkpoint) -> Tuple[Any, Any]:
+    """Load the model and tokenizer of a checkpoint (what HFModel.load_model() used to do)."""
+    model_name, load_in_4bit = checkpoint
+    model = AutoModelForCausalLM.from_pretrained(model_name, device_map="auto", load_in_4bit=load_in_4bit)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    return model, tokenizer
+
+
+def memory_footprint(model: Any) -> int:
+    """Bytes the weights (and buffers) of a loaded model take."""
+    return model.get_memory_footprint() if hasattr(model, 'get_memory_footprint') else 0
+
+
+def release_memory():
+    """Give the memory of unloaded models back (python objects, then the cached GPU blocks)."""
+    gc.collect()
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
+
+
+class LoadedCheckpoint:
+    def __init__(self, model: Any, tokenizer: Any, footprint: int):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.footprint = footprint
+        self.in_use = 0
+
+
+class HFModelRegistry:
+    """The checkpoints loaded in this process (see the module docstring)."""
+
+    def __init__(self, memory_budget: int = None, loader: Callable[[Checkpoint], Tuple[Any, Any]] = None):
+        """
+        :param memory_budget: Most bytes the loaded checkpoints may take, None for no limit.  A single checkpoint bigger
+            than the budget is still loaded (after unloading everything else).
+        :param loader: Loads the (model, tokenizer) of a checkpoint, defaults to load_checkpoint().
+        """
+        self.memory_budget = memory_budget
+        self.loader = loader if loader is not None else load_checkpoint
+
+        # Least recently used first.
+        self.loaded: Dict[Checkpoint, LoadedCheckpoint] = OrderedDict()
+        # Footprints of checkpoints loaded before, so room can be made before loading them again.
+        self.footprints: Dict[Checkpoint, int] = {}
+
+        self.loads = 0
+        self.unloads = 0
+
+        # Loading holds the lock too, two threads asking for a checkpoint should not load it twice.
+        self.__lock__ = threading.RLock()
+
+    @property
+    def loaded_bytes(self) -> int:
+        return sum([x.footprint for x in self.loaded.values()])
+
+    def is_loaded(self, checkpoint: Checkpoint) -> bool:
+        return checkpoint in self.loaded
+
+    def peek(self, checkpoint: Checkpoint) -> Optional[LoadedCheckpoint]:
+        """The loaded checkpoint, None if it is not loaded (never loads and does not count as a use)."""
+        return self.loaded.get(checkpoint)
+
+    def __make_room__(self, needed: int, keep: Checkpoint = None):
+        if self.memory_budget is None:
+            return
+        for checkpoint in list(self.loaded.keys()):
+            if self.loaded_bytes + needed <= self.memory_budget:
+                return
+            if checkpoint != keep and self.loaded[checkpoint].in_use == 0:
+                self.unload(checkpoint)
+
+    def acquire(self, checkpoint: Checkpoint) -> LoadedCheckpoint:
+        """Load the checkpoint if needed and mark it in use (pair it with release(), or use use())."""
+        with self.__lock__:
+            if checkpoint in self.loaded:
+                self.loaded.move_to_end(checkpoint)
+            else:
+                self.__make_room__(self.footprints.get(checkpoint, 0))
+
+                model, tokenizer = self.loader(checkpoint)
+                footprint = memory_footprint(model)
+                self.footprints[checkpoint] = footprint
+                self.loaded[checkpoint] = LoadedCheckpoint(model, tokenizer, footprint)
+                self.loads += 1
+
+                # The first load of a checkpoint only knows its size now.
+                self.__make_room__(0, keep=checkpoint)
+
+            entry = self.loaded[checkpoint]
+            entry.in_use += 1
+            return entry
+
+    def release(self, checkpoint: Checkpoint):
+        with self.__lock__:
+            self.loaded[checkpoint].in_use -= 1
+
+    @contextmanager
+    def use(self, checkpoint: Checkpoint):
+        """Yields the (model, tokenizer) of the checkpoint, which is not unloaded until the block is done."""
+        entry = self.acquire(checkpoint)
+        try:
+            yield entry.model, entry.tokenizer
+        finally:
+            self.release(checkpoint)
+
+    def unload(self, checkpoint: Checkpoint) -> bool:
+        """Unload a checkpoint (False if it was not loaded)."""
+        with self.__lock__:
+            if checkpoint not in self.loaded:
+                return False
+            assert self.loaded[checkpoint].in_use == 0, f'Cannot unload {checkpoint[0]}, it is in use.'
+
+            del self.loaded[checkpoint]
+            self.unloads += 1
+        release_memory()
+        return True
+
+    def unload_all(self):
+        for checkpoint in list(self.loaded.keys()):
+            self.unload(checkpoint)
+
+    def warmup(self, checkpoint: Checkpoint):
+        """Generate one token, so the first real call does not pay for the CUDA kernel setup either."""
+        with self.use(checkpoint) as (model, tokenizer):
+            inputs = tokenizer('Hello', return_tensors='pt').to(model.device)
+            model.generate(**inputs, max_new_tokens=1)
+
+    def preload(self, checkpoints: Iterable[Checkpoint], warmup: bool = False):
+        """Load checkpoints ahead of their first call (in order, so with a tight budget the last ones stay loaded)."""
+        for checkpoint in checkpoints:
+            if warmup:
+                self.warmup(checkpoint)
+            else:
+                self.acquire(checkpoint)
+                self.release(checkpoint)
+
+
+hf_registry = HFModelRegistry()
@@ -11,7 +11,8 @@ from tqdm import tqdm
 from transformers import GPT2TokenizerFast
 
 from src.model.model import Model
-from src import cache
+from src.model.rate_limiter import RateLimiter, get_rate_limiter, estimate_tokens, retry_after_seconds
+from src import cache, tracer
 
 
 class OpenAIModel(Model):
@@ -48,8 +49,12 @@ class OpenAIModel(Model):
             echo: bool = True,
 
             prompt_cost: float = None,
-            completion_cost: float = None
+            completion_cost: float = None,
 
+            requests_per_minute: float = None,
+            tokens_per_minute: float = None,
+            max_concurrency: int = 16,
+            rate_limiter: RateLimiter = None
     ):
         """
 
@@ -65,6 +70,10 @@ class OpenAIModel(Model):
         :param echo: (only for completion) https://platform.openai.com/docs/api-reference/completions/create#completions/create-echo
         :param prompt_cost: Pass in the current cost of the api you are calling to track costs (optional)
         :param completion_cost: Pass in the current cost of the api you are calling to track costs (optional)
+        :param requests_per_minute: Request budget of the engine (optional), shared by every model calling it.
+        :param tokens_per_minute: Token budget of the engine (optional), shared by every model calling it.
+        :param max_concurrency: Most calls in flight to the engine at once (the cap adapts to rate limit errors).
+        :param rate_limiter: Use this limiter instead of the one shared by the engine (see src/model/rate_limiter.py)
         """
 
         self.engine = engine
@@ -84,6 +93,10 @@ class OpenAIModel(Model):
         self.top_p = top_p
 
         self.gpt_waittime = 60
+        self.rate_limiter = rate_limiter or get_rate_limiter(
+            f'openai:{engine}', requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute,
+            max_concurrency=max_concurrency, max_delay=self.gpt_waittime
+        )
 
         self.prompt_cost = prompt_cost
         self.completion_cost = completion_cost
@@ -93,10 +106,15 @@ class OpenAIModel(Model):
             openai.api_key = os.getenv("OPENAI_API_KEY")
 
     def __update_cost__(self, raw):
+        if isinstance(raw, dict) and raw.get('API Error'):
+            return
+        tracer.annotate(prompt_tokens=raw.usage.prompt_tokens, completion_tokens=raw.usage.completion_tokens)
         if self.prompt_cost and self.completion_cost:
             cost = raw.usage.completion_tokens * self.completion_cost + raw.usage.prompt_tokens * self.prompt_cost
             self.total_cost += cost
+            tracer.annotate(cost=cost)
 
+    @tracer.traced('llm', attrs=lambda self, *args, **kwargs: {'model': self.engine})
     @cache.cached(data_ex=timedelta(days=30), no_data_ex=timedelta(hours=1), prepended_key_attr='engine,num_samples,log_probs,echo,temperature=float(0),top_p=float(1.0),stop_token,max_tokens')
     def inference(self, prompt: str, *args, **kwargs) -> Any:
         if self.api_endpoint == 'completion':
@@ -143,20 +161,25 @@ class OpenAIModel(Model):
         last_exc = None
         for i in range(self.api_max_attempts):
             try:
-                return openai.Completion.create(
-                    engine=self.engine,
-                    prompt=prompt,
-                    temperature=temperature,
-                    max_tokens=max_tokens,
-                    logprobs=logprobs,
-                    n=num_samples,
-                    echo=echo,
-                    stop=stop_token
-                )
+                with self.rate_limiter.slot(estimate_tokens(prompt, max_tokens * num_samples)) as slot:
+                    out = openai.Completion.create(
+                        engine=self.engine,
+                        prompt=prompt,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        logprobs=logprobs,
+                        n=num_samples,
+                        echo=echo,
+                        stop=stop_token
+                    )
+                    slot.used_tokens = out.usage.total_tokens
+                tracer.annotate(retries=i)
+                return out
             except openai.error.RateLimitError as e:
                 last_exc = e
                 print(f"ERROR: OPENAI Rate Error: {e}")
-                time.sleep(self.gpt_waittime + int(random.randint(1, 10)))
+                tracer.count(rate_limited=1)
+                self.rate_limiter.backoff(i, retry_after_seconds(e))
             except openai.error.APIError as e:
                 last_exc = e
                 print(f"ERROR: OPENAI API Error: {e}")
@@ -207,19 +230,24 @@ class OpenAIModel(Model):
                 if system_prompt:
                     messages = [{'role': 'system', 'content': system_prompt}, {"role": "user", "content": prompt}]
 
-                return openai.ChatCompletion.create(
-                    model=self.engine,
-                    messages=messages,
-                    temperature=temperature,
-                    top_p=top_p,
-                    max_tokens=max_tokens,
-                    n=num_samples,
-                    stop=stop_token
-                )
+                with self.rate_limiter.slot(estimate_tokens(prompt, max_tokens * num_samples, system_prompt)) as slot:
+                    out = openai.ChatCompletion.create(
+                        model=self.engine,
+                        messages=messages,
+                        temperature=temperature,
+                        top_p=top_p,
+                        max_tokens=max_tokens,
+                        n=num_samples,
+                        stop=stop_token
+                    )
+                    slot.used_tokens = out.usage.total_tokens
+                tracer.annotate(retries=i)
+                return out
             except openai.error.RateLimitError as e:
                 last_exc = e
                 print(f"ERROR: OPENAI Rate Error: {e}")
-                time.sleep(self.gpt_waittime)
+                tracer.count(rate_limited=1)
+                self.rate_limiter.backoff(i, retry_after_seconds(e))
             except openai.error.APIError as e:
                 last_exc = e
                 print(f"ERROR: OPENAI API Error: {e}")
@@ -0,0 +1,252 @@
+"""
+A rate limiter shared by every model that calls the same API endpoint.
+
+OpenAIModel and RitsModel used to sleep a fixed minute on every rate limit error, each thread on its own, so one 429
+stalled one thread while the others kept hitting the endpoint.  Now every model instance for the same engine gets the
+same RateLimiter (see get_rate_limiter()), which
+
+- keeps a token bucket for requests per minute and one for (estimated) tokens per minute, so calls are spaced out
+  before the endpoint has to complain,
+- caps how many calls are in flight and adapts that cap AIMD style: +1 after a window of successful calls, halved on a
+  429,
+- when a call is rate limited, waits what the Retry-After header asks for (if any, and makes every other thread wait
+  for it too) or an exponential backoff with full jitter (uniform between 0 and base_delay * 2^attempt).
+
+Example:
+
+    limiter = get_rate_limiter('openai:gpt-4', requests_per_minute=500, tokens_per_minute=30_000)
+    for attempt in range(max_attempts):
+        try:
+            with limiter.slot(tokens=estimate_tokens(prompt, max_tokens)) as slot:
+                out = call_the_api()
+                slot.used_tokens = out.usage.total_tokens
+            return out
+        except RateLimitError as e:
+            limiter.backoff(attempt, retry_after_seconds(e))
+
+musr_dataset_scripts_ibm/load_test_rate_limiter.py runs RitsModel against a local fake server that injects 429s.
+"""
+
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+
+class TokenBucket:
+    """
+    Holds up to `capacity` tokens and refills `rate_per_minute` of them per minute (continuously).  Taking more than
+    the capacity is allowed once the bucket is full, it then goes negative so the rate still holds in the long run.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        self.rate = rate_per_minute / 60.
+        self.capacity = capacity if capacity is not None else max(1., self.rate)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+
+    def __refill__(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` tokens are available (0 if they are now)."""
+        self.__refill__(now)
+        amount = min(amount, self.capacity)
+        return max(0., (amount - self.tokens) / self.rate)
+
+    def take(self, amount: float, now: float):
+        self.__refill__(now)
+        self.tokens -= amount
+
+    def give(self, amount: float):
+        """Return tokens that were taken but not used (can also take more with a negative amount)."""
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RateLimitSlot:
+    """What RateLimiter.slot() yields, set used_tokens once the real usage of the call is known."""
+
+    def __init__(self, tokens: float):
+        self.tokens = tokens
+        self.used_tokens = None
+
+
+class RateLimiter:
+    """Token buckets + an AIMD concurrency cap + backoff for one endpoint (see the module docstring)."""
+
+    def __init__(
+            self,
+            requests_per_minute: float = None,
+            tokens_per_minute: float = None,
+            max_concurrency: int = 16,
+            min_concurrency: int = 1,
+            initial_concurrency: int = None,
+            increase_every: int = None,
+            base_delay: float = 1.0,
+            max_delay: float = 60.0,
+            burst_seconds: float = 1.0
+    ):
+        """
+        :param requests_per_minute: Request budget of the endpoint (None for no limit).
+        :param tokens_per_minute: Token budget of the endpoint (None for no limit).
+        :param max_concurrency: Most calls ever allowed in flight at once.
+        :param min_concurrency: The concurrency cap is never halved below this.
+        :param initial_concurrency: Where the concurrency cap starts (max_concurrency by default).
+        :param increase_every: Successful calls needed to raise the cap by one (the current cap by default, i.e. +1
+            per "round" of calls).
+        :param base_delay: Backoff of the first retry is uniform in [0, base_delay] seconds, doubling every attempt.
+        :param max_delay: Cap on the backoff window (and on the Retry-After we honor).
+        :param burst_seconds: How many seconds worth of the per minute budgets can go out at once (endpoints often
+            enforce their limits over windows much shorter than a minute).
+        """
+        self.requests = TokenBucket(requests_per_minute, max(1., requests_per_minute * burst_seconds / 60.)) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute, max(1., tokens_per_minute * burst_seconds / 60.)) if tokens_per_minute else None
+
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = initial_concurrency if initial_concurrency is not None else max_concurrency
+        self.increase_every = increase_every
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.in_flight = 0
+        self.paused_until = 0.
+        self.successes = 0
+
+        # Stats, handy for load tests.
+        self.total_calls = 0
+        self.total_rate_limited = 0
+        self.total_wait = 0.
+
+        self.__condition__ = threading.Condition()
+
+    @contextmanager
+    def slot(self, tokens: float = 0):
+        """
+        Wait until a call of `tokens` (estimated) tokens can go out and hold a concurrency slot while it runs.  A call
+        that raises is neither a success nor a rate limit, call backoff() for the latter.
+        """
+        self.acquire(tokens)
+        slot = RateLimitSlot(tokens)
+        succeeded = False
+        try:
+            yield slot
+            succeeded = True
+        finally:
+            self.release(slot, succeeded)
+
+    def acquire(self, tokens: float = 0):
+        start = time.monotonic()
+        with self.__condition__:
+            while True:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if self.in_flight >= self.limit:
+                    wait = max(wait, self.max_delay)  # Woken up by release().
+                if self.requests is not None:
+                    wait = max(wait, self.requests.wait_time(1, now))
+                if self.tokens is not None:
+                    wait = max(wait, self.tokens.wait_time(tokens, now))
+
+                if wait <= 0:
+                    break
+                self.__condition__.wait(wait)
+
+            if self.requests is not None:
+                self.requests.take(1, now)
+            if self.tokens is not None:
+                self.tokens.take(tokens, now)
+            self.in_flight += 1
+            self.total_calls += 1
+            self.total_wait += now - start
+
+    def release(self, slot: RateLimitSlot, succeeded: bool = True):
+        with self.__condition__:
+            self.in_flight -= 1
+            if self.tokens is not None and slot.used_tokens is not None:
+                self.tokens.give(slot.tokens - slot.used_tokens)
+
+            if succeeded:
+                # Additive increase.
+                self.successes += 1
+                if self.successes >= (self.increase_every or self.limit) and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self.successes = 0
+            self.__condition__.notify_all()
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None, sleep: bool = True) -> float:
+        """
+        Record a rate limit error and wait before the next attempt.
+
+        Halves the concurrency cap (multiplicative decrease).  With a Retry-After every thread of this endpoint holds
+        off until then, otherwise only the caller backs off, for a random time in [0, base_delay * 2^attempt].
+
+        :param attempt: 0 for the first retry of a call.
+        :param retry_after: Seconds the endpoint asked us to wait (see retry_after_seconds()).
+        :param sleep: Set to False to only get the delay.
+        :return: The delay in seconds.
+        """
+        with self.__condition__:
+            self.total_rate_limited += 1
+            self.limit = max(self.min_concurrency, self.limit // 2)
+            self.successes = 0
+
+            if retry_after is not None:
+                delay = min(max(0., retry_after), self.max_delay)
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            else:
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+        if sleep:
+            time.sleep(delay)
+        return delay
+
+
+__limiters__: Dict[str, RateLimiter] = {}
+__limiters_lock__ = threading.Lock()
+
+
+def get_rate_limiter(key: str, **kwargs) -> RateLimiter:
+    """
+    The RateLimiter shared by everything calling `key` (the models use their endpoint and engine).  It is made with
+    kwargs (see RateLimiter) the first time a key is asked for, later kwargs are ignored.
+    """
+    with __limiters_lock__:
+        if key not in __limiters__:
+            __limiters__[key] = RateLimiter(**kwargs)
+        return __limiters__[key]
+
+
+def estimate_tokens(prompt: str, max_tokens: int = 0, system_prompt: str = None) -> int:
+    """Rough upper-ish token count of a call (about 4 characters per token for the prompt, plus the completion)."""
+    return (len(prompt) + len(system_prompt or '')) // 4 + (max_tokens or 0)
+
+
+def retry_after_seconds(exc: Exception) -> Optional[float]:
+    """
+    The Retry-After (or retry-after-ms) of a rate limit error, in seconds, or None if it has none.  Works for the
+    errors of both openai<1 (exc.headers) and openai>=1 (exc.response.headers).
+    """
+    headers = getattr(exc, 'headers', None)
+    if headers is None and getattr(exc, 'response', None) is not None:
+        headers = getattr(exc.response, 'headers', None)
+    if not headers:
+        return None
+
+    try:
+        if headers.get('retry-after-ms') is not None:
+            return float(headers.get('retry-after-ms')) / 1000.
+
+        value = headers.get('retry-after')
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,263 @@
+"""
+Record and replay LLM calls, so pipelines can be run (and timed) offline against real model outputs.
+
+RecordingModel wraps any model and appends every call to a trace file (jsonl, one call per line):
+
+    {"key": ..., "prompt": ..., "args": [...], "kwargs": {...}, "model": "microsoft/phi-4", "output": "...",
+     "api_error": false, "latency": 3.2}
+
+ReplayModel answers calls from one or more such traces.  Calls are matched on trace_key(prompt, *args, **kwargs) (a
+hash of the call, like cache.cached keys minus the model attributes); a prompt that was called several times (e.g.
+sampled again after a failed validation) gets its recorded outputs in order, cycling once they run out.
+
+Traces can also be exported from the redis cache of real runs (export_cache()).  Those only know cache keys, so the
+ReplayModel needs key_model, a model configured like the one that filled the cache, to compute the same keys (calls are
+then matched exactly like cache.cached would, including its call counter for sampled calls).
+
+On top of the outputs, ReplayModel simulates an endpoint: latency (the recorded one, a constant or a distribution, see
+parse_latency()), injected errors (error_rate) and a throughput cap (max_calls_per_minute / max_concurrency).
+
+Example:
+
+    model = RecordingModel(RitsModel(engine='microsoft/phi-4', api_endpoint='chat'), 'phi4_trace.jsonl')
+    ... run a pipeline ...
+
+    model = ReplayModel('phi4_trace.jsonl', latency='lognormal:2.0,0.5', error_rate=0.01, max_concurrency=8)
+    ... run the same pipeline offline ...
+"""
+
+import json
+import math
+import pickle
+import random
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Union
+
+from src.model.model import Model
+from src.model.rate_limiter import RateLimiter
+from src.utils.model_utils import format_output
+from src.utils.redis_cache import RedisCache
+from src.utils.tracing import tracer
+
+
+def trace_key(prompt: str, *args, **kwargs) -> str:
+    """The key a call is recorded / replayed under."""
+    return RedisCache.make_hash([prompt, list(args), {k: kwargs[k] for k in sorted(kwargs.keys())}])
+
+
+def parse_latency(spec: Union[None, float, str, Callable]) -> Union[None, str, Callable[[random.Random], float]]:
+    """
+    Latency setting of ReplayModel to a function of an rng (or 'recorded' / None).
+
+    :param spec: None (no latency), seconds, 'recorded' (what the trace says), 'uniform:low,high',
+        'lognormal:median,sigma', 'exponential:mean' or a function of a random.Random returning seconds.
+    """
+    if spec is None or spec == 'recorded' or callable(spec):
+        return spec
+    if isinstance(spec, (int, float)):
+        return lambda rng: float(spec)
+
+    name, _, params = spec.partition(':')
+    params = [float(x) for x in params.split(',')] if params else []
+    if name == 'uniform':
+        return lambda rng: rng.uniform(params[0], params[1])
+    if name == 'lognormal':
+        return lambda rng: rng.lognormvariate(math.log(params[0]), params[1])
+    if name == 'exponential':
+        return lambda rng: rng.expovariate(1. / params[0])
+    try:
+        return parse_latency(float(spec))
+    except ValueError:
+        raise Exception(f'Unknown latency distribution {spec}')
+
+
+def load_traces(trace_files: List[Union[str, Path]]) -> Dict[str, List[Dict[str, Any]]]:
+    """{key: [records in the order they were recorded]} of one or more trace files."""
+    records = {}
+    for trace_file in trace_files:
+        for line in Path(trace_file).open('r'):
+            if line.strip():
+                record = json.loads(line)
+                records.setdefault(record['key'], []).append(record)
+    return records
+
+
+def export_cache(cache: RedisCache, trace_file: Union[str, Path], match: str = '*') -> int:
+    """
+    Write every (matching) entry of the redis cache as a trace record, for ReplayModel(key_model=...).
+
+    :return: Number of entries written.
+    """
+    assert not cache.disabled, 'Enable the cache (cache.enable(db=...)) before exporting it.'
+
+    written = 0
+    with Path(trace_file).open('w') as out:
+        for key in cache.redis_backend.scan_iter(match=match):
+            key = key.decode() if isinstance(key, bytes) else key
+            if key.startswith('lease:'):
+                continue
+            try:
+                raw = pickle.loads(cache.redis_backend.get(key))
+            except Exception as e:
+                print(f'WARNING: Skipping cache entry {key}, it could not be read. ERROR: {e}')
+                continue
+            api_error = isinstance(raw, dict) and bool(raw.get('API Error'))
+            out.write(json.dumps({'key': key, 'output': format_output(None, raw), 'api_error': api_error}) + '\n')
+            written += 1
+    return written
+
+
+class RecordingModel(Model):
+    """
+    Wraps a model and appends every call (with its text output and latency) to a trace file, see the module docstring.
+    Everything else (engine, total_cost, ...) is the wrapped model's.
+    """
+
+    def __init__(self, model: Model, trace_file: Union[str, Path]):
+        """
+        :param model: The model whose calls are recorded.
+        :param trace_file: Jsonl file the calls are appended to.
+        """
+        self.model = model
+        self.trace_file = Path(trace_file)
+        self.trace_file.parent.mkdir(exist_ok=True, parents=True)
+        self.__lock__ = threading.Lock()
+
+    def __getattr__(self, item):
+        # Only called for attributes RecordingModel doesn't have itself.
+        if item == 'model':
+            raise AttributeError(item)
+        return getattr(self.model, item)
+
+    def inference(self, prompt: str, *args, **kwargs) -> Any:
+        start = time.time()
+        raw = self.model.inference(prompt, *args, **kwargs)
+        latency = time.time() - start
+
+        record = {
+            'key': trace_key(prompt, *args, **kwargs),
+            'prompt': prompt,
+            'args': list(args),
+            'kwargs': kwargs,
+            'model': getattr(self.model, 'engine', type(self.model).__name__),
+            'output': format_output(self.model, raw),
+            'api_error': isinstance(raw, dict) and bool(raw.get('API Error')),
+            'latency': latency
+        }
+        line = json.dumps(record, default=str) + '\n'
+        with self.__lock__:
+            with self.trace_file.open('a') as out:
+                out.write(line)
+        return raw
+
+
+class ReplayModel(Model):
+    """
+    Answers calls from recorded traces while simulating the latency, errors and throughput of an endpoint, see the
+    module docstring.
+    """
+
+    def __init__(
+            self,
+            trace_files: Union[str, Path, List[Union[str, Path]]],
+            model_name: str = 'replay',
+            latency: Union[None, float, str, Callable[[random.Random], float]] = 'recorded',
+            latency_scale: float = 1.0,
+            error_rate: float = 0.0,
+            raise_errors: bool = False,
+            max_calls_per_minute: float = None,
+            max_concurrency: int = None,
+            fallback_model: Model = None,
+            key_model: Model = None,
+            seed: int = 0
+    ):
+        """
+        :param trace_files: Trace file(s) from RecordingModel or export_cache().
+        :param model_name: Name used wherever the scripts expect a model/engine name.
+        :param latency: Simulated seconds per call (see parse_latency()), 'recorded' replays the recorded latencies.
+        :param latency_scale: Multiplies every latency (e.g. 0.1 to replay 10x faster).
+        :param error_rate: Chance of a call failing.  A failed call returns the fake "API Error" response the api
+            wrappers return once they run out of retries (or raises, see raise_errors).
+        :param raise_errors: Raise an Exception for injected errors instead.
+        :param max_calls_per_minute: Throughput cap, calls over it wait their turn (None for no cap).
+        :param max_concurrency: Most calls served at once, the rest wait (None for no cap).
+        :param fallback_model: Answers calls that are not in the traces (raises an Exception if None).
+        :param key_model: Match calls on the cache keys this model would use (for traces made by export_cache()).
+        :param seed: Seed of the latency and error draws.
+        """
+        if isinstance(trace_files, (str, Path)):
+            trace_files = [trace_files]
+
+        self.model_name = model_name
+        self.engine = model_name
+        self.total_cost = 0.0
+
+        self.records = load_traces(trace_files)
+        self.latency = parse_latency(latency)
+        self.latency_scale = latency_scale
+        self.error_rate = error_rate
+        self.raise_errors = raise_errors
+        self.fallback_model = fallback_model
+        self.key_model = key_model
+
+        self.limiter = None
+        if max_calls_per_minute is not None or max_concurrency is not None:
+            self.limiter = RateLimiter(
+                requests_per_minute=max_calls_per_minute, max_concurrency=max_concurrency or 1_000_000,
+                initial_concurrency=max_concurrency or 1_000_000
+            )
+
+        self.rng = random.Random(seed)
+        self.calls = {}
+        self.hits = 0
+        self.misses = 0
+        self.__lock__ = threading.Lock()
+
+    def __key__(self, prompt: str, *args, **kwargs) -> str:
+        if self.key_model is not None:
+            return type(self.key_model).inference.cache_key(self.key_model, prompt, *args, **kwargs)
+        return trace_key(prompt, *args, **kwargs)
+
+    @tracer.traced('llm', attrs=lambda self, *args, **kwargs: {'model': self.engine})
+    def inference(self, prompt: str, *args, **kwargs) -> Any:
+        key = self.__key__(prompt, *args, **kwargs)
+
+        with self.__lock__:
+            records = self.records.get(key)
+            if records:
+                record = records[self.calls.get(key, 0) % len(records)]
+                self.calls[key] = self.calls.get(key, 0) + 1
+                self.hits += 1
+            else:
+                record = None
+                self.misses += 1
+            tracer.annotate(replay='hit' if record is not None else 'miss')
+
+            fail = self.error_rate > 0 and self.rng.random() < self.error_rate
+            if self.latency == 'recorded':
+                latency = record.get('latency', 0.) if record is not None else 0.
+            elif self.latency is not None:
+                latency = self.latency(self.rng)
+            else:
+                latency = 0.
+
+        if record is None:
+            if self.fallback_model is None:
+                raise Exception(f'No recorded output for the call (key {key}): {prompt[:200]}')
+            return self.fallback_model.inference(prompt, *args, **kwargs)
+
+        if self.limiter is not None:
+            with self.limiter.slot():
+                time.sleep(max(0., latency * self.latency_scale))
+        else:
+            time.sleep(max(0., latency * self.latency_scale))
+
+        if fail:
+            if self.raise_errors:
+                raise Exception('Injected replay error.')
+            return {"text": prompt + " OPENAI Error - Injected replay error.", "API Error": True}
+        if record.get('api_error'):
+            return {"text": record['output'], "API Error": True}
+        return record['output']
@@ -16,7 +16,8 @@ from tqdm import tqdm
 from transformers import GPT2TokenizerFast
 
 from src.model.model import Model
-from src import cache
+from src.model.rate_limiter import RateLimiter, get_rate_limiter, estimate_tokens, retry_after_seconds
+from src import cache, tracer
 
 
 class RitsModel(Model):
@@ -53,8 +54,13 @@ class RitsModel(Model):
             echo: bool = True,
 
             prompt_cost: float = None,
-            completion_cost: float = None
+            completion_cost: float = None,
 
+            requests_per_minute: float = None,
+            tokens_per_minute: float = None,
+            max_concurrency: int = 16,
+            rate_limiter: RateLimiter = None,
+            base_url: str = None
     ):
         """
 
@@ -70,6 +76,11 @@ class RitsModel(Model):
         :param echo: (only for completion) https://platform.openai.com/docs/api-reference/completions/create#completions/create-echo
         :param prompt_cost: Pass in the current cost of the api you are calling to track costs (optional)
         :param completion_cost: Pass in the current cost of the api you are calling to track costs (optional)
+        :param requests_per_minute: Request budget of the endpoint (optional), shared by every model calling it.
+        :param tokens_per_minute: Token budget of the endpoint (optional), shared by every model calling it.
+        :param max_concurrency: Most calls in flight to the endpoint at once (the cap adapts to rate limit errors).
+        :param rate_limiter: Use this limiter instead of the one shared by the endpoint (see src/model/rate_limiter.py)
+        :param base_url: Call this endpoint instead of the RITS one of the engine (e.g. a local server for testing).
         """
 
         self.engine = engine
@@ -99,7 +110,9 @@ class RitsModel(Model):
             openai.api_key = os.getenv("RITS_API_KEY")
 
 
-        if engine == "mistralai/mixtral-8x22B-instruct-v0.1":
+        if base_url is not None:
+            self.base_url = base_url
+        elif engine == "mistralai/mixtral-8x22B-instruct-v0.1":
             self.base_url = 'https://inference-3scale-apicast-production.apps.rits.fmaas.res.ibm.com/mixtral-8x22b-instruct-v01/v1'
         elif engine in ["ibm-granite/granite-3.0-8b-instruct"]:
             self.base_url = 'https://inference-3scale-apicast-production.apps.rits.fmaas.res.ibm.com/granite-3-0-8b-instruct/v1'
@@ -114,13 +127,23 @@ class RitsModel(Model):
             api_key="EMPTY",
             base_url=self.base_url,
             default_headers={"RITS_API_KEY": os.environ.get("RITS_API_KEY")},
+            max_retries=0,  # Retries go through the rate limiter.
+        )
+        self.rate_limiter = rate_limiter or get_rate_limiter(
+            f'{self.base_url}:{engine}', requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute,
+            max_concurrency=max_concurrency, max_delay=self.gpt_waittime
         )
 
     def __update_cost__(self, raw):
+        if isinstance(raw, dict) and raw.get('API Error'):
+            return
+        tracer.annotate(prompt_tokens=raw.usage.prompt_tokens, completion_tokens=raw.usage.completion_tokens)
         if self.prompt_cost and self.completion_cost:
             cost = raw.usage.completion_tokens * self.completion_cost + raw.usage.prompt_tokens * self.prompt_cost
             self.total_cost += cost
+            tracer.annotate(cost=cost)
 
+    @tracer.traced('llm', attrs=lambda self, *args, **kwargs: {'model': self.engine})
     @cache.cached(data_ex=timedelta(days=30), no_data_ex=timedelta(hours=1), prepended_key_attr='engine,num_samples,log_probs,echo,temperature=float(0),top_p=float(1.0),stop_token,max_tokens')
     def inference(self, prompt: str, *args, **kwargs) -> Any:
         if self.api_endpoint == 'completion':
@@ -167,20 +190,25 @@ class RitsModel(Model):
         last_exc = None
         for i in range(self.api_max_attempts):
             try:
-                return self.client.chat.completions.create(
-                    engine=self.engine,
-                    prompt=prompt,
-                    temperature=temperature,
-                    max_tokens=max_tokens,
-                    logprobs=logprobs,
-                    n=num_samples,
-                    echo=echo,
-                    stop=stop_token
-                )
+                with self.rate_limiter.slot(estimate_tokens(prompt, max_tokens * num_samples)) as slot:
+                    out = self.client.chat.completions.create(
+                        engine=self.engine,
+                        prompt=prompt,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        logprobs=logprobs,
+                        n=num_samples,
+                        echo=echo,
+                        stop=stop_token
+                    )
+                    slot.used_tokens = out.usage.total_tokens
+                tracer.annotate(retries=i)
+                return out
             except openai.RateLimitError as e:
                 last_exc = e
                 print(f"ERROR: OPENAI Rate Error: {e}")
-                time.sleep(self.gpt_waittime + int(random.randint(1, 10)))
+                tracer.count(rate_limited=1)
+                self.rate_limiter.backoff(i, retry_after_seconds(e))
             except openai.APIConnectionError as e:
                 last_exc = e
                 print(f"ERROR: OPENAI APIConnection Error: {e}")
@@ -231,31 +259,30 @@ class RitsModel(Model):
                 if system_prompt:
                     messages = [{'role': 'system', 'content': system_prompt}, {"role": "user", "content": prompt}]
 
-                return self.client.chat.completions.create(
-                    model=self.engine,
-                    messages=messages,
-                    temperature=temperature,
-                    top_p=top_p,
-                    max_tokens=max_tokens,
-                    n=num_samples,
-                    stop=stop_token
-                )
+                with self.rate_limiter.slot(estimate_tokens(prompt, max_tokens * num_samples, system_prompt)) as slot:
+                    out = self.client.chat.completions.create(
+                        model=self.engine,
+                        messages=messages,
+                        temperature=temperature,
+                        top_p=top_p,
+                        max_tokens=max_tokens,
+                        n=num_samples,
+                        stop=stop_token
+                    )
+                    slot.used_tokens = out.usage.total_tokens
+                tracer.annotate(retries=i)
+                return out
             except openai.RateLimitError as e:
                 last_exc = e
                 print(f"ERROR: OPENAI Rate Error: {e}")
-                time.sleep(self.gpt_waittime)
-            except openai.APIError as e:
-                last_exc = e
-                print(f"ERROR: OPENAI API Error: {e}")
-            except openai.Timeout as e:
-                last_exc = e
-                print(f"ERROR: OPENAI Timeout Error: {e}")
-            except openai.error.APIConnectionError as e:
+                tracer.count(rate_limited=1)
+                self.rate_limiter.backoff(i, retry_after_seconds(e))
+            except openai.APIConnectionError as e:
                 last_exc = e
                 print(f"ERROR: OPENAI APIConnection Error: {e}")
-            except openai.error.ServiceUnavailableError as e:
+            except openai.APIError as e:
                 last_exc = e
-                print(f"ERROR: OPENAI Service Error: {e}")
+                print(f"ERROR: OPENAI API Error: {e}")
         # make a fake response
         return {
             "text": prompt + " OPENAI Error - " + str(last_exc),
@@ -0,0 +1,21 @@
+import hashlib
+
+
+def stable_hash(text: str, length: int = 16) -> str:
+    """
+    Content addressed id for a string.  Unlike python's hash(), which is salted per process, this gives the same id in
+    every run, worker and machine.
+
+    :param text: What to hash.
+    :param length: Number of hex characters to keep.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:length]
+
+
+def story_hash_id(intro: str) -> str:
+    """
+    The id shared by the contrastive versions of a murder mystery (same intro, different murderer).
+
+    :param intro: The introduction paragraph of the story (the part that is identical across the contrastive versions)
+    """
+    return stable_hash(intro.strip())
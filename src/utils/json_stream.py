@@ -0,0 +1,174 @@
+"""
+Find values inside a (possibly huge) json document without parsing all of it.
+
+json.load() has to materialize the whole document, which for the eval datasets (and the eval outputs, where every
+answer carries its prompt, its output and the reasoning trees) means holding gigabytes of python objects just to look at
+a handful of them.  Here we scan the raw bytes instead: the scanner only descends into the containers on the way to the
+values you asked for (a key path like ('questions', '*', 'intermediate_trees')) and jumps over everything else by
+matching brackets, so the only thing you pay for is the bytes you actually json.loads() afterwards.
+
+Example:
+
+    with open_json_buffer(Path('murder_mysteries.json')) as buffer:
+        for path, start, end in iter_value_spans(buffer, [('*',)]):
+            example = json.loads(buffer[start:end])
+"""
+
+import json
+import mmap
+import re
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator, List, Tuple, Union, Sequence
+
+KeyPath = Tuple[Union[str, int], ...]
+
+WILDCARD = '*'
+
+_STRUCTURE = re.compile(rb'["\[\]{}]')
+_STRING_REST = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+_SCALAR_END = re.compile(rb'[,\]}\s]')
+_NON_WHITESPACE = re.compile(rb'\S')
+
+
+@contextmanager
+def open_json_buffer(file: Path):
+    """
+    Memory map a file for scanning (the os pages it in and out as needed, nothing is read up front).
+
+    :param file: Path to a json (or jsonl) file.
+    """
+    with Path(file).open('rb') as f:
+        if Path(file).stat().st_size == 0:
+            yield b''
+            return
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield buffer
+        finally:
+            buffer.close()
+
+
+def iter_value_spans(buffer: Union[bytes, mmap.mmap], key_paths: Sequence[KeyPath]) -> Iterator[Tuple[KeyPath, int, int]]:
+    """
+    Yield the (path, start, end) byte span of every value in the document whose path matches one of the key paths, in
+    document order.
+
+    A path is the sequence of object keys / array indices from the root to a value, e.g. ('questions', 0, 'answer').
+    In key_paths, '*' matches any key or index, so ('*',) is every element of a root list and
+    ('gpt-4', 'murder mysteries', 'cot+', 'examples', '*') every example of one ablation in an eval output.
+
+    :param buffer: The raw json (bytes or a memory map, see open_json_buffer()).
+    :param key_paths: Paths of the values to find.
+    """
+    patterns = [tuple(p) for p in key_paths]
+    if len(buffer) == 0:
+        return
+    yield from __walk__(buffer, 0, (), patterns)
+
+
+def iter_json_values(file: Path, key_paths: Sequence[KeyPath]) -> Iterator[Tuple[KeyPath, Any]]:
+    """
+    Parse every value of the file matching one of the key paths, one at a time (see iter_value_spans()).
+
+    :param file: Path to a json file.
+    :param key_paths: Paths of the values to parse.
+    """
+    with open_json_buffer(file) as buffer:
+        for path, start, end in iter_value_spans(buffer, key_paths):
+            yield path, json.loads(buffer[start:end])
+
+
+def skip_value(buffer: Union[bytes, mmap.mmap], pos: int) -> int:
+    """
+    Find the end of the json value starting at pos (no whitespace) without parsing it.
+
+    :param buffer: The raw json.
+    :param pos: Byte offset of the first character of the value.
+    :return: Byte offset just past the value.
+    """
+    first = buffer[pos:pos + 1]
+    if first == b'"':
+        return __string_end__(buffer, pos)
+
+    if first not in (b'[', b'{'):
+        match = _SCALAR_END.search(buffer, pos)
+        return len(buffer) if match is None else match.start()
+
+    depth = 0
+    while True:
+        match = _STRUCTURE.search(buffer, pos)
+        if match is None:
+            raise ValueError(f'Unterminated json container starting at byte {pos}')
+        char = buffer[match.start():match.end()]
+        pos = match.end()
+
+        if char == b'"':
+            pos = __string_end__(buffer, match.start())
+        elif char in (b'[', b'{'):
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return pos
+
+
+def __string_end__(buffer, pos: int) -> int:
+    match = _STRING_REST.match(buffer, pos + 1)
+    if match is None:
+        raise ValueError(f'Unterminated json string starting at byte {pos}')
+    return match.end()
+
+
+def __skip_whitespace__(buffer, pos: int) -> int:
+    match = _NON_WHITESPACE.search(buffer, pos)
+    if match is None:
+        raise ValueError(f'Unexpected end of json at byte {pos}')
+    return match.start()
+
+
+def __path_matches__(path: KeyPath, pattern: KeyPath) -> bool:
+    return all(p == WILDCARD or p == k for k, p in zip(path, pattern))
+
+
+def __walk__(buffer, pos: int, path: KeyPath, patterns: List[KeyPath]):
+    """Yields the matching spans under the value at pos, returns the offset just past that value."""
+    pos = __skip_whitespace__(buffer, pos)
+
+    if any(len(p) == len(path) and __path_matches__(path, p) for p in patterns):
+        end = skip_value(buffer, pos)
+        yield path, pos, end
+        return end
+
+    first = buffer[pos:pos + 1]
+    if first not in (b'[', b'{') or not any(len(p) > len(path) and __path_matches__(path, p) for p in patterns):
+        return skip_value(buffer, pos)
+
+    closing = b']' if first == b'[' else b'}'
+    pos = __skip_whitespace__(buffer, pos + 1)
+    if buffer[pos:pos + 1] == closing:
+        return pos + 1
+
+    idx = 0
+    while True:
+        if first == b'[':
+            child = idx
+        else:
+            key_end = __string_end__(buffer, pos)
+            child = json.loads(buffer[pos:key_end])
+            pos = __skip_whitespace__(buffer, key_end)
+            if buffer[pos:pos + 1] != b':':
+                raise ValueError(f'Expected ":" at byte {pos}')
+            pos += 1
+
+        pos = yield from __walk__(buffer, pos, path + (child,), patterns)
+
+        pos = __skip_whitespace__(buffer, pos)
+        char = buffer[pos:pos + 1]
+        pos += 1
+        if char == closing:
+            return pos
+        if char != b',':
+            raise ValueError(f'Expected "," or "{closing.decode()}" at byte {pos - 1}')
+        pos = __skip_whitespace__(buffer, pos)
+        idx += 1
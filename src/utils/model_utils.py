@@ -0,0 +1,29 @@
+from typing import Any
+
+
+def format_output(model, raw: Any) -> str:
+    """
+    Every model wrapper returns a slightly different raw object (openai<1.0 dictionaries, openai>=1.0 response objects,
+    plain strings from huggingface and the stand-in models, and the fake "API Error" dictionary the api wrappers return
+    when they run out of retries).  This pulls out the generated text regardless of which one we got.
+
+    :param model: The model that produced the raw output (kept so callers don't have to care which model they used)
+    :param raw: The raw output of model.inference()
+    :return: The generated text.
+    """
+
+    if raw is None:
+        return ''
+    if isinstance(raw, str):
+        return raw
+    if isinstance(raw, dict) and raw.get('API Error'):
+        return raw.get('text', '')
+
+    choice = raw['choices'][0] if isinstance(raw, dict) else raw.choices[0]
+    if isinstance(choice, dict):
+        if 'message' in choice:
+            return choice['message']['content']
+        return choice.get('text', '')
+    if getattr(choice, 'message', None) is not None:
+        return choice.message.content
+    return choice.text
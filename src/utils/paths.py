@@ -5,4 +5,5 @@ ROOT_FOLDER = Path(__file__).parent.parent.parent
 OUTPUT_FOLDER = ROOT_FOLDER / 'datasets_ibm'
 DISTILL_FOLDER = ROOT_FOLDER / 'distill_ibm'
 GRANITE_LCOT_FOLDER = ROOT_FOLDER / 'granite_longcot_data'
-DOMAIN_SEED_FOLDER = ROOT_FOLDER / 'domain_seed_ibm'
\ No newline at end of file
+DOMAIN_SEED_FOLDER = ROOT_FOLDER / 'domain_seed_ibm'
+DOMAIN_SEED_STORE = DOMAIN_SEED_FOLDER / 'domain_seeds.store'
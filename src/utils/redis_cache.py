@@ -1,13 +1,57 @@
-from typing import Optional
+from typing import Callable, Dict, Optional, Tuple, Any
+from contextlib import contextmanager
+import contextvars
 from functools import wraps, partial
 import hashlib
 import json
 import pickle
+import threading
+import time
+import uuid
 from pickle import UnpicklingError
 import redis
 
+from src.utils.tracing import tracer
+
+
+# Only touch a lease while we still hold it (the token is ours), so a leader that outlived its lease can't extend or
+# free the lease of whoever took over.
+__RELEASE_LEASE__ = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+__EXTEND_LEASE__ = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+# Set by RedisCache.reserved_key(), the key the next cached call uses instead of computing its own.
+__reserved_key__ = contextvars.ContextVar('musr_reserved_cache_key', default=None)
+
+
+class __Flight__:
+    """A call in progress in this process, followers wait on done and read pickled (None if the leader failed)."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.pickled = None
+
 
 class RedisCache:
+    """
+    Caches function results in redis (see cached()).
+
+    Concurrent calls for the same key are coalesced (single-flight): within a process the first caller runs the
+    function and the others wait for its result, across processes the first caller takes a short lease on the key in
+    redis (SET NX PX, kept alive while it runs) and the others poll for the result with backoff.  If a leader dies its
+    lease times out and one of the followers takes over.
+    """
+
     redis_backend: Optional[redis.StrictRedis]
     bust_cache: bool
     disabled: bool
@@ -21,10 +65,30 @@ class RedisCache:
             db: int = 0,
             bust_cache: bool = False,
             disabled: bool = False,
+            single_flight: bool = True,
+            lease_seconds: float = 30.,
+            poll_interval: float = 0.05,
+            max_poll_interval: float = 2.,
             *args,
             **kwargs
     ):
+        """
+        :param single_flight: Coalesce concurrent calls for the same key (see the class docstring).
+        :param lease_seconds: How long a leader's lease lasts without being renewed (it is renewed every third of it
+            while the leader runs), i.e. how long followers wait on a leader that crashed.
+        :param poll_interval: First wait of a follower in another process between looks at the cache (doubles every
+            time up to max_poll_interval).
+        """
         self.keystore = {}
+        # Callers may run inference from several threads (e.g. DatasetBuilder.run_concurrently).
+        self.__keystore_lock__ = threading.Lock()
+
+        self.single_flight = single_flight
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.__flights__: Dict[str, __Flight__] = {}
+        self.__flights_lock__ = threading.Lock()
         if disabled:
             self.disable()
         else:
@@ -45,6 +109,8 @@ class RedisCache:
 
         try:
             self.redis_backend = redis.StrictRedis(host=host, port=port, db=db)
+            self.__release_lease__ = self.redis_backend.register_script(__RELEASE_LEASE__)
+            self.__extend_lease__ = self.redis_backend.register_script(__EXTEND_LEASE__)
             self.bust_cache = bust_cache
             self.disabled = False
 
@@ -95,56 +161,178 @@ class RedisCache:
 
             # If there are conditional values in the prepended key args that aren't satisfied, we do not cache.
             no_cache = False
-            key = self._key(f, *args, **kwargs)
-            if prepended_key_attr:
-                prepended_key_attrs = prepended_key_attr.split(',')
-                prepended_str = ''
-                check_keystore = False
-                for attr in prepended_key_attrs:
-                    # conditional on if we only allow to cache attributes at specific values.
-                    if '=' in attr:
-                        name, val = attr.split('=')
-                        attr = getattr(args[0], name)
-                        prepended_str += f'{str(attr)}'
-                        if attr != eval(val):
-                            check_keystore = True
-                    else:
-                        prepended_str += f'{str(getattr(args[0], attr))}'
-                key = f'{prepended_str}{key}'
-                if check_keystore:
-                    self.keystore[key] = self.keystore.get(key, -1) + 1
-                    key = f'{key}.{self.keystore[key]}'
+            key = __reserved_key__.get()
+            if key is not None:
+                # Only the outermost cached call takes the reserved key (a wrapped model calling its inner model doesn't).
+                __reserved_key__.set(None)
+            else:
+                key = self.__cache_key__(f, prepended_key_attr, *args, **kwargs)
+
+            if self.disabled or no_cache:
+                return f(*args, **kwargs)
 
             # look in the cache unless we're busting the cache
-            if not self.bust_cache and not self.disabled and not no_cache:
-                if self.redis_backend.exists(key):
+            if not self.bust_cache:
+                if self.single_flight:
+                    return self.__single_flight__(key, partial(f, *args, **kwargs), data_ex, no_data_ex)
 
-                    pickled = self.redis_backend.get(key)
-                    try:
-                        return pickle.loads(pickled)
-                    except UnpicklingError:
-                        pass
+                found, v = self.__lookup__(key)
+                if found:
+                    tracer.annotate(cache='hit')
+                    return v
 
             # run the function
+            tracer.annotate(cache='miss')
             v = f(*args, **kwargs)
+            self.__store__(key, v, data_ex, no_data_ex)
 
-            if not self.disabled and not no_cache:
-                # pickle and cache the result
-                pickled = pickle.dumps(v)
+            # return the result
+            return v
 
-                if data_ex and v is not None:
-                    ex = data_ex
-                elif no_data_ex and v is None:
-                    ex = no_data_ex
+        # The key a call would be cached under (counts as a call for keys with a call counter).
+        wrapper.cache_key = partial(self.__cache_key__, f, prepended_key_attr)
+        return wrapper
+
+    @contextmanager
+    def reserved_key(self, key: Optional[str]):
+        """
+        The first cached call made in this block uses key (taken earlier with wrapper.cache_key()) instead of computing
+        one.  Keys with a call counter (".0", ".1", ...) get their number when they are taken, so calls whose keys were
+        taken in order keep their numbers however they end up running (i.e. concurrently).  None does nothing.
+        """
+        token = __reserved_key__.set(key)
+        try:
+            yield
+        finally:
+            __reserved_key__.reset(token)
+
+    def __cache_key__(self, f, prepended_key_attr: Optional[str], *args, **kwargs) -> str:
+        key = self._key(f, *args, **kwargs)
+        if prepended_key_attr:
+            prepended_key_attrs = prepended_key_attr.split(',')
+            prepended_str = ''
+            check_keystore = False
+            for attr in prepended_key_attrs:
+                # conditional on if we only allow to cache attributes at specific values.
+                if '=' in attr:
+                    name, val = attr.split('=')
+                    attr = getattr(args[0], name)
+                    prepended_str += f'{str(attr)}'
+                    if attr != eval(val):
+                        check_keystore = True
                 else:
-                    ex = None
+                    prepended_str += f'{str(getattr(args[0], attr))}'
+            key = f'{prepended_str}{key}'
+            if check_keystore:
+                with self.__keystore_lock__:
+                    self.keystore[key] = self.keystore.get(key, -1) + 1
+                    key = f'{key}.{self.keystore[key]}'
+        return key
 
-                self.redis_backend.set(key, pickled, ex)
+    def __lookup__(self, key: str) -> Tuple[bool, Any]:
+        """(True, value) if key is cached, else (False, None)."""
+        if self.redis_backend.exists(key):
+            pickled = self.redis_backend.get(key)
+            try:
+                return True, pickle.loads(pickled)
+            except UnpicklingError:
+                pass
+        return False, None
 
-            # return the result
-            return v
+    def __store__(self, key: str, v: Any, data_ex, no_data_ex) -> bytes:
+        # pickle and cache the result
+        pickled = pickle.dumps(v)
 
-        return wrapper
+        if data_ex and v is not None:
+            ex = data_ex
+        elif no_data_ex and v is None:
+            ex = no_data_ex
+        else:
+            ex = None
+
+        self.redis_backend.set(key, pickled, ex)
+        return pickled
+
+    def __single_flight__(self, key: str, compute: Callable[[], Any], data_ex, no_data_ex) -> Any:
+        """Look key up, or compute and cache it, making sure only one caller anywhere computes it at a time."""
+        while True:
+            found, v = self.__lookup__(key)
+            if found:
+                tracer.annotate(cache='hit')
+                return v
+
+            with self.__flights_lock__:
+                flight = self.__flights__.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self.__flights__[key] = __Flight__()
+
+            if not leader:
+                flight.done.wait()
+                if flight.pickled is not None:
+                    # Everyone gets their own copy, like they would from the cache.
+                    tracer.annotate(cache='coalesced')
+                    return pickle.loads(flight.pickled)
+                # The leader failed, try again (maybe as the leader).
+                continue
+
+            try:
+                v, flight.pickled = self.__lead__(key, compute, data_ex, no_data_ex)
+                return v
+            finally:
+                with self.__flights_lock__:
+                    del self.__flights__[key]
+                flight.done.set()
+
+    def __lead__(self, key: str, compute: Callable[[], Any], data_ex, no_data_ex) -> Tuple[Any, bytes]:
+        """Take the redis lease on key (waiting out other processes), then compute and cache the value."""
+        lease_key = f'lease:{key}'
+        lease_ms = int(self.lease_seconds * 1000)
+        token = uuid.uuid4().hex
+
+        delay = self.poll_interval
+        while not self.redis_backend.set(lease_key, token, nx=True, px=lease_ms):
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_poll_interval)
+
+            found, v = self.__lookup__(key)
+            if found:
+                tracer.annotate(cache='coalesced')
+                return v, pickle.dumps(v)
+
+        try:
+            # Another process may have finished between our last look and taking the lease.
+            found, v = self.__lookup__(key)
+            if found:
+                tracer.annotate(cache='coalesced')
+                return v, pickle.dumps(v)
+
+            tracer.annotate(cache='miss')
+            with self.__keep_lease__(lease_key, token, lease_ms):
+                v = compute()
+            return v, self.__store__(key, v, data_ex, no_data_ex)
+        finally:
+            self.__release_lease__(keys=[lease_key], args=[token])
+
+    @contextmanager
+    def __keep_lease__(self, lease_key: str, token: str, lease_ms: int):
+        """Renew the lease every third of its length while the leader runs."""
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(lease_ms / 3000.):
+                try:
+                    self.__extend_lease__(keys=[lease_key], args=[token, lease_ms])
+                except redis.RedisError as e:
+                    print(f"WARNING: Could not renew the cache lease on {lease_key}. ERROR: {e}")
+
+        thread = threading.Thread(target=renew, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
 
     def _key(self, f, *args, **kwargs):
         func_name = f.__qualname__
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from pathlib import Path
+from typing import List, Dict, Any, Callable, Hashable, Iterable, Optional
+
+
+class SampleReservation:
+    """
+    A reservation book for madlib samples that can be shared between processes.
+
+    DatasetBuilder.sample_madlib only checks uniqueness against the "previously_sampled" list of the process it runs in,
+    so two workers can happily create two stories about the same victim at the same crime scene.  Passing one of these
+    into sample_madlib makes each sample a claim on the shared book instead; the first worker to claim a sample gets it,
+    everyone else resamples.
+
+    Claims go through a single dict.setdefault call on a Manager dict which is atomic on the manager server, so no
+    extra lock is needed.  Without a manager this is just an in-process set.
+    """
+
+    def __init__(self, claims: Optional[Dict[Hashable, str]] = None):
+        """
+        :param claims: A multiprocessing.Manager().dict() to share between workers (a plain dict if not given).
+        """
+
+        self.claims = claims if claims is not None else {}
+        self.__n_claims__ = 0
+
+    def reserve(self, sample: Iterable[str]) -> bool:
+        """
+        Claim a sample.
+
+        :param sample: The sampled values (order matters, same as the previously_sampled lists in sample_madlib)
+        :return: True if this call claimed the sample, False if someone else already had it.
+        """
+        self.__n_claims__ += 1
+        token = f'{os.getpid()}.{id(self)}.{self.__n_claims__}'
+        return self.claims.setdefault(tuple(sample), token) == token
+
+    def extend(self, samples: Iterable[Iterable[str]]):
+        """Mark samples as taken without claiming them (i.e. when resuming from an existing dataset)."""
+        for s in samples:
+            self.claims.setdefault(tuple(s), 'previously sampled')
+
+    def __contains__(self, sample: Iterable[str]) -> bool:
+        return tuple(sample) in self.claims
+
+    def __len__(self):
+        return len(self.claims)
+
+
+def worker_seed(base_seed: int, worker_idx: int) -> int:
+    """Independent, reproducible seed stream per worker (python's hash() is salted per process so we don't use it)."""
+    return int(hashlib.sha256(f'{base_seed}:{worker_idx}'.encode()).hexdigest()[:8], 16)
+
+
+def split_work(total: int, n_workers: int) -> List[int]:
+    """How many examples each worker should make (the first workers take the remainder)."""
+    return [total // n_workers + (1 if widx < total % n_workers else 0) for widx in range(n_workers)]
+
+
+def shard_file(out_file: Path, worker_idx: int) -> Path:
+    return out_file.parent / f'{out_file.stem}.worker{worker_idx}{out_file.suffix}'
+
+
+def merge_shards(shard_files: List[Path], out_file: Path) -> List[Dict[str, Any]]:
+    """
+    Concatenate the per-worker datasets in worker order (each worker writes its examples in creation order) so the
+    merged dataset only depends on the seeds, not on which worker finished first.
+    """
+
+    dataset = []
+    for f in shard_files:
+        if f.exists():
+            dataset.extend(json.load(f.open('r')))
+    json.dump(dataset, out_file.open('w'))
+    return dataset
+
+
+def run_sharded(
+        worker_fn: Callable[..., Any],
+        n_workers: int,
+        max_examples: int,
+        out_file: Path,
+        base_seed: int = 0,
+        progress: bool = True,
+        **worker_kwargs
+) -> Dict[str, Any]:
+    """
+    Run worker_fn in n_workers processes and merge what they create.
+
+    worker_fn is called as worker_fn(worker_idx=, n_examples=, seed=, out_file=, reservation=, **worker_kwargs) and is
+    expected to write its examples (a json list) to out_file as it goes.  It has to be importable (top level function)
+    so it can be sent to the worker process.
+
+    :param worker_fn: The per worker creation loop.
+    :param n_workers: Number of worker processes.
+    :param max_examples: Total number of examples (split evenly between workers).
+    :param out_file: Where the merged dataset goes, workers write to "{stem}.worker{idx}{suffix}" next to it.
+    :param base_seed: Seed that every worker seed is derived from.
+    :param progress: Print the throughput report.
+    :param worker_kwargs: Passed through to worker_fn.
+    :return: Throughput stats for the run.
+    """
+
+    ctx = multiprocessing.get_context()
+    manager = ctx.Manager()
+    reservation = SampleReservation(manager.dict())
+
+    shard_files = [shard_file(out_file, widx) for widx in range(n_workers)]
+
+    start = time.time()
+    procs = []
+    for widx, n_examples in enumerate(split_work(max_examples, n_workers)):
+        p = ctx.Process(
+            target=worker_fn,
+            kwargs={
+                'worker_idx': widx,
+                'n_examples': n_examples,
+                'seed': worker_seed(base_seed, widx),
+                'out_file': shard_files[widx],
+                'reservation': reservation,
+                **worker_kwargs
+            }
+        )
+        p.start()
+        procs.append(p)
+
+    for p in procs:
+        p.join()
+    elapsed = time.time() - start
+
+    failed = [widx for widx, p in enumerate(procs) if p.exitcode != 0]
+    dataset = merge_shards(shard_files, out_file)
+    per_worker = [len(json.load(f.open('r'))) if f.exists() else 0 for f in shard_files]
+    manager.shutdown()
+
+    hours = max(elapsed, 1e-9) / 3600
+    stats = {
+        'workers': n_workers,
+        'failed_workers': failed,
+        'examples': len(dataset),
+        'examples_per_worker': per_worker,
+        'elapsed_seconds': elapsed,
+        'examples_per_hour': len(dataset) / hours,
+    }
+
+    if progress:
+        print(f'SHARDED RUN | {len(dataset)} examples from {n_workers} workers in {elapsed:.1f}s | {stats["examples_per_hour"]:.1f} examples/hour')
+        if failed:
+            print(f'WARNING: workers {failed} exited with an error, their partial output was still merged.')
+    return stats
@@ -0,0 +1,267 @@
+"""
+Spans for where the time (and the tokens and money) of a generation run go.
+
+A span is a named, timed block of work with attributes (model, prompt_tokens, completion_tokens, cost, cache,
+retries, ...).  Spans opened while another one is open become its children, across the threads of
+DatasetBuilder.run_concurrently too, so a murder mystery run gives a tree like
+
+    story -> tree -> deduction -> attempt -> llm / validator -> llm
+          -> chapter -> validation round -> recall -> llm
+          -> intro -> llm
+
+Tracing is off until tracer.enable() is called (spans are then free no-ops).  Finished spans can be exported as jsonl
+(one span per line) or as a Chrome trace (open it in chrome://tracing or https://ui.perfetto.dev).  Long runs should
+flush() instead: it appends the spans finished since the last flush to the file and forgets them, so neither memory nor
+the cost of writing the trace grows with the run.
+
+Example:
+
+    from src import tracer
+
+    tracer.enable()
+    with tracer.span('story', idx=0) as story:
+        ...
+    print(tracer.rollup(story))        # {'prompt_tokens': ..., 'completion_tokens': ..., 'cost': ..., 'llm_calls': ...}
+    tracer.export('trace.json')        # Chrome trace ('.jsonl' for jsonl)
+
+    tracer.flush('trace.json')         # or: append what finished so far (last=True when the run is done)
+"""
+
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Union
+
+__current_span__ = contextvars.ContextVar('musr_current_span', default=None)
+
+ROLLUP_KEYS = ('prompt_tokens', 'completion_tokens', 'cost')
+
+
+class Span:
+    def __init__(self, name: str, span_id: int, parent_id: Optional[int], attrs: Dict[str, Any]):
+        self.name = name
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.attrs = dict(attrs)
+        self.thread = threading.get_ident()
+        self.start = time.time()
+        self.end = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.time()) - self.start
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add(self, **amounts):
+        """Add to numeric attributes (missing ones start at 0)."""
+        for k, v in amounts.items():
+            self.attrs[k] = self.attrs.get(k, 0) + v
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            'name': self.name, 'span_id': self.span_id, 'parent_id': self.parent_id, 'thread': self.thread,
+            'start': self.start, 'end': self.end, 'duration': self.duration, 'attrs': self.attrs
+        }
+
+
+class __NullSpan__(Span):
+    """What spans are when tracing is off, setting attributes on it does nothing."""
+
+    def __init__(self):
+        super().__init__('null', 0, None, {})
+
+    def set(self, **attrs):
+        pass
+
+    def add(self, **amounts):
+        pass
+
+
+NULL_SPAN = __NullSpan__()
+
+
+class Tracer:
+    """Collects spans (see the module docstring)."""
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.spans: List[Span] = []
+        self.__ids__ = itertools.count(1)
+        self.__lock__ = threading.Lock()
+        # file -> {'t0': start time its Chrome events are relative to, 'events': events written} for the files flush()
+        # has written to.
+        self.__flushed__: Dict[Path, Dict[str, Any]] = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        with self.__lock__:
+            self.spans = []
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """Time the block as a child of the current span, yields the Span so attributes can be set on it."""
+        if not self.enabled:
+            yield NULL_SPAN
+            return
+
+        parent = __current_span__.get()
+        span = Span(name, next(self.__ids__), parent.span_id if parent is not None else None, attrs)
+        token = __current_span__.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=repr(e))
+            raise
+        finally:
+            span.end = time.time()
+            __current_span__.reset(token)
+            with self.__lock__:
+                self.spans.append(span)
+
+    def traced(self, name: str, attrs: Callable[..., Dict[str, Any]] = None):
+        """
+        Decorator version of span().
+
+        :param attrs: Called with the arguments of the decorated function, returns the attributes of the span.
+        """
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return f(*args, **kwargs)
+                with self.span(name, **(attrs(*args, **kwargs) if attrs is not None else {})):
+                    return f(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def current(self) -> Span:
+        span = __current_span__.get()
+        return span if self.enabled and span is not None else NULL_SPAN
+
+    def annotate(self, **attrs):
+        """Set attributes on the current span."""
+        self.current().set(**attrs)
+
+    def count(self, **amounts):
+        """Add to numeric attributes of the current span."""
+        self.current().add(**amounts)
+
+    def descendants(self, span: Span) -> List[Span]:
+        """Finished spans under span (not including it)."""
+        with self.__lock__:
+            spans = list(self.spans)
+        children = {}
+        for s in spans:
+            children.setdefault(s.parent_id, []).append(s)
+
+        out, stack = [], list(children.get(span.span_id, []))
+        while stack:
+            s = stack.pop()
+            out.append(s)
+            stack.extend(children.get(s.span_id, []))
+        return out
+
+    def rollup(self, span: Span) -> Dict[str, Any]:
+        """Tokens, cost and llm calls / cache hits of a span and everything under it."""
+        totals = {k: 0 for k in ROLLUP_KEYS}
+        totals.update({'llm_calls': 0, 'cache_hits': 0})
+        for s in [span] + self.descendants(span):
+            for k in ROLLUP_KEYS:
+                totals[k] += s.attrs.get(k, 0) or 0
+            if s.name == 'llm':
+                totals['llm_calls'] += 1
+                totals['cache_hits'] += s.attrs.get('cache') in ('hit', 'coalesced')
+        return totals
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """{span name: count, total / max seconds and summed tokens and cost} over the finished spans."""
+        with self.__lock__:
+            spans = list(self.spans)
+        out = {}
+        for s in spans:
+            entry = out.setdefault(s.name, {'count': 0, 'total_s': 0., 'max_s': 0., **{k: 0 for k in ROLLUP_KEYS}})
+            entry['count'] += 1
+            entry['total_s'] += s.duration
+            entry['max_s'] = max(entry['max_s'], s.duration)
+            for k in ROLLUP_KEYS:
+                entry[k] += s.attrs.get(k, 0) or 0
+        return out
+
+    def export(self, file: Union[str, Path]):
+        """Write the finished spans as jsonl (.jsonl files) or a Chrome trace (anything else)."""
+        file = Path(file)
+        file.parent.mkdir(exist_ok=True, parents=True)
+        if file.suffix == '.jsonl':
+            self.export_jsonl(file)
+        else:
+            self.export_chrome(file)
+
+    def flush(self, file: Union[str, Path], last: bool = False):
+        """
+        Append the spans finished since the last flush to file and drop them (the first flush to a file starts it
+        over).  Jsonl files (.jsonl) get a line per span; anything else is a Chrome trace in the JSON array format,
+        whose closing bracket is optional, so the trace can be opened while the run is still going (last=True closes it).
+        """
+        file = Path(file)
+        with self.__lock__:
+            spans, self.spans = sorted(self.spans, key=lambda x: x.start), []
+            first = file not in self.__flushed__
+            if first:
+                self.__flushed__[file] = {'t0': min([s.start for s in spans], default=time.time()), 'events': 0}
+            flushed = self.__flushed__[file]
+
+        if first:
+            file.parent.mkdir(exist_ok=True, parents=True)
+        with file.open('w' if first else 'a') as out:
+            if file.suffix == '.jsonl':
+                for s in spans:
+                    out.write(json.dumps(s.to_json(), default=str) + '\n')
+                return
+
+            if first:
+                out.write('[\n')
+            for s in spans:
+                # Every event but the first one of the file starts with the comma that separates it.
+                out.write((',\n' if flushed['events'] > 0 else '') + json.dumps(self.__chrome_event__(s, flushed['t0']), default=str))
+                flushed['events'] += 1
+            if last:
+                out.write('\n]\n')
+
+    @staticmethod
+    def __chrome_event__(s: Span, t0: float) -> Dict[str, Any]:
+        return {
+            'name': s.name, 'cat': s.name, 'ph': 'X', 'pid': os.getpid(), 'tid': s.thread,
+            'ts': (s.start - t0) * 1e6, 'dur': s.duration * 1e6,
+            'args': {**s.attrs, 'span_id': s.span_id, 'parent_id': s.parent_id}
+        }
+
+    def export_jsonl(self, file: Union[str, Path]):
+        with self.__lock__:
+            spans = list(self.spans)
+        with Path(file).open('w') as out:
+            for s in sorted(spans, key=lambda x: x.start):
+                out.write(json.dumps(s.to_json(), default=str) + '\n')
+
+    def export_chrome(self, file: Union[str, Path]):
+        """Chrome trace event format, one complete ("X") event per span."""
+        with self.__lock__:
+            spans = list(self.spans)
+        t0 = min([s.start for s in spans], default=0.)
+        events = [self.__chrome_event__(s, t0) for s in sorted(spans, key=lambda x: x.start)]
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, Path(file).open('w'), default=str)
+
+
+tracer = Tracer()
@@ -2,3 +2,4 @@ from src.validators.validator import Validator
 from src.validators.types.structure_validator import StructureValidator
 from src.validators.types.forbidden_text_validator import ForbiddenTextValidator
 from src.validators.types.model_validator import ModelValidator
+from src.validators.fact_precheck import FactPrecheck
@@ -0,0 +1,146 @@
+"""
+A cheap, local check for facts that are clearly stated in a story.
+
+MurderMysteryDataset.fact_recall_story_validation asks an LLM whether every fact of a chapter is supported by it.
+Many facts are written into the chapter nearly word for word, so FactPrecheck looks for them lexically first and only
+the facts it is unsure about are sent to the model.  It never decides a fact is missing, it only ever says "clearly
+present" or "ask the model", so the thresholds trade how many facts are skipped against how often a fact the model
+would have rejected slips through (measure that with musr_dataset_scripts_ibm/measure_fact_precheck.py).
+
+A fact is clearly present when:
+
+- every capitalized word in it (names, places, ...) appears in the story, and
+- most of its content words (min_unigram_containment) and word pairs (min_bigram_containment, pairs within one
+  sentence) appear in the story, after lowercasing, dropping punctuation and stop words and a light stemming, and
+- it has the same polarity as the story sentence(s) it matches best: negations (not, never, n't, without, nobody, ...)
+  are the one thing that may never be missing, "Mackenzie was not seen near the boathouse" is the opposite of the
+  story's "Mackenzie was seen near the boathouse" while sharing all of its other words.
+
+Example:
+
+    precheck = FactPrecheck()
+    precheck.is_present('Mackenzie was seen near the boathouse.', story)
+    present, uncertain = precheck.split(facts, story)
+"""
+
+import re
+from typing import List, Set, Tuple
+
+STOP_WORDS = {
+    'a', 'an', 'the', 'and', 'or', 'but', 'of', 'to', 'in', 'on', 'at', 'by', 'for', 'with', 'from', 'as', 'into',
+    'is', 'was', 'are', 'were', 'be', 'been', 'being', 'has', 'had', 'have', 'do', 'does', 'did', 'that', 'this',
+    'these', 'those', 'it', 'its', 'he', 'she', 'they', 'his', 'her', 'their', 'them', 'him', 'who', 'which', 'also',
+    'very', 'so', 'than', 'then', 'there', 'just', 'about'
+}
+
+NEGATIONS = {
+    'not', 'no', 'never', 'without', 'nobody', 'none', 'nothing', 'nowhere', 'neither', 'nor', 'cannot', 'noone'
+}
+
+_WORD = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+_NAME = re.compile(r"\b[A-Z][a-z]+")
+_SENTENCE_END = re.compile(r"[.!?;\n]+")
+
+
+def stem(word: str) -> str:
+    """Very light suffix stripping so "murdered"/"murders"/"murdering" meet."""
+    if word.endswith("'s"):
+        word = word[:-2]
+    for suffix in ('ing', 'ed', 'es', 's'):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+
+def words(text: str) -> List[str]:
+    """Lowercased words without punctuation (possessives kept as "name's")."""
+    return _WORD.findall(text.lower().replace('\u2019', "'"))
+
+
+def is_negation(word: str) -> bool:
+    return word in NEGATIONS or word.endswith("n't")
+
+
+def negated(text_words: List[str]) -> bool:
+    """Does a fact / sentence (its words()) say something is not so?"""
+    return any([is_negation(x) for x in text_words])
+
+
+def content_words(text: str) -> List[str]:
+    return [stem(x) for x in words(text) if x not in STOP_WORDS]
+
+
+def names(text: str) -> Set[str]:
+    """Capitalized words (names, places, ... and the odd sentence start, which only makes the check stricter)."""
+    return {x.lower() for x in _NAME.findall(text) if x.lower() not in STOP_WORDS}
+
+
+class FactPrecheck:
+    """Lexical containment check of facts against a story (see the module docstring)."""
+
+    def __init__(self, min_unigram_containment: float = 0.9, min_bigram_containment: float = 0.75, min_content_words: int = 3):
+        """
+        :param min_unigram_containment: Fraction of the fact's content words that must be in the story.
+        :param min_bigram_containment: Fraction of the fact's adjacent content word pairs that must be in the story.
+        :param min_content_words: Facts with fewer content words are always sent to the model (too little to go on).
+        """
+        self.min_unigram_containment = min_unigram_containment
+        self.min_bigram_containment = min_bigram_containment
+        self.min_content_words = min_content_words
+
+    @staticmethod
+    def story_ngrams(story: str) -> Tuple[Set[str], Set[Tuple[str, str]], Set[str], List[Tuple[Set[str], bool]]]:
+        """
+        What the facts are looked up in: the story's content words, content word pairs (within a sentence), raw words
+        and (content words, negated) per sentence.
+        """
+        sentences = [(content_words(x), negated(words(x))) for x in _SENTENCE_END.split(story)]
+        unigrams = {x for sentence, _ in sentences for x in sentence}
+        bigrams = {x for sentence, _ in sentences for x in zip(sentence, sentence[1:])}
+        tokens = {x[:-2] if x.endswith("'s") else x for x in words(story)}
+        return unigrams, bigrams, tokens, [(set(x), n) for x, n in sentences if len(x) > 0]
+
+    def scores(self, fact: str, story_ngrams) -> Tuple[float, float, bool, bool]:
+        """
+        (unigram containment, bigram containment, all names present, same polarity) of a fact in a story (see
+        story_ngrams()).  The polarity agrees when the fact's negations are all in the story and every story sentence
+        sharing the most content words with the fact is negated exactly when the fact is.
+        """
+        story_words, story_bigrams, story_tokens, story_sentences = story_ngrams
+
+        fact_words = content_words(fact)
+        bigrams = list(zip(fact_words, fact_words[1:]))
+        unigram = sum([x in story_words for x in fact_words]) / len(fact_words) if len(fact_words) > 0 else 0.
+        bigram = sum([x in story_bigrams for x in bigrams]) / len(bigrams) if len(bigrams) > 0 else 0.
+        all_names = all([x in story_tokens for x in names(fact)])
+
+        raw_fact_words = words(fact)
+        fact_negated = negated(raw_fact_words)
+        negations_present = all([x in story_tokens for x in raw_fact_words if is_negation(x)])
+
+        matched = {x for x in fact_words if not is_negation(x)}
+        overlaps = [len(matched & sentence) for sentence, _ in story_sentences]
+        best = max(overlaps, default=0)
+        same_polarity = negations_present and best > 0 and all([
+            sentence_negated == fact_negated for (_, sentence_negated), overlap in zip(story_sentences, overlaps) if overlap == best
+        ])
+        return unigram, bigram, all_names, same_polarity
+
+    def is_present(self, fact: str, story: str, story_ngrams=None) -> bool:
+        """
+        True if the fact is clearly stated in the story, False if the model should decide.
+
+        :param story_ngrams: story_ngrams(story), pass it when checking many facts against the same story.
+        """
+        if len(content_words(fact)) < self.min_content_words:
+            return False
+        unigram, bigram, all_names, same_polarity = self.scores(fact, story_ngrams if story_ngrams is not None else self.story_ngrams(story))
+        return all_names and same_polarity and unigram >= self.min_unigram_containment and bigram >= self.min_bigram_containment
+
+    def split(self, facts: List[str], story: str) -> Tuple[List[str], List[str]]:
+        """Split facts into (clearly present, uncertain), keeping their order."""
+        story_ngrams = self.story_ngrams(story)
+        present, uncertain = [], []
+        for fact in facts:
+            (present if self.is_present(fact, story, story_ngrams) else uncertain).append(fact)
+        return present, uncertain